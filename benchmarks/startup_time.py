@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""Measure the cold start time of ``import mdt`` and of the command line scripts.
+
+Every measurement starts a new Python interpreter, such that nothing is cached in memory by a previous import. The
+command line scripts are started with ``--help``, which measures the time needed to get to the argument parser.
+Per command we report the minimum and the median over a number of repeats.
+
+Example of use::
+
+    python benchmarks/startup_time.py
+    python benchmarks/startup_time.py --repeats 10 --scripts mdt_info_protocol mdt_model_fit
+    python benchmarks/startup_time.py --output startup_times.json
+"""
+from __future__ import print_function
+
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import timeit
+
+__author__ = 'Robbert Harms'
+__date__ = "2017-04-20"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+def get_cli_scripts():
+    """Get the module names of all the command line scripts.
+
+    Returns:
+        list of str: the names of the modules in ``mdt.cli_scripts`` that define a command
+    """
+    scripts_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'mdt', 'cli_scripts')
+    return list(sorted(os.path.splitext(os.path.basename(f))[0]
+                       for f in glob.glob(os.path.join(scripts_dir, 'mdt_*.py'))))
+
+
+def time_command(command, repeats):
+    """Time the execution of the given command in a new process.
+
+    Args:
+        command (list of str): the command to run
+        repeats (int): the number of times we run the command
+
+    Returns:
+        tuple: the minimum and the median run time in seconds, or None if the command failed
+    """
+    run_times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeats):
+            start_time = timeit.default_timer()
+            return_code = subprocess.call(command, stdout=devnull, stderr=devnull)
+            run_times.append(timeit.default_timer() - start_time)
+
+            if return_code != 0:
+                return None
+
+    run_times = sorted(run_times)
+    return run_times[0], run_times[len(run_times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--repeats', type=int, default=5, help='the number of runs per command, defaults to 5')
+    parser.add_argument('--scripts', nargs='*', help='the command line scripts to time (module names), '
+                                                     'defaults to all scripts')
+    parser.add_argument('--output', help='if given, write the results as json to this file')
+    args = parser.parse_args()
+
+    commands = [('import mdt', [sys.executable, '-c', 'import mdt'])]
+    for script in (get_cli_scripts() if args.scripts is None else args.scripts):
+        commands.append((script.replace('_', '-'), [sys.executable, '-m', 'mdt.cli_scripts.' + script, '--help']))
+
+    baseline = time_command([sys.executable, '-c', 'pass'], args.repeats)
+    print('{:<30}{:>12}{:>12}'.format('command', 'min (s)', 'median (s)'))
+    print('{:<30}{:>12.3f}{:>12.3f}'.format('python (baseline)', *baseline))
+
+    results = {'python (baseline)': {'min': baseline[0], 'median': baseline[1]}}
+    for name, command in commands:
+        run_time = time_command(command, args.repeats)
+
+        if run_time is None:
+            print('{:<30}{:>24}'.format(name, 'failed'))
+            results[name] = None
+        else:
+            print('{:<30}{:>12.3f}{:>12.3f}'.format(name, *run_time))
+            results[name] = {'min': run_time[0], 'median': run_time[1]}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,39 +1,25 @@
+"""The Maastricht Diffusion Toolbox.
+
+Most of the public API in this module is imported lazily, on first use, such that ``import mdt`` (and with that the
+command line scripts) does not pay for loading OpenCL, the components and the configuration before they are needed.
+On Python versions without support for module level ``__getattr__`` (PEP 562), everything is imported directly.
+"""
 import collections
 import glob
+import importlib
 import logging
-import logging.config as logging_config
 import os
+import sys
 from inspect import stack
 from contextlib import contextmanager
-import numpy as np
 import shutil
 import six
 from six import string_types
 
 from .__version__ import VERSION, VERSION_STATUS, __version__
 
-
-from mdt.configuration import get_logging_configuration_dict
-try:
-    logging_config.dictConfig(get_logging_configuration_dict())
-except ValueError:
-    print('Logging disabled')
-
-
 from mdt.user_script_info import easy_save_user_script_info
-from mdt.utils import estimate_noise_std, get_cl_devices, load_problem_data, create_blank_mask, create_index_matrix, \
-    volume_index_to_roi_index, roi_index_to_volume_index, load_brain_mask, init_user_settings, restore_volumes, \
-    apply_mask, create_roi, volume_merge, protocol_merge, create_median_otsu_brain_mask, load_samples, \
-    load_nifti, write_slice_roi, split_write_dataset, apply_mask_to_file, extract_volumes, recalculate_error_measures, \
-    create_signal_estimates, get_slice_in_dimension, per_model_logging_context, get_temporary_results_dir, \
-    get_example_data, create_sort_matrix, sort_volumes_per_voxel, sort_orientations, SimpleInitializationData
-from mdt.batch_utils import collect_batch_fit_output, collect_batch_fit_single_map, run_function_on_batch_fit_output
-from mdt.protocols import load_bvec_bval, load_protocol, auto_load_protocol, write_protocol, write_bvec_bval
-from mdt.components_loader import load_component, get_model, component_import, construct_component, get_component_class
-from mdt.configuration import config_context, get_processing_strategy
 from mdt.exceptions import InsufficientProtocolError
-from mdt.model_sampling import combine_sampling_information
-from mdt.nifti import write_nifti
 
 
 __author__ = 'Robbert Harms'
@@ -43,6 +29,55 @@ __maintainer__ = "Robbert Harms"
 __email__ = "robbert.harms@maastrichtuniversity.nl"
 
 
+_lazy_imports = {}
+"""Per module the names we expose in this module but only import on first use."""
+_lazy_imports.update({name: 'mdt.utils' for name in (
+    'estimate_noise_std', 'get_cl_devices', 'load_problem_data', 'create_blank_mask', 'create_index_matrix',
+    'volume_index_to_roi_index', 'roi_index_to_volume_index', 'load_brain_mask', 'init_user_settings',
+    'restore_volumes', 'apply_mask', 'create_roi', 'volume_merge', 'protocol_merge', 'create_median_otsu_brain_mask',
+    'load_samples', 'load_nifti', 'write_slice_roi', 'split_write_dataset', 'apply_mask_to_file', 'extract_volumes',
+    'recalculate_error_measures', 'create_signal_estimates', 'get_slice_in_dimension', 'per_model_logging_context',
+    'get_temporary_results_dir', 'get_example_data', 'create_sort_matrix', 'sort_volumes_per_voxel',
+    'sort_orientations', 'SimpleInitializationData')})
+_lazy_imports.update({name: 'mdt.batch_utils' for name in (
+    'collect_batch_fit_output', 'collect_batch_fit_single_map', 'run_function_on_batch_fit_output')})
+_lazy_imports.update({name: 'mdt.protocols' for name in (
+    'load_bvec_bval', 'load_protocol', 'auto_load_protocol', 'write_protocol', 'write_bvec_bval')})
+_lazy_imports.update({name: 'mdt.components_loader' for name in (
+    'load_component', 'get_model', 'component_import', 'construct_component', 'get_component_class')})
+_lazy_imports.update({name: 'mdt.configuration' for name in ('config_context', 'get_processing_strategy')})
+_lazy_imports.update({'combine_sampling_information': 'mdt.model_sampling',
+                      'write_nifti': 'mdt.nifti'})
+
+_lazy_submodules = ('batch_utils', 'cl_program_cache', 'cl_routines', 'components_config', 'components_loader',
+                    'configuration', 'data_loaders', 'deferred_mappings', 'file_conversions', 'log_handlers',
+                    'masking', 'model_fitting', 'model_protocol_problem', 'model_sampling', 'models', 'nifti',
+                    'processing_strategies', 'protocols', 'sample_statistics', 'sample_storage', 'shell_utils',
+                    'utils', 'visualization')
+"""The submodules we import on first attribute access, such that ``mdt.utils`` works after only ``import mdt``."""
+
+
+def __getattr__(name):
+    """Import the lazily loaded names of this module on first use (PEP 562).
+
+    Functions in this module can not rely on this, global lookups do not pass through this function. Those import
+    what they need themselves.
+    """
+    if name in _lazy_imports:
+        value = getattr(importlib.import_module(_lazy_imports[name]), name)
+    elif name in _lazy_submodules:
+        value = importlib.import_module('mdt.' + name)
+    else:
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy_imports) | set(_lazy_submodules))
+
+
 def fit_model(model, problem_data, output_folder, optimizer=None,
               recalculate=False, only_recalculate_last=False, cascade_subdir=False,
               cl_device_ind=None, double_precision=False, tmp_results_dir=True, save_user_script_info=True,
@@ -90,7 +125,7 @@ def fit_model(model, problem_data, output_folder, optimizer=None,
     from mdt.model_fitting import ModelFit
 
     if not mdt.utils.check_user_components():
-        init_user_settings(pass_if_exists=True)
+        mdt.utils.init_user_settings(pass_if_exists=True)
 
     model_fit = ModelFit(model, problem_data, output_folder, optimizer=optimizer, recalculate=recalculate,
                          only_recalculate_last=only_recalculate_last,
@@ -106,7 +141,7 @@ def fit_model(model, problem_data, output_folder, optimizer=None,
 
 def sample_model(model, problem_data, output_folder, sampler=None, recalculate=False,
                  cl_device_ind=None, double_precision=False, store_samples=True, append_samples=False,
-                 tmp_results_dir=True, save_user_script_info=True, initialization_data=None):
+                 tmp_results_dir=True, save_user_script_info=True, initialization_data=None, nmr_chains=1):
     """Sample a composite model using the given cascading strategy.
 
     Args:
@@ -123,8 +158,10 @@ def sample_model(model, problem_data, output_folder, sampler=None, recalculate=F
                 if you are only interested in the volume maps and not in the entire sample chain.
         append_samples (boolean): if set to True, recalculate set to False and store_samples set to True,
             we append the samples found to the already existing samples. This additionally requires that in previous
-            runs store_samples was also set to True. Currently this will not use the stored MH state object for
-            continuing the chain, that is still left as todo.
+            runs store_samples was also set to True. If the previous run stored its chain state and a Metropolis
+            Hastings sampler is used, the chains are continued exactly from that state, without burn-in.
+            Appending is not supported if the samples of this or of the previous run are reduced (thinned,
+            shortened, limited to some parameters or stored as quantiles), see the sample reduction settings.
         tmp_results_dir (str, True or None): The temporary dir for the calculations. Set to a string to use
                 that path directly, set to True to use the config value, set to None to disable.
         save_user_script_info (boolean, str or SaveUserScriptInfo): The info we need to save about the script the
@@ -135,6 +172,13 @@ def sample_model(model, problem_data, output_folder, sampler=None, recalculate=F
         initialization_data (:class:`~mdt.utils.InitializationData`): provides (extra) initialization data to use
             during model fitting. If we are optimizing a cascade model this data only applies to the last model in the
             cascade.
+        nmr_chains (int): the number of independent chains to sample per voxel. All chains are sampled in the same
+            run, the additional chains start from a perturbation of the starting point (for example the optimization
+            results given in the initialization data). With multiple chains the samples of the first chain are
+            stored (and returned) as with a single chain, the samples of every other chain are stored in the same
+            format in a ``chain_<index>`` subdirectory of the samples directory, which can be loaded with
+            :func:`load_samples`. R-hat and split R-hat maps are added to the volume maps.
+            Multiple chains can not be combined with append_samples.
 
     Returns:
         dict: if store_samples is True then we return the samples per parameter as a numpy memmap. If store_samples
@@ -142,12 +186,17 @@ def sample_model(model, problem_data, output_folder, sampler=None, recalculate=F
     """
     import mdt.utils
     from mot.load_balance_strategies import EvenDistribution
-    from mdt.model_sampling import sample_composite_model
+    from mdt.components_loader import get_model
+    from mdt.configuration import get_processing_strategy, get_sampler, get_sample_reduction_settings
+    from mdt.model_sampling import sample_composite_model, SamplingChainState, combine_sampling_information
+    from mdt.sample_storage import SampleReduction
+    from mdt.utils import get_cl_devices, get_temporary_results_dir, per_model_logging_context
     from mdt.models.cascade import DMRICascadeModelInterface
+    from mot.cl_routines.sampling.metropolis_hastings import MetropolisHastings
     import mot.configuration
 
     if not mdt.utils.check_user_components():
-        init_user_settings(pass_if_exists=True)
+        mdt.utils.init_user_settings(pass_if_exists=True)
 
     if isinstance(model, string_types):
         model = get_model(model)
@@ -166,6 +215,16 @@ def sample_model(model, problem_data, output_folder, sampler=None, recalculate=F
     if recalculate and append_samples:
         raise ValueError('Invalid switches: both recalculate and append_samples are set to True.')
 
+    if nmr_chains > 1 and append_samples:
+        raise ValueError('Invalid switches: append_samples is not supported with multiple chains.')
+
+    if append_samples:
+        samples_dir = os.path.join(output_folder, model.name, 'samples')
+        if not (SampleReduction(**get_sample_reduction_settings(model.name)).is_identity
+                and SampleReduction.load(samples_dir).is_identity):
+            raise ValueError('Invalid switches: append_samples is not supported if the stored samples are reduced, '
+                             'see the sample reduction settings.')
+
     if cl_device_ind is not None and not isinstance(cl_device_ind, collections.Iterable):
         cl_device_ind = [cl_device_ind]
 
@@ -178,7 +237,7 @@ def sample_model(model, problem_data, output_folder, sampler=None, recalculate=F
 
     with mot.configuration.config_context(cl_context_action):
         if sampler is None:
-            sampler = configuration.get_sampler()
+            sampler = get_sampler()
 
         processing_strategy = get_processing_strategy('sampling', model_names=model.name,
                                                       tmp_dir=get_temporary_results_dir(tmp_results_dir))
@@ -201,17 +260,25 @@ def sample_model(model, problem_data, output_folder, sampler=None, recalculate=F
             logger.info('Using MDT version {}'.format(__version__))
             logger.info('Preparing for model {0}'.format(model.name))
 
+            chain_state = None
             if append_samples:
                 logger.info('Append samples is set to True, we will append this run to the '
                             'previously calculated samples.')
 
+                if isinstance(sampler, MetropolisHastings) and SamplingChainState.exists(base_dir):
+                    logger.info('Continuing the chains from the stored sampling state.')
+                    chain_state = SamplingChainState(model, base_dir, problem_data.mask)
+                else:
+                    logger.warning('No stored sampling state found, the appended samples start new chains.')
+
             model.double_precision = double_precision
 
             results = sample_composite_model(model, problem_data, output_folder, sampler,
                                              processing_strategy, recalculate=recalculate,
                                              store_samples=store_samples,
                                              store_volume_maps=not append_samples,
-                                             initialization_data=initialization_data)
+                                             initialization_data=initialization_data,
+                                             chain_state=chain_state, nmr_chains=nmr_chains)
 
             if append_samples:
                 combine_sampling_information(base_dir, output_folder, model)
@@ -224,7 +291,7 @@ def sample_model(model, problem_data, output_folder, sampler=None, recalculate=F
 
 def batch_fit(data_folder, batch_profile=None, subjects_selection=None, recalculate=False,
               models_to_fit=None, cascade_subdir=False, cl_device_ind=None, dry_run=False,
-              double_precision=False, tmp_results_dir=True):
+              double_precision=False, tmp_results_dir=True, nmr_processes=None):
     """Run all the available and applicable models on the data in the given folder.
 
     Args:
@@ -248,6 +315,8 @@ def batch_fit(data_folder, batch_profile=None, subjects_selection=None, recalcul
         double_precision (boolean): if we would like to do the calculations in double precision
         tmp_results_dir (str, True or None): The temporary dir for the calculations. Set to a string to use
                 that path directly, set to True to use the config value, set to None to disable.
+        nmr_processes (int): the number of subjects to process in parallel. If None or 1 the subjects are processed
+            one after another. If larger than one, every worker process gets its own subset of the CL devices.
 
     Returns:
         The list of subjects we will calculate / have calculated.
@@ -256,12 +325,12 @@ def batch_fit(data_folder, batch_profile=None, subjects_selection=None, recalcul
     from mdt.model_fitting import BatchFitting
 
     if not mdt.utils.check_user_components():
-        init_user_settings(pass_if_exists=True)
+        mdt.utils.init_user_settings(pass_if_exists=True)
 
     batch_fitting = BatchFitting(data_folder, batch_profile=batch_profile, subjects_selection=subjects_selection,
                                  recalculate=recalculate, models_to_fit=models_to_fit, cascade_subdir=cascade_subdir,
                                  cl_device_ind=cl_device_ind, double_precision=double_precision,
-                                 tmp_results_dir=tmp_results_dir)
+                                 tmp_results_dir=tmp_results_dir, nmr_processes=nmr_processes)
 
     if dry_run:
         return batch_fitting.get_subjects_info()
@@ -455,6 +524,7 @@ def view_result_samples(data, **kwargs):
         data (string or dict): The location of the maps to use the samples from, or the samples themselves.
         kwargs (dict): see SampleVisualizer for all the supported keywords
     """
+    from mdt.utils import load_samples
     from mdt.visualization.samples import SampleVisualizer
 
     if isinstance(data, string_types):
@@ -548,6 +618,9 @@ def sort_maps(input_maps, reversed_sort=False, sort_index_matrix=None):
     Returns:
         list: the list of sorted volumes
     """
+    import numpy as np
+    from mdt.utils import create_sort_matrix, load_nifti, sort_volumes_per_voxel
+
     if sort_index_matrix is None:
         sort_index_matrix = create_sort_matrix(input_maps, reversed_sort=reversed_sort)
     elif isinstance(sort_index_matrix, string_types):
@@ -659,6 +732,7 @@ def get_batch_profile(batch_profile_name):
     Returns:
         class: a reference to a :class:`mdt.batch_utils.BatchProfile`.
     """
+    from mdt.components_loader import get_component_class
     return get_component_class('batch_profiles', batch_profile_name)
 
 
@@ -680,12 +754,16 @@ def reset_logging():
 
     This is commonly called after updating the logging configuration to let the changes take affect.
     """
+    import logging.config as logging_config
+    from mdt.configuration import get_logging_configuration_dict
     logging_config.dictConfig(get_logging_configuration_dict())
 
 
 @contextmanager
 def disable_logging_context():
     """A context in which the logging is temporarily disabled"""
+    from mdt.configuration import config_context
+
     config = '''
     logging:
         info_dict:
@@ -701,3 +779,8 @@ def disable_logging_context():
         reset_logging()
         yield
     reset_logging()
+
+
+if sys.version_info < (3, 7):
+    for _name in list(_lazy_imports):
+        __getattr__(_name)
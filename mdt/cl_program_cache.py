@@ -0,0 +1,237 @@
+"""On-disk cache of compiled OpenCL programs.
+
+Building the kernels of the more complex models can take several seconds, which would otherwise be spent again for
+every worker, that is, for every chunk and every model. This module keeps the compiled program binaries in memory and
+on disk (by default in the MDT configuration directory) such that a kernel is compiled only once per device.
+
+Programs are cached by a hash of the kernel source, the compile flags and the device (name, driver and platform). A
+program is rebuilt from the source if its binary can not be loaded, for example after a driver update that did not
+change the driver version string.
+
+The workers of MDT use the cache via :class:`ProgramCacheWorker`. The workers of MOT, which compile the kernels of the
+composite models, only use the cache within a :func:`program_cache_context`.
+"""
+import hashlib
+import logging
+import os
+import threading
+import warnings
+from contextlib import contextmanager
+
+import pyopencl as cl
+from mot.load_balance_strategies import Worker
+
+__author__ = 'Robbert Harms'
+__date__ = "2017-04-24"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class ProgramCache(object):
+
+    _instances = {}
+
+    def __init__(self, cache_dir=None):
+        """Cache of compiled OpenCL program binaries.
+
+        The binaries are kept in memory and, if a cache directory is given, on disk. Use :meth:`get_instance` to get
+        the cache as configured in the MDT configuration.
+
+        Args:
+            cache_dir (str): the directory in which we store the program binaries, if None we only cache in memory
+        """
+        self._cache_dir = cache_dir
+        self._binaries = {}
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger(__name__)
+
+    @classmethod
+    def get_instance(cls):
+        """Get the program cache for the current configuration.
+
+        Returns:
+            ProgramCache: the cache, or None if the program cache is disabled
+        """
+        from mdt.configuration import get_cl_program_cache_settings
+        settings = get_cl_program_cache_settings()
+
+        if not settings['enabled']:
+            return None
+
+        if settings['directory'] not in cls._instances:
+            cls._instances[settings['directory']] = cls(settings['directory'])
+        return cls._instances[settings['directory']]
+
+    @property
+    def cache_dir(self):
+        return self._cache_dir
+
+    def build(self, context, kernel_source, compile_flags=()):
+        """Get the built program for the given kernel source.
+
+        If every device of the given context has a cached binary for this source and these compile flags, we build
+        the program from these binaries. Else, we compile the program from the source and store the binaries.
+
+        Args:
+            context (pyopencl.Context): the context for which we want to build the program
+            kernel_source (str): the kernel source
+            compile_flags (list of str): the compile flags
+
+        Returns:
+            pyopencl.Program: the built program
+        """
+        options = ' '.join(compile_flags)
+        devices = context.devices
+        keys = [get_cache_key(device, kernel_source, options) for device in devices]
+
+        binaries = [self._get_binary(key) for key in keys]
+        if all(binary is not None for binary in binaries):
+            try:
+                return cl.Program(context, devices, binaries).build(options)
+            except cl.Error:
+                self._logger.debug('Could not load the cached program binaries, recompiling from source.')
+
+        program = cl.Program(context, kernel_source).build(options)
+        for key, binary in zip(keys, program.get_info(cl.program_info.BINARIES)):
+            self._set_binary(key, bytes(binary))
+        return program
+
+    def clear(self):
+        """Remove all the cached programs, from memory and from disk."""
+        with self._lock:
+            self._binaries = {}
+
+            if self._cache_dir is not None and os.path.isdir(self._cache_dir):
+                for fname in os.listdir(self._cache_dir):
+                    if fname.endswith('.bin'):
+                        os.remove(os.path.join(self._cache_dir, fname))
+
+    def _get_binary(self, key):
+        with self._lock:
+            if key in self._binaries:
+                return self._binaries[key]
+
+        if self._cache_dir is None:
+            return None
+
+        try:
+            with open(os.path.join(self._cache_dir, key + '.bin'), 'rb') as f:
+                binary = f.read()
+        except IOError:
+            return None
+
+        with self._lock:
+            self._binaries[key] = binary
+        return binary
+
+    def _set_binary(self, key, binary):
+        """Store the given binary, if the binary can not be written to disk we only keep it in memory."""
+        with self._lock:
+            self._binaries[key] = binary
+
+        if self._cache_dir is None or not binary:
+            return
+
+        path = os.path.join(self._cache_dir, key + '.bin')
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+        try:
+            if not os.path.isdir(self._cache_dir):
+                os.makedirs(self._cache_dir)
+
+            with open(tmp_path, 'wb') as f:
+                f.write(binary)
+
+            if hasattr(os, 'replace'):
+                os.replace(tmp_path, path)
+            else:
+                if os.name == 'nt' and os.path.exists(path):
+                    os.remove(path)
+                os.rename(tmp_path, path)
+        except (IOError, OSError):
+            self._logger.debug('Could not write the program binary to the cache directory.')
+
+
+class ProgramCacheWorker(Worker):
+    """A worker that builds its kernel using the program cache, if enabled."""
+
+    def _build_kernel(self, compile_flags=()):
+        return _build_worker_kernel(self, compile_flags)
+
+
+def build_program(context, kernel_source, compile_flags=()):
+    """Build the given kernel source, using the program cache if enabled.
+
+    Args:
+        context (pyopencl.Context): the context for which we want to build the program
+        kernel_source (str): the kernel source
+        compile_flags (list of str): the compile flags
+
+    Returns:
+        pyopencl.Program: the built program
+    """
+    from mot import configuration
+    if configuration.should_ignore_kernel_compile_warnings():
+        warnings.simplefilter("ignore")
+
+    cache = ProgramCache.get_instance()
+    if cache is None:
+        return cl.Program(context, kernel_source).build(' '.join(compile_flags))
+    return cache.build(context, kernel_source, compile_flags)
+
+
+def _build_worker_kernel(worker, compile_flags=()):
+    """Build the kernel of the given worker using the program cache, replaces :meth:`Worker._build_kernel`."""
+    return build_program(worker._cl_run_context.context, worker._get_kernel_source(), compile_flags)
+
+
+def get_cache_key(device, kernel_source, options):
+    """Get the key under which we store the binary of the given program for the given device.
+
+    Args:
+        device (pyopencl.Device): the device we compile for
+        kernel_source (str): the kernel source
+        options (str): the compile options
+
+    Returns:
+        str: the hexadecimal hash of the source, the options and the device
+    """
+    key = hashlib.sha1()
+    for item in (kernel_source, options, device.name, device.version, device.driver_version,
+                 device.platform.name, device.platform.version, cl.VERSION_TEXT):
+        key.update(item.encode('utf-8'))
+        key.update(b'\0')
+    return key.hexdigest()
+
+
+_mot_workers_lock = threading.Lock()
+_mot_workers_depth = [0]
+_mot_build_kernel = [None]
+
+
+@contextmanager
+def program_cache_context():
+    """A context in which the workers of MOT also build their kernels using the program cache.
+
+    This covers the kernels of the optimization routines and the mapping routines (for example the model estimates
+    and the error measures) and with that most kernels compiled for the composite models. The contexts can be nested.
+
+    MOT constructs these workers itself and offers no hook to change how they build their kernel, so this replaces
+    :meth:`mot.load_balance_strategies.Worker._build_kernel` on the class for as long as the outermost context is
+    active. This is a process-wide side effect: during this time every MOT worker in this process, also those used by
+    other threads, builds its kernel using the program cache. The method in place before entering is restored when
+    the outermost context exits, also on errors. Workers defined in MDT should instead derive from
+    :class:`ProgramCacheWorker`, which uses the program cache without changing MOT.
+    """
+    with _mot_workers_lock:
+        if _mot_workers_depth[0] == 0:
+            _mot_build_kernel[0] = Worker.__dict__['_build_kernel']
+            Worker._build_kernel = _build_worker_kernel
+        _mot_workers_depth[0] += 1
+    try:
+        yield
+    finally:
+        with _mot_workers_lock:
+            _mot_workers_depth[0] -= 1
+            if _mot_workers_depth[0] == 0:
+                Worker._build_kernel = _mot_build_kernel[0]
+                _mot_build_kernel[0] = None
@@ -2,8 +2,9 @@ import pyopencl as cl
 import numpy as np
 from mot.utils import get_float_type_def
 from mot.cl_routines.base import CLRoutine
-from mot.load_balance_strategies import Worker
+from mdt.cl_program_cache import ProgramCacheWorker
 from mdt.components_loader import LibraryFunctionsLoader
+from mdt.configuration import get_numpy_fast_path_settings
 
 
 __author__ = 'Robbert Harms'
@@ -46,6 +47,11 @@ class CalculateEigenvectors(CLRoutine):
         psi_roi = np.require(psi_roi, np_dtype, requirements=['C', 'A', 'O'])
 
         rows = theta_roi.shape[0]
+
+        settings = get_numpy_fast_path_settings()
+        if rows <= settings['max_voxels']:
+            return _convert_theta_phi_psi(theta_roi, phi_roi, psi_roi, settings['voxels_per_block'])
+
         evecs = np.zeros((rows, 3, 3), dtype=np_dtype, order='C')
 
         workers = self._create_workers(lambda cl_environment: _CEWorker(cl_environment,
@@ -56,7 +62,7 @@ class CalculateEigenvectors(CLRoutine):
         return evecs
 
 
-class _CEWorker(Worker):
+class _CEWorker(ProgramCacheWorker):
 
     def __init__(self, cl_environment, compile_flags, theta_roi, phi_roi, psi_roi, evecs, double_precision):
         super(_CEWorker, self).__init__(cl_environment)
@@ -129,3 +135,63 @@ class _CEWorker(Worker):
             }
         '''
         return kernel_source
+
+
+def _convert_theta_phi_psi(theta_roi, phi_roi, psi_roi, voxels_per_block):
+    """Calculate the eigenvectors using NumPy, as in the library function TensorSphericalToCartesian.
+
+    The computations are done in the data type of the given angles.
+
+    Args:
+        theta_roi (ndarray): The list of theta's per voxel in the ROI
+        phi_roi (ndarray): The list of phi's per voxel in the ROI
+        psi_roi (ndarray): The list of psi's per voxel in the ROI
+        voxels_per_block (int): the number of voxels we process at once, this bounds the size of the temporary arrays
+
+    Returns:
+        ndarray: the (n, 3, 3) matrix with per voxel the three eigenvectors
+    """
+    np_dtype = theta_roi.dtype
+
+    # the kernel adds the single precision constant M_PI_2_F, also in double precision
+    half_pi = np_dtype.type(np.float32(np.pi / 2))
+
+    evecs = np.zeros((theta_roi.shape[0], 3, 3), dtype=np_dtype, order='C')
+
+    for start in range(0, theta_roi.shape[0], voxels_per_block):
+        theta = theta_roi[start:start + voxels_per_block]
+        phi = phi_roi[start:start + voxels_per_block]
+        psi = psi_roi[start:start + voxels_per_block]
+
+        cos_phi, sin_phi = np.cos(phi), np.sin(phi)
+        sin_theta = np.sin(theta)
+        cos_psi, sin_psi = np.cos(psi), np.sin(psi)
+
+        vec0 = np.stack([cos_phi * sin_theta, sin_phi * sin_theta, np.cos(theta)], axis=1)
+
+        # rotate vec0 by 90 degrees, changing, x, y and z
+        rotation_factor = np.sin(theta + half_pi)
+        vec1 = np.stack([rotation_factor * cos_phi, rotation_factor * sin_phi, np.cos(theta + half_pi)], axis=1)
+
+        # uses Rodrigues' formula to rotate vec1 by psi around vec0, with the same sign correction as the kernel
+        vec1 = (vec1 * cos_psi[:, None]
+                + np.cross(vec1, _get_rotation_sign(vec0)[:, None] * vec0) * sin_psi[:, None]
+                + vec0 * (np.sum(vec0 * vec1, axis=1) * (1 - cos_psi))[:, None])
+
+        evecs[start:start + voxels_per_block, 0] = vec0
+        evecs[start:start + voxels_per_block, 1] = vec1
+        evecs[start:start + voxels_per_block, 2] = np.cross(vec0, vec1)
+
+    return evecs
+
+
+def _get_rotation_sign(vec0):
+    """Get the sign correction of the rotation around vec0 in the kernel, -1 if z < 0 or if z == 0 and x < 0, else 1.
+
+    Args:
+        vec0 (ndarray): the (n, 3) matrix with the first vector per voxel
+
+    Returns:
+        ndarray: the sign per voxel, in the data type of the given vectors
+    """
+    return np.where((vec0[:, 2] < 0) | ((vec0[:, 2] == 0) & (vec0[:, 0] < 0)), -1, 1).astype(vec0.dtype)
@@ -2,7 +2,8 @@ import numpy as np
 import pyopencl as cl
 from mot.utils import get_float_type_def
 from mot.cl_routines.base import CLRoutine
-from mot.load_balance_strategies import Worker
+from mdt.cl_program_cache import ProgramCacheWorker
+from mdt.configuration import get_numpy_fast_path_settings
 
 
 __author__ = 'Robbert Harms'
@@ -59,6 +60,10 @@ class DTIMeasures(CLRoutine):
 
         eigenvalues = np.require(eigenvalues, np_dtype, requirements=['C', 'A', 'O'])
 
+        settings = get_numpy_fast_path_settings()
+        if eigenvalues.shape[0] <= settings['max_voxels']:
+            return _calculate_fa_md(eigenvalues, settings['voxels_per_block'])
+
         s = eigenvalues.shape
         fa_host = np.zeros((s[0], 1), dtype=np_dtype)
         md_host = np.zeros((s[0], 1), dtype=np_dtype)
@@ -72,7 +77,7 @@ class DTIMeasures(CLRoutine):
         return fa_host, md_host
 
 
-class _DTIMeasuresWorker(Worker):
+class _DTIMeasuresWorker(ProgramCacheWorker):
 
     def __init__(self, cl_environment, compile_flags, eigenvalues, fa_host, md_host, double_precision):
         super(_DTIMeasuresWorker, self).__init__(cl_environment)
@@ -127,3 +132,29 @@ class _DTIMeasuresWorker(Worker):
             }
         '''
         return kernel_source
+
+
+def _calculate_fa_md(eigenvalues, voxels_per_block):
+    """Calculate the FA and MD using NumPy, this computes the same as the kernel of :class:`_DTIMeasuresWorker`.
+
+    Args:
+        eigenvalues (ndarray): the (n, 3) matrix with the eigenvalues per voxel, in double precision
+        voxels_per_block (int): the number of voxels we process at once, this bounds the size of the temporary arrays
+
+    Returns:
+        tuple: the (n, 1) matrices with the FA and MD
+    """
+    fa_host = np.zeros((eigenvalues.shape[0], 1), dtype=eigenvalues.dtype)
+    md_host = np.zeros((eigenvalues.shape[0], 1), dtype=eigenvalues.dtype)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for start in range(0, eigenvalues.shape[0], voxels_per_block):
+            v1, v2, v3 = eigenvalues[start:start + voxels_per_block].T
+
+            fa_host[start:start + voxels_per_block, 0] = np.sqrt(0.5 * (((v1 - v2) * (v1 - v2)) +
+                                                                        ((v1 - v3) * (v1 - v3)) +
+                                                                        ((v2 - v3) * (v2 - v3))) /
+                                                                 (v1 * v1 + v2 * v2 + v3 * v3))
+            md_host[start:start + voxels_per_block, 0] = (v1 + v2 + v3) / 3.0
+
+    return fa_host, md_host
@@ -15,7 +15,6 @@ import argparse
 import os
 import mdt
 from argcomplete.completers import FilesCompleter
-from mdt.batch_utils import batch_profile_factory, SelectedSubjects
 from mdt.components_loader import BatchProfilesLoader
 
 from mdt.shell_utils import BasicShellApplication
@@ -42,6 +41,7 @@ class BatchFit(BasicShellApplication):
             mdt-batch-fit .
             mdt-batch-fit /data/mgh --batch-profile 'HCP_MGH'
             mdt-batch-fit . --subjects-index 0 1 2 --subjects-id 1003 1004
+            mdt-batch-fit . --cl-device-ind 0 1 --nmr-processes 2
             mdt-batch-fit . --dry-run --models-to-fit 'BallStick_r1 (Cascade)' 'Tensor (Cascade)'
         ''')
         epilog = self._format_examples(doc_parser, examples)
@@ -104,9 +104,16 @@ class BatchFit(BasicShellApplication):
                             help='The directory for the temporary results. The default ("True") uses the config file '
                                  'setting. Set to the literal "None" to disable.').completer = FilesCompleter()
 
+        parser.add_argument('--nmr-processes', dest='nmr_processes', type=int, default=None,
+                            help="The number of subjects to process in parallel, each in its own process. The "
+                                 "selected CL devices are divided over the processes. Default is one subject at "
+                                 "a time.")
+
         return parser
 
     def run(self, args, extra_args):
+        from mdt.batch_utils import batch_profile_factory, SelectedSubjects
+
         batch_profile = batch_profile_factory(args.batch_profile, os.path.realpath(args.data_folder))
 
         if args.use_gradient_deviations is not None:
@@ -136,7 +143,8 @@ class BatchFit(BasicShellApplication):
                       double_precision=args.double_precision,
                       dry_run=args.dry_run,
                       cascade_subdir=args.cascade_subdir,
-                      tmp_results_dir=tmp_results_dir)
+                      tmp_results_dir=tmp_results_dir,
+                      nmr_processes=args.nmr_processes)
 
 
 def get_doc_arg_parser():
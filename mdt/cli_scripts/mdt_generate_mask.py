@@ -7,10 +7,8 @@ import os
 import mdt
 from argcomplete.completers import FilesCompleter
 
-import mot.configuration
 from mdt.shell_utils import BasicShellApplication
 from mot import cl_environments
-from mot.load_balance_strategies import EvenDistribution
 import textwrap
 
 __author__ = 'Robbert Harms'
@@ -76,6 +74,9 @@ class GenerateMask(BasicShellApplication):
         return parser
 
     def run(self, args, extra_args):
+        import mot.configuration
+        from mot.load_balance_strategies import EvenDistribution
+
         dwi_name = os.path.splitext(os.path.realpath(args.dwi))[0]
         dwi_name = dwi_name.replace('.nii', '')
 
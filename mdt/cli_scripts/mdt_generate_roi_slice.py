@@ -6,8 +6,6 @@ import os
 import mdt
 from argcomplete.completers import FilesCompleter
 import textwrap
-from mdt.nifti import load_nifti
-import mdt.utils
 from mdt.shell_utils import BasicShellApplication
 
 __author__ = 'Robbert Harms'
@@ -47,6 +45,9 @@ class GenerateRoiSlice(BasicShellApplication):
         return parser
 
     def run(self, args, extra_args):
+        import mdt.utils
+        from mdt.nifti import load_nifti
+
         shape = load_nifti(args.mask).shape
         roi_dimension = args.dimension if args.dimension is not None else 2
         if roi_dimension > len(shape)-1 or roi_dimension < 0:
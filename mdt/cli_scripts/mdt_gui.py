@@ -8,7 +8,6 @@ import textwrap
 from argcomplete.completers import FilesCompleter
 
 from mdt import init_user_settings
-from mdt.gui.model_fit.qt_main import start_gui
 from mdt.shell_utils import BasicShellApplication
 
 __author__ = 'Robbert Harms'
@@ -32,6 +31,8 @@ class GUI(BasicShellApplication):
         return parser
 
     def run(self, args, extra_args):
+        from mdt.gui.model_fit.qt_main import start_gui
+
         if args.dir:
             cwd = os.path.realpath(args.dir)
         else:
@@ -3,7 +3,6 @@
 """Print some basic information about an image file."""
 import argparse
 import os
-from mdt.nifti import load_nifti
 import textwrap
 
 from mdt.shell_utils import BasicShellApplication
@@ -34,6 +33,8 @@ class InfoImg(BasicShellApplication):
         return parser
 
     def run(self, args, extra_args):
+        from mdt.nifti import load_nifti
+
         for image in args.images:
             image_path = os.path.realpath(image)
             if os.path.isfile(image_path):
@@ -5,7 +5,6 @@ import argparse
 import textwrap
 import mdt
 from mdt.shell_utils import BasicShellApplication
-from mot import cl_environments
 
 __author__ = 'Robbert Harms'
 __date__ = "2015-08-18"
@@ -23,6 +22,8 @@ class ListDevices(BasicShellApplication):
         return parser
 
     def run(self, args, extra_args):
+        from mot import cl_environments
+
         mdt.init_user_settings(pass_if_exists=True)
 
         for ind, env in enumerate(cl_environments.CLEnvironmentFactory.smart_device_selection()):
@@ -45,7 +45,6 @@ from argcomplete.completers import FilesCompleter
 import textwrap
 
 from mdt.shell_utils import BasicShellApplication
-from mdt.utils import split_image_path
 
 __author__ = 'Robbert Harms'
 __date__ = "2015-08-18"
@@ -97,6 +96,8 @@ class MathImg(BasicShellApplication):
         return parser
 
     def run(self, args, extra_args):
+        from mdt.utils import split_image_path
+
         write_output = args.output_file is not None
 
         if write_output:
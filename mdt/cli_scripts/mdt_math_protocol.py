@@ -20,9 +20,7 @@ import mdt
 from argcomplete.completers import FilesCompleter
 import textwrap
 
-from mdt.protocols import Protocol
 from mdt.shell_utils import BasicShellApplication
-from mot.utils import is_scalar
 
 __author__ = 'Robbert Harms'
 __date__ = "2015-08-18"
@@ -62,6 +60,9 @@ class MathProtocol(BasicShellApplication):
         return parser
 
     def run(self, args, extra_args):
+        from mdt.protocols import Protocol
+        from mot.utils import is_scalar
+
         if args.output_file is not None:
             output_file = os.path.realpath(args.output_file)
         else:
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# PYTHON_ARGCOMPLETE_OK
+"""Compile the OpenCL kernels of the given models in advance.
+
+This fits every given model to a small synthetic dataset with the given protocol, which stores the compiled kernels
+in the OpenCL program cache. Subsequent model fits with the same protocol, precision and device can then skip the
+compilation of these kernels.
+
+Since the kernels depend on the protocol, please use the protocol of the data you are going to process.
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import mdt
+from argcomplete.completers import FilesCompleter
+from mdt.shell_utils import BasicShellApplication
+from mot import cl_environments
+import textwrap
+
+__author__ = 'Robbert Harms'
+__date__ = "2017-04-24"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class Precompile(BasicShellApplication):
+
+    def __init__(self):
+        super(Precompile, self).__init__()
+        self.available_devices = list((ind for ind, env in
+                                       enumerate(cl_environments.CLEnvironmentFactory.smart_device_selection())))
+
+    def _get_arg_parser(self, doc_parser=False):
+        description = textwrap.dedent(__doc__)
+
+        examples = textwrap.dedent('''
+            mdt-precompile data.prtcl "BallStick_r1 (Cascade)" "NODDI (Cascade)"
+            mdt-precompile data.prtcl "CHARMED_r1 (Cascade)" --cl-device-ind 1
+            mdt-precompile --clear
+           ''')
+        epilog = self._format_examples(doc_parser, examples)
+
+        parser = argparse.ArgumentParser(description=description, epilog=epilog,
+                                         formatter_class=argparse.RawTextHelpFormatter)
+        parser.add_argument(
+            'protocol', nargs='?', action=mdt.shell_utils.get_argparse_extension_checker(['.prtcl']),
+            help='the protocol file, see mdt-generate-protocol').completer = FilesCompleter(['prtcl'],
+                                                                                            directories=False)
+        parser.add_argument('models', metavar='models', nargs='*',
+                            help='the names of the models to compile, see mdt-list-models')
+
+        parser.add_argument('--cl-device-ind', type=int, nargs='*', choices=self.available_devices,
+                            help="The index of the device we would like to use. This follows the indices "
+                                 "in mdt-list-devices and defaults to the first GPU.")
+
+        parser.add_argument('--double', dest='double_precision', action='store_true',
+                            help="Compile for double precision.")
+        parser.add_argument('--float', dest='double_precision', action='store_false',
+                            help="Compile for single precision. (default)")
+        parser.set_defaults(double_precision=False)
+
+        parser.add_argument('--clear', action='store_true',
+                            help="Remove all the compiled programs from the cache before compiling.")
+
+        return parser
+
+    def run(self, args, extra_args):
+        import numpy as np
+        import nibabel as nib
+        from mdt.cl_program_cache import ProgramCache
+
+        cache = ProgramCache.get_instance()
+        if cache is None:
+            print('The OpenCL program cache is disabled in the configuration.')
+            return
+
+        if args.clear:
+            cache.clear()
+            print('Cleared the program cache in {}'.format(cache.cache_dir))
+
+        if not args.models:
+            return
+
+        if args.protocol is None:
+            raise ValueError('Please provide a protocol to compile the models for.')
+
+        protocol = mdt.load_protocol(os.path.realpath(args.protocol))
+        problem_data = mdt.load_problem_data((np.ones((2, 1, 1, protocol.length)), nib.Nifti1Header()),
+                                             protocol, np.ones((2, 1, 1), dtype=np.bool_), noise_std=1)
+
+        output_folder = tempfile.mkdtemp()
+        try:
+            for model in args.models:
+                print('Compiling the kernels of model {}'.format(model))
+                mdt.fit_model(model, problem_data, output_folder, recalculate=True,
+                              cl_device_ind=args.cl_device_ind, double_precision=args.double_precision,
+                              tmp_results_dir=None, save_user_script_info=None)
+        finally:
+            shutil.rmtree(output_folder, ignore_errors=True)
+
+        print('Stored the compiled programs in {}'.format(cache.cache_dir))
+
+
+def get_doc_arg_parser():
+    return Precompile().get_documentation_arg_parser()
+
+
+if __name__ == '__main__':
+    Precompile().start()
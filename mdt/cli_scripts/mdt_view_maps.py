@@ -7,7 +7,6 @@ import textwrap
 from argcomplete.completers import FilesCompleter
 from mdt.utils import init_user_settings
 from mdt import view_maps, write_view_maps_figure
-from mdt.visualization.maps.base import DataInfo
 from mdt.shell_utils import BasicShellApplication
 
 __author__ = 'Robbert Harms'
@@ -47,6 +46,8 @@ class GUI(BasicShellApplication):
         return parser
 
     def run(self, args, extra_args):
+        from mdt.visualization.maps.base import DataInfo
+
         if args.dir:
             data = DataInfo.from_dir(os.path.realpath(args.dir))
         else:
@@ -12,7 +12,6 @@ import os
 from argcomplete.completers import FilesCompleter
 import textwrap
 
-from mdt.utils import volume_merge
 from mdt.shell_utils import BasicShellApplication, get_argparse_extension_checker
 
 __author__ = 'Robbert Harms'
@@ -54,6 +53,8 @@ class VolumeMerge(BasicShellApplication):
         return parser
 
     def run(self, args, extra_args):
+        from mdt.utils import volume_merge
+
         output_file = os.path.realpath(args.output_file)
 
         if os.path.isfile(output_file):
@@ -6,7 +6,9 @@ of sources from which they load the available components.
 import collections
 import imp #todo in P3.4 replace imp calls with importlib.SourceFileLoader(name, path).load_module(name)
 import inspect
+import json
 import os
+import threading
 from contextlib import contextmanager
 from six import with_metaclass
 
@@ -560,12 +562,10 @@ class UserComponentsSourceSingle(ComponentsSource):
 
     def list(self):
         items = []
-        if os.path.isdir(self.path):
-            for dir_name, sub_dirs, files in os.walk(self.path):
-                for file in files:
-                    if file.endswith('.py') and not file.startswith('__'):
-                        items.append(file[0:-3])
-                        self._class_filenames[file[0:-3]] = os.path.join(dir_name, file)
+        for path in _list_component_files(self.path):
+            name = os.path.splitext(os.path.basename(path))[0]
+            items.append(name)
+            self._class_filenames[name] = path
         return items
 
     def get_class(self, name):
@@ -645,6 +645,103 @@ class ComponentInfo(object):
         return NotImplemented
 
 
+class ComponentsIndex(object):
+
+    _instances = {}
+
+    def __init__(self, path):
+        """A persistent index of the components defined in the component files.
+
+        For every indexed file this stores the names and meta information of the components defined in that file,
+        together with the modification time and the size of the file. An entry is only used as long as the
+        modification time and size of the file match, else the file needs to be loaded and indexed again.
+
+        Use :meth:`get_instance` to get the index for the current components directory.
+
+        Args:
+            path (str): the path to the index file
+        """
+        self._path = path
+        self._lock = threading.Lock()
+        self._modified = False
+        self._files = self._load()
+
+    @classmethod
+    def get_instance(cls):
+        """Get the index of the components in the current configuration directory.
+
+        Returns:
+            ComponentsIndex: the index, shared by all the component sources
+        """
+        from mdt.configuration import get_config_dir
+        path = os.path.join(get_config_dir(), 'components', 'components_index.json')
+        if path not in cls._instances:
+            cls._instances[path] = cls(path)
+        return cls._instances[path]
+
+    def get_components(self, path):
+        """Get the indexed components of the given file.
+
+        Args:
+            path (str): the path to the python file
+
+        Returns:
+            list or None: the list with for every component a dictionary with the name and the meta information, or
+                None if the file is not indexed or changed since it was indexed
+        """
+        entry = self._files.get(path)
+        if entry is None or entry['stat'] != _get_file_stat(path):
+            return None
+        return entry['components']
+
+    def set_components(self, path, components):
+        """Set the components of the given file.
+
+        Args:
+            path (str): the path to the python file
+            components (list): for every component a dictionary with the name and the meta information
+        """
+        with self._lock:
+            self._files[path] = {'stat': _get_file_stat(path), 'components': components}
+            self._modified = True
+
+    def save(self):
+        """Write the index to disk if it was modified, removing the entries of files that no longer exist.
+
+        If the index can not be written, for example due to missing permissions, the index is only kept in memory.
+        """
+        with self._lock:
+            if not self._modified:
+                return
+
+            self._files = {path: entry for path, entry in self._files.items() if os.path.isfile(path)}
+            self._modified = False
+
+            try:
+                tmp_path = self._path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump({'version': 1, 'files': self._files}, f)
+
+                if hasattr(os, 'replace'):
+                    os.replace(tmp_path, self._path)
+                else:
+                    if os.name == 'nt' and os.path.exists(self._path):
+                        os.remove(self._path)
+                    os.rename(tmp_path, self._path)
+            except (IOError, OSError):
+                pass
+
+    def _load(self):
+        try:
+            with open(self._path, 'r') as f:
+                index = json.load(f)
+            if index.get('version') == 1:
+                return index['files']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        return {}
+
+
 class UserComponentsSourceMulti(ComponentsSource):
 
     loaded_modules_cache = {}
@@ -652,6 +749,11 @@ class UserComponentsSourceMulti(ComponentsSource):
     def __init__(self, user_type, component_type):
         """"Base class for components in which there are multiple components per file.
 
+        To list the components we need to know which components are defined in every file. Since that requires
+        loading the python files, the names and meta information of the components per file are stored in the
+        :class:`ComponentsIndex`. The files are then only loaded if they changed since they were indexed, or if we
+        need the class of one of its components.
+
         Args:
             user_type (str): either 'user' or 'standard'. This defines from which dir to use the components
             component_type (str): from which dir in 'user' or 'standard' to use the components
@@ -676,49 +778,75 @@ class UserComponentsSourceMulti(ComponentsSource):
 
         self.path = _get_components_path(user_type, component_type)
         self._check_path()
-        self._components = self._load_all_components()
+        self._index_entries = self._get_index_entries()
 
     def list(self):
-        return self._components.keys()
+        return self._index_entries.keys()
 
     def get_class(self, name):
-        if name not in self._components:
+        if name not in self._index_entries:
             raise ImportError
-        return self._components[name].get_component_class()
+        return self._get_component(name).get_component_class()
 
     def get_meta_info(self, name):
-        return self._components[name].get_meta_info()
+        meta_info = self._index_entries[name]['meta_info']
+        if meta_info is None:
+            return self._get_component(name).get_meta_info()
+        return meta_info
 
-    def _load_all_components(self):
-        self._update_modules_cache()
+    def _get_index_entries(self):
+        """Get the index entries of all the components in this source.
 
-        all_components = []
-        for module, components in self.loaded_modules_cache[self._user_type][self._component_type].values():
-            all_components.extend(components)
+        Returns:
+            dict: per component name the index entry, a dictionary with the path to the file defining the component
+                and the meta information of the component (None if it is not stored in the index)
+        """
+        index = ComponentsIndex.get_instance()
+
+        entries = {}
+        for path in _list_component_files(self.path):
+            components = index.get_components(path)
+            if components is None:
+                components = [{'name': component.get_name(), 'meta_info': _to_index_value(component.get_meta_info())}
+                              for component in self._load_module_components(path)]
+                index.set_components(path, components)
+
+            for component in components:
+                entries[component['name']] = {'path': path, 'meta_info': component['meta_info']}
+
+        index.save()
+        return entries
+
+    def _get_component(self, name):
+        """Get the component info of the component with the given name, this loads the file of the component."""
+        for component in self._load_module_components(self._index_entries[name]['path']):
+            if component.get_name() == name:
+                return component
+        raise ImportError
+
+    def _load_module_components(self, path):
+        """Load the python file with the given path and return the components it defines.
 
-        return {component.get_name(): component for component in all_components}
+        The loaded modules are cached, such that every file is loaded at most once.
 
-    def _update_modules_cache(self):
-        """Fill the modules cache with the components.
+        Args:
+            path (str): the path to the python file
 
-        This loops through all the python files present in the dir name and tries to use them as modules if they
-        are not yet loaded.
+        Returns:
+            list: list of ComponentInfo objects
         """
-        for dir_name, sub_dirs, files in os.walk(self.path):
-            for file in files:
-                if file.endswith('.py') and not file.startswith('__'):
-                    path = os.path.join(dir_name, file)
+        modules_cache = self.loaded_modules_cache[self._user_type][self._component_type]
 
-                    if path not in self.loaded_modules_cache[self._user_type][self._component_type]:
-                        module_name = self._user_type + '/' + \
-                                      self._component_type + '/' + \
-                                      dir_name[len(self.path) + 1:] + '/' + \
-                                      os.path.splitext(os.path.basename(path))[0]
+        if path not in modules_cache:
+            module_name = self._user_type + '/' + \
+                          self._component_type + '/' + \
+                          os.path.dirname(path)[len(self.path) + 1:] + '/' + \
+                          os.path.splitext(os.path.basename(path))[0]
 
-                        module = imp.load_source(module_name, path)
+            module = imp.load_source(module_name, path)
+            modules_cache[path] = (module, self._get_components_from_module(module))
 
-                        self.loaded_modules_cache[self._user_type][self._component_type][path] = \
-                            (module, self._get_components_from_module(module))
+        return modules_cache[path][1]
 
     def _get_components_from_module(self, module):
         """Return a list of all the available components in the given module.
@@ -763,10 +891,10 @@ class AutoUserComponentsSourceMulti(UserComponentsSourceMulti):
         super(AutoUserComponentsSourceMulti, self).__init__(user_type, component_type)
 
     def get_class(self, name):
-        if name not in self._components:
+        if name not in self._index_entries:
             raise ImportError
 
-        base = self._components[name].get_component_class()
+        base = self._get_component(name).get_component_class()
         if inspect.isclass(base) and issubclass(base, ComponentConfig):
             return self.component_builder.create_class(base)
 
@@ -1065,6 +1193,66 @@ def _get_class_predicate(module, class_type):
     return complete_predicate
 
 
+_component_files_cache = {}
+
+
+def _list_component_files(path):
+    """List the python files with components in the given directory and its subdirectories.
+
+    The listing is cached and only repeated if one of the directories changed, that is, if a file or directory was
+    added, removed or renamed.
+
+    Args:
+        path (str): the components directory
+
+    Returns:
+        list of str: the paths to the python files with components
+    """
+    cached = _component_files_cache.get(path)
+    if cached is not None and all(_get_mtime(dir_name) == mtime for dir_name, mtime in cached[0]):
+        return cached[1]
+
+    directories = [(path, _get_mtime(path))]
+    files = []
+    if os.path.isdir(path):
+        for dir_name, sub_dirs, file_names in os.walk(path):
+            if dir_name != path:
+                directories.append((dir_name, _get_mtime(dir_name)))
+            for file_name in file_names:
+                if file_name.endswith('.py') and not file_name.startswith('__'):
+                    files.append(os.path.join(dir_name, file_name))
+
+    _component_files_cache[path] = (directories, files)
+    return files
+
+
+def _get_mtime(path):
+    """Get the modification time of the given path, None if it does not exist."""
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def _get_file_stat(path):
+    """Get the modification time and size of the given file, used to check if an indexed file changed."""
+    try:
+        stat = os.stat(path)
+        return [stat.st_mtime, stat.st_size]
+    except OSError:
+        return None
+
+
+def _to_index_value(value):
+    """Get the given value if it can be stored in the (JSON) components index without change, else None."""
+    try:
+        if json.loads(json.dumps(value)) == value:
+            return value
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
 def _get_components_path(user_type, component_type):
     """
     Args:
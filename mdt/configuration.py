@@ -23,6 +23,7 @@ import re
 from copy import deepcopy
 
 import collections
+import logging.config as logging_config
 import yaml
 from contextlib import contextmanager
 from pkg_resources import resource_stream
@@ -211,6 +212,25 @@ class OutputFormatLoader(ConfigSectionLoader):
             if 'gzip' in options:
                 config_insert(['output_format', item, 'gzip'], bool(options['gzip']))
 
+            if 'compression_level' in options:
+                level = options['compression_level']
+                if level is not None:
+                    level = int(level)
+                    if not 1 <= level <= 9:
+                        raise ValueError('The compression level should be between 1 and 9, {} given.'.format(level))
+                config_insert(['output_format', item, 'compression_level'], level)
+
+        if 'samples_storage' in value.get('sampling', {}):
+            storage = value['sampling']['samples_storage']
+            if storage.get('format', 'npy') not in ('npy', 'compressed'):
+                raise ValueError('The samples storage format should be either "npy" or "compressed", '
+                                 '{} given.'.format(storage['format']))
+            for key, sub_value in storage.items():
+                config_insert(['output_format', 'sampling', 'samples_storage', key], sub_value)
+
+        if 'nmr_write_threads' in value:
+            config_insert(['output_format', 'nmr_write_threads'], value['nmr_write_threads'])
+
 
 class LoggingLoader(ConfigSectionLoader):
     """Loader for the top level key logging. """
@@ -250,6 +270,22 @@ class SampleSettingsLoader(ConfigSectionLoader):
         if 'general' in value:
             config_insert(['sampling', 'general'], value['general'])
 
+        for item in ['streaming', 'adaptive', 'post_processing', 'multiple_chains']:
+            if item in value:
+                for key, sub_value in value[item].items():
+                    config_insert(['sampling', item, key], sub_value)
+
+        ensure_exists(['sampling', 'sample_reduction', 'model_specific'])
+        if 'sample_reduction' in value:
+            for key, sub_value in value['sample_reduction'].get('general', {}).items():
+                config_insert(['sampling', 'sample_reduction', 'general', key], sub_value)
+            for key, sub_value in value['sample_reduction'].get('model_specific', {}).items():
+                config_insert(['sampling', 'sample_reduction', 'model_specific', key], sub_value)
+
+        if value.get('adaptive', {}).get('ess', 'multivariate') not in ('multivariate', 'univariate'):
+            raise ValueError('The adaptive sampling ess should be either "multivariate" or "univariate", '
+                             '{} given.'.format(value['adaptive']['ess']))
+
 
 class ProcessingStrategySectionLoader(ConfigSectionLoader):
     """Loads the config section processing_strategies"""
@@ -277,6 +313,33 @@ class TmpResultsDirSectionLoader(ConfigSectionLoader):
         config_insert(['tmp_results_dir'], value)
 
 
+class TmpResultsStorageSectionLoader(ConfigSectionLoader):
+    """Load the section tmp_results_storage"""
+
+    def load(self, value):
+        if value not in ('volume', 'roi'):
+            raise ValueError('The tmp_results_storage should be either "volume" or "roi", {} given.'.format(value))
+        config_insert(['tmp_results_storage'], value)
+
+
+class CLProgramCacheSectionLoader(ConfigSectionLoader):
+    """Load the section cl_program_cache"""
+
+    def load(self, value):
+        for item in ['enabled', 'directory']:
+            if item in value:
+                config_insert(['cl_program_cache', item], value[item])
+
+
+class NumpyFastPathSectionLoader(ConfigSectionLoader):
+    """Load the section numpy_fast_path"""
+
+    def load(self, value):
+        for item in ['max_voxels', 'voxels_per_block']:
+            if item in value:
+                config_insert(['numpy_fast_path', item], value[item])
+
+
 class NoiseStdEstimationSectionLoader(ConfigSectionLoader):
     """Load the section noise_std_estimating"""
 
@@ -357,6 +420,15 @@ def get_section_loader(section):
     if section == 'tmp_results_dir':
         return TmpResultsDirSectionLoader()
 
+    if section == 'tmp_results_storage':
+        return TmpResultsStorageSectionLoader()
+
+    if section == 'cl_program_cache':
+        return CLProgramCacheSectionLoader()
+
+    if section == 'numpy_fast_path':
+        return NumpyFastPathSectionLoader()
+
     if section == 'noise_std_estimating':
         return NoiseStdEstimationSectionLoader()
 
@@ -390,6 +462,46 @@ def gzip_sampling_results():
     return _config['output_format']['sampling']['gzip']
 
 
+def get_optimization_results_compression_level():
+    """Get the gzip compression level for writing the volume maps from the optimization.
+
+    Returns:
+        int or None: the compression level (1-9), or None for the default level
+    """
+    return _config['output_format']['optimization'].get('compression_level')
+
+
+def get_sampling_results_compression_level():
+    """Get the gzip compression level for writing the volume maps from the sampling.
+
+    Returns:
+        int or None: the compression level (1-9), or None for the default level
+    """
+    return _config['output_format']['sampling'].get('compression_level')
+
+
+def get_samples_storage_settings():
+    """Get the settings for storing the sample chains.
+
+    Returns:
+        dict: with the keys 'format' (either 'npy' or 'compressed'), 'dtype' (the data type to store the samples
+            in with the compressed format, None for the sampled data type), 'voxels_per_block' and
+            'compression_level' (the zlib compression level of the compressed format)
+    """
+    settings = {'format': 'npy', 'dtype': None, 'voxels_per_block': 256, 'compression_level': 1}
+    settings.update(_config['output_format']['sampling'].get('samples_storage', {}))
+    return settings
+
+
+def get_nmr_write_threads():
+    """Get the number of threads to use for writing (and compressing) the result volumes.
+
+    Returns:
+        int or None: the number of threads, if None we use the number of CPU's
+    """
+    return _config['output_format'].get('nmr_write_threads')
+
+
 def get_tmp_results_dir():
     """Get the default tmp results directory.
 
@@ -402,6 +514,44 @@ def get_tmp_results_dir():
     return _config['tmp_results_dir']
 
 
+def get_tmp_results_storage():
+    """Get the storage format for the temporary results.
+
+    With 'volume' every map is stored as a memory mapped volume, with 'roi' every map is stored as an array with
+    only the voxels in the mask, which is expanded to a volume only when the results are combined.
+
+    Returns:
+        str: either 'volume' or 'roi'
+    """
+    return _config.get('tmp_results_storage', 'volume')
+
+
+def get_cl_program_cache_settings():
+    """Get the settings of the cache of compiled OpenCL programs.
+
+    Returns:
+        dict: with the keys 'enabled' and 'directory', the directory in which we store the compiled programs. If not
+            configured, this defaults to a directory in the MDT configuration directory.
+    """
+    settings = {'enabled': True, 'directory': None}
+    settings.update(_config.get('cl_program_cache', {}))
+    if settings['directory'] is None:
+        settings['directory'] = os.path.join(get_config_dir(), 'cl_program_cache')
+    return settings
+
+
+def get_numpy_fast_path_settings():
+    """Get the settings for computing the simple element wise routines (like the DTI measures) with NumPy.
+
+    Returns:
+        dict: with the keys 'max_voxels', up to which number of voxels we use NumPy instead of OpenCL, and
+            'voxels_per_block', the number of voxels NumPy processes at once
+    """
+    settings = {'max_voxels': 100000, 'voxels_per_block': 100000}
+    settings.update(_config.get('numpy_fast_path', {}))
+    return settings
+
+
 def get_processing_strategy(processing_type, model_names=None, **kwargs):
     """Get the correct processing strategy for the given model.
 
@@ -526,6 +676,78 @@ def get_general_optimizer_settings():
     return _config['optimization']['general']['settings']
 
 
+def get_sampling_streaming_settings():
+    """Get the settings for sampling with online statistics, used when the samples are not stored.
+
+    Returns:
+        dict: with the keys 'block_size' (the number of samples per block, None to disable streaming),
+            'quantiles' (the quantiles to estimate) and 'quantile_sketch_size' (the number of samples per chain
+            kept for estimating the quantiles)
+    """
+    settings = {'block_size': None, 'quantiles': [], 'quantile_sketch_size': 1000}
+    settings.update(_config['sampling'].get('streaming', {}))
+    return settings
+
+
+def get_sampling_adaptive_settings():
+    """Get the settings for adaptive termination of sampling, only used when sampling with online statistics.
+
+    Returns:
+        dict: with the keys 'enabled', 'ess' (either 'multivariate' or 'univariate'), 'min_ess' (the ESS at which
+            we stop sampling a voxel, if None it is computed from 'alpha' and 'epsilon') and 'min_nmr_samples'
+            (the minimum number of samples per voxel before we start checking the ESS)
+    """
+    settings = {'enabled': False, 'ess': 'multivariate', 'min_ess': None, 'alpha': 0.05, 'epsilon': 0.1,
+                'min_nmr_samples': 1000}
+    settings.update(_config['sampling'].get('adaptive', {}))
+    return settings
+
+
+def get_sampling_post_processing_settings():
+    """Get the settings for the post-processing of the sample chains.
+
+    Returns:
+        dict: with the keys 'nmr_processes' (the number of processes used for estimating the ESS, if None we use
+            one per CPU) and 'voxels_per_block' (the number of voxels handed to a process at once)
+    """
+    settings = {'nmr_processes': None, 'voxels_per_block': 100}
+    settings.update(_config['sampling'].get('post_processing', {}))
+    return settings
+
+
+def get_sampling_multiple_chains_settings():
+    """Get the settings for sampling multiple chains per voxel.
+
+    Returns:
+        dict: with the keys 'start_dispersion' (the relative standard deviation of the perturbation of the starting
+            points of the additional chains) and 'seed' (the seed for generating the perturbations)
+    """
+    settings = {'start_dispersion': 0.05, 'seed': 0}
+    settings.update(_config['sampling'].get('multiple_chains', {}))
+    return settings
+
+
+def get_sample_reduction_settings(model_names=None):
+    """Get the settings for reducing the sample chains before they are stored.
+
+    Args:
+        model_names (list of str): the list of model names (the full recursive cascade of model names), used for
+            looking up the model specific settings.
+
+    Returns:
+        dict: with the keys 'thinning' (store every k-th sample), 'last_n' (only store the last n samples, None for
+            all), 'parameters' (the names of the parameters to store, None for all) and 'quantiles' (if set, the
+            quantiles to store instead of the chains)
+    """
+    reduction_config = _config['sampling'].get('sample_reduction', {})
+
+    settings = {'thinning': 1, 'last_n': None, 'parameters': None, 'quantiles': None}
+    settings.update(reduction_config.get('general', {}))
+    if model_names:
+        settings.update(get_model_config(model_names, reduction_config.get('model_specific', {})) or {})
+    return settings
+
+
 def get_sampler():
     """Load the sampler from the configuration.
 
@@ -761,3 +983,10 @@ try:
     load_user_home()
 except IOError:
     pass
+
+
+"""Configure the logging, this is done here such that it is in place before any of the processing modules is used."""
+try:
+    logging_config.dictConfig(get_logging_configuration_dict())
+except ValueError:
+    print('Logging disabled')
@@ -0,0 +1,138 @@
+import timeit
+
+import numpy as np
+
+import mot.configuration
+from mdt.processing_strategies import ChunksProcessingStrategy
+
+__author__ = 'Robbert Harms'
+__date__ = "2017-03-21"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+meta_info = {'title': 'Fit in chunks of adaptively sized voxel ranges',
+             'description': 'Processes a model in chunks of voxels, sized by the device memory and '
+                            'the measured processing time.'}
+
+
+class AdaptiveVoxelRange(ChunksProcessingStrategy):
+
+    def __init__(self, target_chunk_duration=60, memory_fraction=0.5, min_nmr_voxels=1000,
+                 max_nmr_voxels=200000, initial_nmr_voxels=10000, max_growth_factor=2, **kwargs):
+        """Optimize a given dataset in batches of which the size adapts to the device and the model.
+
+        The first chunk is sized using an estimate of the memory footprint of a single voxel (from the length of the
+        protocol and the number of model parameters) and the global memory of the devices in use. After every chunk
+        the size of the next chunk is tuned using the measured throughput such that a single chunk takes about
+        ``target_chunk_duration`` seconds, without exceeding the memory ceiling.
+
+        Args:
+            target_chunk_duration (float): the number of seconds we would like every chunk to take
+            memory_fraction (float): the fraction of the global device memory we may use for the voxels of one chunk
+            min_nmr_voxels (int): the minimum number of voxels per chunk, if allowed by the memory ceiling
+            max_nmr_voxels (int): the maximum number of voxels per chunk, also used as memory ceiling if the memory
+                of the devices can not be determined
+            initial_nmr_voxels (int): the number of voxels in the first chunk, if allowed by the memory ceiling
+            max_growth_factor (float): the maximum factor by which the chunk size may grow from one chunk to the next
+        """
+        super(AdaptiveVoxelRange, self).__init__(**kwargs)
+        self.target_chunk_duration = target_chunk_duration
+        self.memory_fraction = memory_fraction
+        self.min_nmr_voxels = int(min_nmr_voxels)
+        self.max_nmr_voxels = int(max_nmr_voxels)
+        self.initial_nmr_voxels = int(initial_nmr_voxels)
+        self.max_growth_factor = max_growth_factor
+
+    def _chunks_generator(self, model, problem_data, output_path, worker, total_roi_indices):
+        ceiling = self._get_memory_ceiling(model, problem_data)
+        nmr_voxels = self._clip(self.initial_nmr_voxels, ceiling)
+
+        self._logger.info('Using adaptive chunk sizes, starting with {} voxels, '
+                          'with a maximum of {} voxels per chunk.'.format(nmr_voxels, ceiling))
+
+        ind_start = 0
+        while ind_start < len(total_roi_indices):
+            ind_end = min(len(total_roi_indices), ind_start + nmr_voxels)
+
+            start_time = timeit.default_timer()
+            yield total_roi_indices[ind_start:ind_end]
+            run_time = timeit.default_timer() - start_time
+
+            nmr_voxels = self._get_next_chunk_size(ind_end - ind_start, run_time, ceiling)
+            ind_start = ind_end
+
+    def _get_next_chunk_size(self, nmr_voxels, run_time, ceiling):
+        """Get the size of the next chunk based on the throughput of the previous chunk.
+
+        Args:
+            nmr_voxels (int): the number of voxels in the previous chunk
+            run_time (float): the time in seconds it took to process the previous chunk
+            ceiling (int): the maximum number of voxels per chunk
+
+        Returns:
+            int: the number of voxels for the next chunk
+        """
+        if run_time <= 0:
+            return self._clip(int(nmr_voxels * self.max_growth_factor), ceiling)
+
+        optimal = int((nmr_voxels / float(run_time)) * self.target_chunk_duration)
+        optimal = min(optimal, int(nmr_voxels * self.max_growth_factor))
+        return self._clip(optimal, ceiling)
+
+    def _clip(self, nmr_voxels, ceiling):
+        """Clip the number of voxels to the minimum number of voxels and the memory ceiling, the latter is leading."""
+        return int(min(max(self.min_nmr_voxels, nmr_voxels), ceiling))
+
+    def _get_memory_ceiling(self, model, problem_data):
+        """Get the maximum number of voxels per chunk allowed by the memory of the devices.
+
+        With multiple devices the voxels of a chunk are divided evenly over the devices, as such the smallest device
+        determines the memory available per device. The ceiling can be lower than the configured minimum number of
+        voxels, in which case the ceiling is used as chunk size.
+
+        Returns:
+            int: the maximum number of voxels in a single chunk
+        """
+        try:
+            devices = [env.device for env in mot.configuration.get_cl_environments()]
+            global_mem_size = min(device.global_mem_size for device in devices)
+            max_alloc_size = min(device.max_mem_alloc_size for device in devices)
+        except Exception:
+            return self.max_nmr_voxels
+
+        bytes_per_voxel, largest_buffer_per_voxel = _get_voxel_memory_footprint(model, problem_data)
+
+        nmr_voxels_per_device = min(global_mem_size * self.memory_fraction / bytes_per_voxel,
+                                    max_alloc_size / largest_buffer_per_voxel)
+
+        ceiling = int(max(1, min(self.max_nmr_voxels, nmr_voxels_per_device * len(devices))))
+        if ceiling < self.min_nmr_voxels:
+            self._logger.warning('The memory of the devices only allows {} voxels per chunk, using that instead of '
+                                 'the minimum of {} voxels.'.format(ceiling, self.min_nmr_voxels))
+        return ceiling
+
+
+def _get_voxel_memory_footprint(model, problem_data):
+    """Estimate the device memory needed for processing a single voxel.
+
+    This is an upper bound estimate, counting the observations, model evaluations and residuals per protocol line,
+    a Jacobian as used by the gradient based optimization routines and some space per parameter for the starting
+    points, results, bounds and (for sampling) the proposal states.
+
+    Args:
+        model (:class:`~mdt.models.composite.DMRICompositeModel`): the model we want to process
+        problem_data (:class:`~mdt.utils.DMRIProblemData`): the problem data with which the model is initialized
+
+    Returns:
+        tuple: the total number of bytes per voxel and the number of bytes per voxel of the largest single buffer
+    """
+    float_size = np.dtype(np.float64 if model.double_precision else np.float32).itemsize
+
+    nmr_inst = problem_data.get_nmr_inst_per_problem()
+    nmr_params = len(model.get_optimized_param_names())
+
+    jacobian = nmr_inst * nmr_params
+    total = jacobian + 3 * nmr_inst + nmr_params * (nmr_params + 8)
+
+    return float_size * total, float_size * max(jacobian, nmr_inst)
@@ -0,0 +1,53 @@
+import numpy as np
+
+from mdt.processing_strategies import ChunksProcessingStrategy
+
+__author__ = 'Robbert Harms'
+__date__ = "2017-03-22"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+meta_info = {'title': 'Fit in chunks of whole slabs',
+             'description': 'Processes a model in chunks of complete slices over the first volume dimension.'}
+
+
+class SlabRange(ChunksProcessingStrategy):
+
+    def __init__(self, nmr_voxels=40000, **kwargs):
+        """Optimize a given dataset in spatially coherent slabs of at most the given number of voxels.
+
+        Every chunk consists of complete slices over the first dimension of the volume. Since the (temporary) results
+        are stored in C order, every chunk then maps to one contiguous block in the result files, which allows writing
+        every chunk as a single dense block. Slices containing more than ``nmr_voxels`` voxels are split over multiple
+        chunks.
+
+        Args:
+            nmr_voxels (int): the maximum number of voxels per chunk
+
+        Attributes:
+            nmr_voxels (int): the maximum number of voxels per chunk
+        """
+        super(SlabRange, self).__init__(**kwargs)
+        self.nmr_voxels = nmr_voxels
+
+    def _chunks_generator(self, model, problem_data, output_path, worker, total_roi_indices):
+        roi_indices = np.sort(total_roi_indices)
+        slice_indices = np.nonzero(problem_data.mask)[0][roi_indices]
+        slice_boundaries = np.concatenate((np.flatnonzero(np.diff(slice_indices)) + 1, [len(roi_indices)]))
+
+        chunk_start = 0
+        chunk_end = 0
+        for slice_end in slice_boundaries:
+            if slice_end - chunk_start > self.nmr_voxels and chunk_end > chunk_start:
+                yield roi_indices[chunk_start:chunk_end]
+                chunk_start = chunk_end
+
+            while slice_end - chunk_start > self.nmr_voxels:
+                yield roi_indices[chunk_start:chunk_start + self.nmr_voxels]
+                chunk_start += self.nmr_voxels
+
+            chunk_end = slice_end
+
+        if chunk_end > chunk_start:
+            yield roi_indices[chunk_start:chunk_end]
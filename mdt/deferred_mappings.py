@@ -37,7 +37,6 @@ class DeferredActionDict(collections.MutableMapping):
 
     def __getitem__(self, key):
         if key not in self._applied_on_key or not self._applied_on_key[key]:
-            self._func(key, self._items[key])
             self._items[key] = self._func(key, self._items[key])
             self._applied_on_key[key] = True
         return self._items[key]
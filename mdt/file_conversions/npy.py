@@ -2,8 +2,8 @@ import glob
 import os
 import numpy as np
 import six
-from mdt.utils import restore_volumes
-from mdt.nifti import write_nifti, load_nifti
+from mdt.nifti import write_nifti, write_nifti_blocks, load_nifti
+from mdt.sample_storage import CompressedSamples
 
 __author__ = 'Robbert Harms'
 __date__ = "2017-02-28"
@@ -47,20 +47,33 @@ def load_all_npy_files(directory):
     return results_dict
 
 
-def samples_npy_to_nifti(samples_npy_fname, used_mask, nifti_header, nifti_fname=None):
+def samples_npy_to_nifti(samples_npy_fname, used_mask, nifti_header, nifti_fname=None, max_block_memory=2**28,
+                         compression_level=None):
     """Convert a npy file containing sampling results to a nifti file.
 
     Since the sample npy files are stored as a two dimensional matrix (with on the first axis the ROI index number
     and on the second the samples), we need to have the lookup table for the spatial information about the samples.
 
+    The nifti file is written in blocks of samples, as such the complete four dimensional volume is never held in
+    memory. Larger blocks are faster, since every block reads a part of every sample chain. This holds especially
+    for the compressed samples format, in which every block of samples decompresses all the stored chains.
+
     Args:
-        samples_npy_fname (str): the filename of the samples file to convert
+        samples_npy_fname (str): the filename of the samples file to convert, either a ``.npy`` file or a
+            directory with compressed samples (see :class:`~mdt.sample_storage.CompressedSamples`)
         used_mask (ndarray or str): either an three dimensional matrix with the mask or a path to a nifti file.
         nifti_header (nibabel header): the header to use for writing the nifti file
         nifti_fname (str): the filename of the nifti file. If not given it defaults to the same directory as the
             samples file.
+        max_block_memory (int): the maximum number of bytes used for the volumes of one block of samples
+        compression_level (int): the gzip compression level (1-9) to use when writing a .nii.gz file. If None we use
+            the NiBabel default.
     """
-    samples = np.load(samples_npy_fname, mmap_mode='r')
+    samples_npy_fname = os.path.normpath(samples_npy_fname)
+    if CompressedSamples.is_store(samples_npy_fname):
+        samples = CompressedSamples(samples_npy_fname)
+    else:
+        samples = np.load(samples_npy_fname, mmap_mode='r')
 
     if isinstance(used_mask, six.string_types):
         used_mask = load_nifti(used_mask).get_data()
@@ -74,5 +87,21 @@ def samples_npy_to_nifti(samples_npy_fname, used_mask, nifti_header, nifti_fname
         nifti_fname = os.path.join(os.path.dirname(samples_npy_fname),
                                    os.path.splitext(os.path.basename(samples_npy_fname))[0] + '.nii.gz')
 
-    volume = restore_volumes(samples, used_mask)
-    write_nifti(volume, nifti_header, nifti_fname)
+    shape3d = used_mask.shape[:3]
+    nmr_samples = samples.shape[1]
+
+    # the volume of a block is copied once when converted to Fortran order, hence the factor two
+    bytes_per_sample = 2 * int(np.prod(shape3d)) * samples.dtype.itemsize
+    samples_per_block = int(max(1, min(nmr_samples, max_block_memory // bytes_per_sample)))
+
+    def volume_blocks():
+        indices = np.ravel_multi_index(np.nonzero(used_mask)[:3], shape3d, order='C')
+        for block_start in range(0, nmr_samples, samples_per_block):
+            block = samples[:, block_start:block_start + samples_per_block]
+
+            volumes = np.zeros((int(np.prod(shape3d)), block.shape[1]), dtype=samples.dtype)
+            volumes[indices] = block
+            yield np.reshape(volumes, shape3d + (block.shape[1],))
+
+    write_nifti_blocks(volume_blocks(), shape3d + (nmr_samples,), samples.dtype, nifti_header, nifti_fname,
+                       compression_level=compression_level)
@@ -1,6 +1,8 @@
 import collections
 import glob
 import logging
+import multiprocessing
+import multiprocessing.queues
 import os
 import time
 import timeit
@@ -9,7 +11,7 @@ from six import string_types
 from mdt.__version__ import __version__
 from mdt.deferred_mappings import DeferredActionDict
 from mdt.file_conversions.npy import load_all_npy_files
-from mdt.nifti import get_all_image_data
+from mdt.nifti import get_all_image_data, BackgroundNiftiWriter
 from mdt.batch_utils import batch_profile_factory, AllSubjects
 from mdt.components_loader import get_model
 from mdt.configuration import get_processing_strategy, get_optimizer_for_model
@@ -17,7 +19,8 @@ from mdt.models.cascade import DMRICascadeModelInterface
 from mdt.protocols import write_protocol
 from mdt.utils import create_roi, get_cl_devices, model_output_exists, \
     per_model_logging_context, get_temporary_results_dir, SimpleInitializationData, is_scalar
-from mdt.processing_strategies import SimpleModelProcessingWorkerGenerator, FittingProcessingWorker
+from mdt.processing_strategies import SimpleModelProcessingWorkerGenerator, FittingProcessingWorker, \
+    roi_results_to_volumes
 from mdt.exceptions import InsufficientProtocolError
 from mot.load_balance_strategies import EvenDistribution
 import mot.configuration
@@ -29,11 +32,15 @@ __maintainer__ = "Robbert Harms"
 __email__ = "robbert.harms@maastrichtuniversity.nl"
 
 
+BATCH_FIT_STATUS_POLL_INTERVAL = 1
+"""The time in seconds between the checks of the parallel batch fitting for status updates and dead worker processes."""
+
+
 class BatchFitting(object):
 
     def __init__(self, data_folder, batch_profile=None, subjects_selection=None, recalculate=False,
                  models_to_fit=None, cascade_subdir=False,
-                 cl_device_ind=None, double_precision=False, tmp_results_dir=True):
+                 cl_device_ind=None, double_precision=False, tmp_results_dir=True, nmr_processes=None):
         """This class is meant to make running computations as simple as possible.
 
         The idea is that a single folder is enough to fit_model the computations. One can optionally give it the
@@ -63,6 +70,9 @@ class BatchFitting(object):
             double_precision (boolean): if we would like to do the calculations in double precision
             tmp_results_dir (str, True or None): The temporary dir for the calculations. Set to a string to use
                 that path directly, set to True to use the config value, set to None to disable.
+            nmr_processes (int): the number of subjects to process in parallel. If None or 1 we process the subjects
+                one after another in this process. If larger than one we start that many worker processes and
+                divide the selected CL devices (or all devices if ``cl_device_ind`` is not set) over the workers.
         """
         self._logger = logging.getLogger(__name__)
         self._batch_profile = batch_profile_factory(batch_profile, data_folder)
@@ -78,6 +88,7 @@ class BatchFitting(object):
         self._recalculate = recalculate
         self._double_precision = double_precision
         self._cascade_subdir = cascade_subdir
+        self._nmr_processes = nmr_processes or 1
 
         if self._batch_profile is None:
             raise RuntimeError('No suitable batch profile could be '
@@ -121,6 +132,15 @@ class BatchFitting(object):
         """Run the computations on the current dir with all the configured options. """
         self._logger.info('Running computations on {0} subjects'.format(len(self._subjects)))
 
+        if self._nmr_processes > 1 and len(self._subjects) > 1:
+            self._run_parallel()
+        else:
+            self._run_serial()
+
+        return self._subjects
+
+    def _run_serial(self):
+        """Process all the subjects one after another in the current process."""
         run_func = _BatchFitRunner(self._models_to_fit, self._recalculate, self._cascade_subdir,
                                    self._cl_device_ind, self._double_precision, self._tmp_results_dir)
         for ind, subject in enumerate(self._subjects):
@@ -128,7 +148,163 @@ class BatchFitting(object):
                 subject.subject_id, ind + 1, len(self._subjects), ind / len(self._subjects)))
             run_func(subject)
 
-        return self._subjects
+    def _run_parallel(self):
+        """Process the subjects using a pool of worker processes, each with its own subset of the CL devices.
+
+        See :func:`_run_batch_fit_workers` for the details.
+        """
+        device_subsets = _get_device_subsets(self._cl_device_ind, min(self._nmr_processes, len(self._subjects)))
+
+        run_funcs = []
+        for worker_ind, device_indices in enumerate(device_subsets):
+            run_funcs.append(_BatchFitRunner(self._models_to_fit, self._recalculate, self._cascade_subdir,
+                                             device_indices, self._double_precision, self._tmp_results_dir))
+            self._logger.info('Starting batch fit worker {} using the devices with indices {}.'.format(
+                worker_ind, device_indices))
+
+        _run_batch_fit_workers(self._subjects, run_funcs)
+
+
+def _get_device_subsets(cl_device_ind, nmr_workers):
+    """Divide the CL devices over the given number of workers.
+
+    If there are more devices than workers, every worker gets multiple devices. If there are more workers than devices,
+    the devices are shared over the workers in a round robin fashion.
+
+    Args:
+        cl_device_ind (list of int or None): the indices of the devices to use, if None we use all devices
+        nmr_workers (int): the number of workers we want to divide the devices over
+
+    Returns:
+        list of list: per worker the indices of the devices that worker may use
+    """
+    device_indices = cl_device_ind
+    if device_indices is None:
+        device_indices = list(range(len(get_cl_devices())))
+
+    if len(device_indices) >= nmr_workers:
+        return [list(device_indices[ind::nmr_workers]) for ind in range(nmr_workers)]
+    return [[device_indices[ind % len(device_indices)]] for ind in range(nmr_workers)]
+
+
+def _run_batch_fit_workers(subjects, run_funcs, status_poll_interval=BATCH_FIT_STATUS_POLL_INTERVAL):
+    """Process the given subjects on one worker process per run function.
+
+    Every worker pulls subjects from a shared queue until the queue is exhausted. The workers send status messages
+    back to this process which we use for the progress logging.
+
+    If a worker process dies (for example by a segmentation fault in the CL driver), the subject it was processing
+    is marked as failed. The other workers continue with the remaining subjects. If no workers are left, all
+    remaining subjects are marked as failed.
+
+    Args:
+        subjects (list of SubjectInfo): the subjects to process
+        run_funcs (list of _BatchFitRunner): per worker the function to apply to the subjects
+        status_poll_interval (float): the time in seconds between the checks for status updates and of the workers
+
+    Returns:
+        dict: per subject id the error message if processing that subject failed, else None
+    """
+    logger = logging.getLogger(__name__)
+
+    # the status updates are written synchronously, such that the start of a subject is known even if the worker
+    # dies directly afterwards
+    if hasattr(multiprocessing, 'get_context'):
+        context = multiprocessing.get_context('spawn')
+        status_queue = context.SimpleQueue()
+    else:
+        context = multiprocessing
+        status_queue = multiprocessing.queues.SimpleQueue()
+
+    task_queue = context.Queue()
+
+    for subject in subjects:
+        task_queue.put(subject)
+
+    workers = []
+    for worker_ind, run_func in enumerate(run_funcs):
+        task_queue.put(None)
+
+        worker = context.Process(target=_batch_fit_worker, args=(worker_ind, run_func, task_queue, status_queue),
+                                 name='mdt-batch-fit-{}'.format(worker_ind))
+        worker.start()
+        workers.append(worker)
+
+    subject_ids = [subject.subject_id for subject in subjects]
+    finished = {}
+    in_progress = {}
+    alive_workers = set(range(len(workers)))
+
+    def finish_subject(subject_id, error=None):
+        if subject_id in finished:
+            return
+        finished[subject_id] = error
+
+        if error is not None:
+            logger.error('Processing subject {} failed with the error: {}'.format(subject_id, error))
+        logger.info('Finished processing subject {}, ({} of {}, we are at {:.2%})'.format(
+            subject_id, len(finished), len(subject_ids), len(finished) / len(subject_ids)))
+
+    def process_status(worker_ind, subject_id, status, message):
+        if status == 'started':
+            in_progress[worker_ind] = subject_id
+            logger.info('Started processing subject {}.'.format(subject_id))
+        else:
+            in_progress[worker_ind] = None
+            finish_subject(subject_id, message if status == 'failed' else None)
+
+    while len(finished) < len(set(subject_ids)):
+        if not status_queue.empty():
+            process_status(*status_queue.get())
+            continue
+
+        for worker_ind in list(alive_workers):
+            if not workers[worker_ind].is_alive():
+                alive_workers.remove(worker_ind)
+
+                # status updates sent just before the worker stopped may have arrived after the last check
+                while not status_queue.empty():
+                    process_status(*status_queue.get())
+
+                exitcode = workers[worker_ind].exitcode
+                if in_progress.get(worker_ind) is not None and exitcode != 0:
+                    finish_subject(in_progress.pop(worker_ind),
+                                   'the worker {} exited with code {}'.format(worker_ind, exitcode))
+
+        if not alive_workers:
+            for subject_id in subject_ids:
+                finish_subject(subject_id, 'all workers exited before processing this subject')
+            break
+
+        time.sleep(status_poll_interval)
+
+    for worker in workers:
+        worker.join()
+
+    return finished
+
+
+def _batch_fit_worker(worker_ind, run_func, task_queue, status_queue):
+    """The loop executed by the batch fitting worker processes.
+
+    This takes subjects from the task queue until it receives None. Status updates are reported back on the status
+    queue as (worker_ind, subject_id, status, message) tuples, with status one of 'started', 'done' or 'failed'.
+
+    Args:
+        worker_ind (int): the index of this worker, used to identify the worker in the status updates
+        run_func (_BatchFitRunner): the function to apply to every subject
+        task_queue (multiprocessing.Queue): the queue with the subjects to process
+        status_queue (multiprocessing.SimpleQueue): the queue on which we report the subject status
+    """
+    for subject_info in iter(task_queue.get, None):
+        status_queue.put((worker_ind, subject_info.subject_id, 'started', None))
+        try:
+            run_func(subject_info)
+        except Exception as exc:
+            logging.getLogger(__name__).exception(exc)
+            status_queue.put((worker_ind, subject_info.subject_id, 'failed', repr(exc)))
+        else:
+            status_queue.put((worker_ind, subject_info.subject_id, 'done', None))
 
 
 class _BatchFitRunner(object):
@@ -142,6 +318,15 @@ class _BatchFitRunner(object):
         self._logger = logging.getLogger(__name__)
         self._tmp_results_dir = tmp_results_dir
 
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_logger']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._logger = logging.getLogger(__name__)
+
     def __call__(self, subject_info):
         """Run the batch fitting on the given subject.
 
@@ -159,6 +344,10 @@ class _BatchFitRunner(object):
         self._logger.info('Loading the data (DWI, mask and protocol) of subject {0}'.format(subject_info.subject_id))
         problem_data = subject_info.get_problem_data()
 
+        # all models share this problem data, extracting the observations once allows the volume subsets
+        # used by the different models to reuse them
+        problem_data.load_observations()
+
         with self._timer(subject_info.subject_id):
             for model in self._models_to_fit:
                 self._logger.info('Going to fit model {0} on subject {1}'.format(model, subject_info.subject_id))
@@ -241,6 +430,7 @@ class ModelFit(object):
         self._model_names_list = []
         self._tmp_results_dir = get_temporary_results_dir(tmp_results_dir)
         self._initialization_data = initialization_data or SimpleInitializationData()
+        self._volumes_writer = None
 
         if self._cl_device_indices is not None and not isinstance(self._cl_device_indices, collections.Iterable):
             self._cl_device_indices = [self._cl_device_indices]
@@ -265,7 +455,12 @@ class ModelFit(object):
             dict: The result maps for the given composite model or the last model in the cascade.
                 This returns the results as 3d/4d volumes for every output map.
         """
-        _, maps = self._run(self._model, self._recalculate, self._only_recalculate_last)
+        with BackgroundNiftiWriter() as volumes_writer:
+            self._volumes_writer = volumes_writer
+            try:
+                _, maps = self._run(self._model, self._recalculate, self._only_recalculate_last)
+            finally:
+                self._volumes_writer = None
         return maps
 
     def _run(self, model, recalculate, only_recalculate_last, _in_recursion=False):
@@ -335,10 +530,10 @@ class ModelFit(object):
                                                               tmp_dir=self._tmp_results_dir)
 
                 fitter = SingleModelFit(model, self._problem_data, self._output_folder, optimizer, processing_strategy,
-                                        recalculate=recalculate)
+                                        recalculate=recalculate, volumes_writer=self._volumes_writer)
                 results = fitter.run()
 
-        map_results = get_all_image_data(os.path.join(self._output_folder, model.name))
+        map_results = roi_results_to_volumes(results, self._problem_data.mask)
         return results, map_results
 
     def _apply_user_provided_initialization_data(self, model):
@@ -355,7 +550,8 @@ class ModelFit(object):
 
 class SingleModelFit(object):
 
-    def __init__(self, model, problem_data, output_folder, optimizer, processing_strategy, recalculate=False):
+    def __init__(self, model, problem_data, output_folder, optimizer, processing_strategy, recalculate=False,
+                 volumes_writer=None):
         """Fits a composite model.
 
          This does not accept cascade models. Please use the more general ModelFit class for all models,
@@ -371,8 +567,12 @@ class SingleModelFit(object):
              processing_strategy (:class:`~mdt.processing_strategies.ModelProcessingStrategy`): the processing strategy
                 to use
              recalculate (boolean): If we want to recalculate the results if they are already present.
+             volumes_writer (:class:`~mdt.nifti.BackgroundNiftiWriter`): if given, the result maps are written
+                in the background using this writer. In that case, the results are not guaranteed to be on disk until
+                the writer has finished.
          """
         self.recalculate = recalculate
+        self._volumes_writer = volumes_writer
 
         self._model = model
         self._problem_data = problem_data
@@ -392,6 +592,9 @@ class SingleModelFit(object):
         with per_model_logging_context(self._output_path):
             self._model.set_problem_data(self._problem_data)
 
+            if self._volumes_writer is not None:
+                self._volumes_writer.wait(self._output_path)
+
             if self.recalculate:
                 if os.path.exists(self._output_path):
                     list(map(os.remove, glob.glob(os.path.join(self._output_path, '*.nii*'))))
@@ -406,7 +609,7 @@ class SingleModelFit(object):
 
             with self._logging():
                 worker_generator = SimpleModelProcessingWorkerGenerator(
-                    lambda *args: FittingProcessingWorker(self._optimizer, *args))
+                    lambda *args: FittingProcessingWorker(self._optimizer, self._volumes_writer, *args))
 
                 results = self._processing_strategy.run(
                     self._model, self._problem_data, self._output_path, self.recalculate, worker_generator)
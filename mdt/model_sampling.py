@@ -1,18 +1,22 @@
 from contextlib import contextmanager
+import glob
+import json
 import logging
 import os
 import timeit
 import time
 
-from numpy.lib.format import open_memmap
+import numpy as np
 import shutil
 
-from mdt.nifti import load_nifti, write_all_as_nifti
-from mdt.utils import model_output_exists, load_samples, restore_volumes
+from mdt.nifti import load_nifti, write_all_as_nifti, get_all_image_data
+from mdt.sample_statistics import OnlineSampleStatistics
+from mdt.sample_storage import COMPRESSED_SAMPLES_EXTENSION
+from mdt.utils import model_output_exists, load_samples, restore_volumes, create_roi, append_sample_segment, \
+    remove_sample_segments, post_process_sample_statistics, SAMPLE_SEGMENTS_DIR_NAME
 from mdt.processing_strategies import SimpleModelProcessingWorkerGenerator, SamplingProcessingWorker
 from mdt.exceptions import InsufficientProtocolError
-from mot.cl_routines.mapping.error_measures import ErrorMeasures
-from mot.cl_routines.mapping.residual_calculator import ResidualCalculator
+from mot.cl_routines.sampling.metropolis_hastings import SimpleMHState
 
 __author__ = 'Robbert Harms'
 __date__ = "2015-05-01"
@@ -22,7 +26,7 @@ __email__ = "robbert.harms@maastrichtuniversity.nl"
 
 def sample_composite_model(model, problem_data, output_folder, sampler, processing_strategy,
                            recalculate=False, store_samples=True, store_volume_maps=True,
-                           initialization_data=None):
+                           initialization_data=None, chain_state=None, nmr_chains=1):
     """Sample a composite model.
 
     Args:
@@ -39,6 +43,10 @@ def sample_composite_model(model, problem_data, output_folder, sampler, processi
         initialization_data (:class:`~mdt.utils.InitializationData`): provides (extra) initialization data to use
             during model fitting. If we are optimizing a cascade model this data only applies to the last model in the
             cascade.
+        chain_state (SamplingChainState): if given, we continue the chains of a previous sampling run from the
+            given state instead of starting new chains. No burn-in is applied in that case.
+        nmr_chains (int): the number of independent chains to sample per voxel, see
+            :class:`~mdt.processing_strategies.SamplingProcessingWorker`.
     """
     if not model.is_protocol_sufficient(problem_data.protocol):
         raise InsufficientProtocolError(
@@ -66,7 +74,8 @@ def sample_composite_model(model, problem_data, output_folder, sampler, processi
 
     with _log_info(logger, model.name):
         worker_generator = SimpleModelProcessingWorkerGenerator(
-            lambda *args: SamplingProcessingWorker(sampler, store_samples, store_volume_maps, *args))
+            lambda *args: SamplingProcessingWorker(sampler, store_samples, store_volume_maps, chain_state,
+                                                   nmr_chains, *args))
         return processing_strategy.run(model, problem_data, output_folder, recalculate, worker_generator)
 
 
@@ -83,6 +92,11 @@ def _log_info(logger, model_name):
 def combine_sampling_information(base_dir, append_dir, model, output_dir=None):
     """Combine the samples and sampling results from two sampling runs.
 
+    The samples of the second run are appended as a new segment to the samples in the output dir (see
+    :func:`~mdt.utils.append_sample_segment`), without copying the existing samples. The volume maps are updated
+    from the stored sufficient statistics of the existing samples and the new samples, as such only the new
+    samples are read.
+
     Args:
         base_dir (str): the directory containing the first part of the total chain of samples.
         append_dir (str): the directory containing the additional samples we would like to append to the sampling
@@ -97,51 +111,233 @@ def combine_sampling_information(base_dir, append_dir, model, output_dir=None):
         os.makedirs(output_dir)
 
     def move_extra_maps():
-        for directory in ['chain_end_point', 'proposal_state']:
+        for directory in ['chain_end_point', 'proposal_state', 'mh_state']:
             if os.path.exists(os.path.join(output_dir, directory)):
                 shutil.rmtree(os.path.join(output_dir, directory))
-            shutil.move(os.path.join(append_dir, directory), os.path.join(output_dir, directory))
+            if os.path.exists(os.path.join(append_dir, directory)):
+                shutil.move(os.path.join(append_dir, directory), os.path.join(output_dir, directory))
+
+    def copy_base_samples():
+        if os.path.abspath(output_dir) == os.path.abspath(base_dir):
+            return
+
+        remove_sample_segments(output_dir)
+        for fname in glob.glob(os.path.join(base_dir, '*.samples.npy')):
+            shutil.copy(fname, output_dir)
+        for path in glob.glob(os.path.join(base_dir, '*' + COMPRESSED_SAMPLES_EXTENSION)):
+            target = os.path.join(output_dir, os.path.basename(path))
+            if os.path.exists(target):
+                shutil.rmtree(target)
+            shutil.copytree(path, target)
+        if os.path.isdir(os.path.join(base_dir, SAMPLE_SEGMENTS_DIR_NAME)):
+            shutil.copytree(os.path.join(base_dir, SAMPLE_SEGMENTS_DIR_NAME),
+                            os.path.join(output_dir, SAMPLE_SEGMENTS_DIR_NAME))
 
     def append_samples():
-        base_samples = load_samples(base_dir)
-        other_samples = load_samples(append_dir)
+        statistics = _update_sample_statistics(output_dir, load_samples(append_dir), model)
+        append_sample_segment(output_dir, append_dir)
+        return statistics
 
-        total_nmr_voxels = base_samples[list(base_samples.keys())[0]].shape[0]
-        nmr_samples = [base_samples[list(base_samples.keys())[0]].shape[1],
-                       other_samples[list(other_samples.keys())[0]].shape[1]]
+    def create_volume_maps(statistics):
+        volume_rois = post_process_sample_statistics(model, statistics.get_all_maps())
 
-        tmp_output_dir = os.path.join(output_dir, '_tmp_samples')
-        if not os.path.exists(tmp_output_dir):
-            os.makedirs(tmp_output_dir)
+        mask_nifti = load_nifti(os.path.join(output_dir, 'volume_maps', 'UsedMask.nii.gz'))
 
-        for map_name in base_samples:
-            samples_file = os.path.join(tmp_output_dir, map_name + '.samples.npy')
+        volume_maps = restore_volumes(volume_rois, mask_nifti.get_data())
 
-            saved = open_memmap(samples_file, mode='w+', dtype=base_samples[map_name].dtype,
-                                shape=(total_nmr_voxels, sum(nmr_samples)))
-            saved[:, :nmr_samples[0]] = base_samples[map_name]
-            saved[:, nmr_samples[0]:] = other_samples[map_name]
+        write_all_as_nifti(volume_maps, os.path.join(output_dir, 'volume_maps'), mask_nifti.get_header(),
+                           overwrite_volumes=True)
 
-            shutil.move(os.path.join(tmp_output_dir, map_name + '.samples.npy'),
-                        os.path.join(output_dir, map_name + '.samples.npy'))
+    move_extra_maps()
+    copy_base_samples()
+    create_volume_maps(append_samples())
 
-        shutil.rmtree(tmp_output_dir)
 
-    def create_volume_maps():
-        samples = load_samples(output_dir)
+def _update_sample_statistics(samples_dir, new_samples, model, nmr_voxels_per_block=1000):
+    """Update the sufficient statistics stored with the samples in the given directory with the given new samples.
 
-        volume_rois = model.add_extra_result_maps(model.samples_to_statistics(samples))
-        errors = ResidualCalculator().calculate(model, volume_rois)
-        error_measures = ErrorMeasures().calculate(errors)
-        volume_rois.update(error_measures)
+    The statistics are stored in the sample segments directory. If no (valid) statistics are stored yet, they are
+    first computed from the current samples, which reads all the current samples once.
 
-        mask_nifti = load_nifti(os.path.join(output_dir, 'volume_maps', 'UsedMask.nii.gz'))
+    The new statistics are written before the new samples are appended. Since the statistics record the number of
+    samples they were computed from, they are recomputed if the appending is interrupted.
 
-        volume_maps = restore_volumes(volume_rois, mask_nifti.get_data())
+    The ESS is estimated with batch means with a batch size based on the total length of the chains after appending.
+    If the statistics are updated from a stored state, the stored batches can only be merged, so the batch size is
+    the multiple of the stored batch size closest to the square root of the new chain length (see
+    :meth:`~mdt.sample_statistics.OnlineSampleStatistics.adapt_batch_size`). The ESS can then deviate slightly from
+    the ESS computed over the complete chains at once.
 
-        write_all_as_nifti(volume_maps, os.path.join(output_dir, 'volume_maps'), mask_nifti.get_header(),
-                           overwrite_volumes=True)
+    Args:
+        samples_dir (str): the directory with the current samples
+        new_samples (dict): per parameter the new samples we are about to append
+        model (mdt.models.composite.DMRICompositeModel): the model that was sampled
+        nmr_voxels_per_block (int): the number of voxels we process at once
 
-    move_extra_maps()
-    append_samples()
-    create_volume_maps()
+    Returns:
+        mdt.sample_statistics.OnlineSampleStatistics: the statistics over the current and the new samples
+    """
+    param_names = model.get_optimized_param_names()
+    sampling_statistics = model.get_parameter_sampling_statistics()
+    statistics_dir = os.path.join(samples_dir, SAMPLE_SEGMENTS_DIR_NAME, 'statistics')
+
+    current_samples = load_samples(samples_dir)
+    nmr_voxels, nmr_current_samples = current_samples[param_names[0]].shape
+    nmr_total_samples = nmr_current_samples + new_samples[param_names[0]].shape[1]
+
+    stored_state = _load_statistics_state(statistics_dir)
+    if stored_state is not None and stored_state['nmr_samples'] != nmr_current_samples:
+        stored_state = None
+
+    def get_block(samples, block):
+        return np.stack([samples[name][block] for name in param_names], axis=1)
+
+    new_state = None
+    for block_start in range(0, nmr_voxels, nmr_voxels_per_block):
+        block = slice(block_start, min(nmr_voxels, block_start + nmr_voxels_per_block))
+
+        statistics = OnlineSampleStatistics(param_names, sampling_statistics, nmr_total_samples)
+        if stored_state is None:
+            statistics.update(get_block(current_samples, block))
+        else:
+            statistics.set_state({key: value[block] if isinstance(value, np.ndarray) else value
+                                  for key, value in stored_state.items()})
+            statistics.adapt_batch_size(nmr_total_samples)
+        statistics.update(get_block(new_samples, block))
+
+        block_state = statistics.get_state()
+        if new_state is None:
+            new_state = {key: np.zeros((nmr_voxels,) + value.shape[1:], dtype=value.dtype)
+                         if isinstance(value, np.ndarray) else value for key, value in block_state.items()}
+        for key, value in block_state.items():
+            if isinstance(value, np.ndarray):
+                new_state[key][block] = value
+
+    _store_statistics_state(statistics_dir, new_state)
+
+    statistics = OnlineSampleStatistics(param_names, sampling_statistics, new_state['nmr_samples'])
+    statistics.set_state(new_state)
+    return statistics
+
+
+def _load_statistics_state(statistics_dir):
+    """Load the state of the sample statistics stored in the given directory.
+
+    Returns:
+        dict or None: the stored state (see :meth:`OnlineSampleStatistics.get_state`), or None if not present
+    """
+    info_file = os.path.join(statistics_dir, 'state.json')
+    if not os.path.isfile(info_file):
+        return None
+
+    with open(info_file, 'r') as f:
+        state = json.load(f)
+
+    for fname in glob.glob(os.path.join(statistics_dir, '*.npy')):
+        state[os.path.basename(fname)[:-len('.npy')]] = np.load(fname, mmap_mode='r')
+    return state
+
+
+def _store_statistics_state(statistics_dir, state):
+    """Store the state of the sample statistics in the given directory, replacing the current state."""
+    tmp_dir = statistics_dir + '_tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    for key, value in state.items():
+        if isinstance(value, np.ndarray):
+            np.save(os.path.join(tmp_dir, key + '.npy'), value)
+
+    with open(os.path.join(tmp_dir, 'state.json'), 'w') as f:
+        json.dump({key: value for key, value in state.items() if not isinstance(value, np.ndarray)}, f)
+
+    if os.path.exists(statistics_dir):
+        shutil.rmtree(statistics_dir)
+    os.rename(tmp_dir, statistics_dir)
+
+
+class SamplingChainState(object):
+
+    _mh_state_maps = ['proposal_state_sampling_counter', 'proposal_state_acceptance_counter',
+                      'online_parameter_variance', 'online_parameter_variance_update_m2',
+                      'online_parameter_mean', 'rng_state']
+
+    def __init__(self, model, samples_dir, mask):
+        """The state of the Markov chains at the end of a previous sampling run, used to continue these chains.
+
+        This loads the chain end points, the proposal states and the Metropolis Hastings state stored by a previous
+        sampling run, such that sampling can resume exactly where the previous run stopped.
+
+        Args:
+            model (mdt.models.composite.DMRICompositeModel): the model we are sampling
+            samples_dir (str): the directory with the output of the previous sampling run
+            mask (ndarray): the mask of the problem data, to convert the stored maps to ROI space
+        """
+        self._param_names = model.get_optimized_param_names()
+        self._proposal_state_names = model.get_proposal_state_names()
+
+        self._chain_end_point = self._load_roi_maps(os.path.join(samples_dir, 'chain_end_point'), mask)
+        self._proposal_state = self._load_roi_maps(os.path.join(samples_dir, 'proposal_state'), mask)
+        self._mh_state = self._load_roi_maps(os.path.join(samples_dir, 'mh_state'), mask)
+
+        with open(os.path.join(samples_dir, 'mh_state', 'nmr_samples_drawn.txt'), 'r') as f:
+            self._nmr_samples_drawn = int(f.read())
+
+    @classmethod
+    def exists(cls, samples_dir):
+        """Check if the given directory contains the complete state of a previous sampling run.
+
+        Args:
+            samples_dir (str): the directory with the output of a sampling run
+
+        Returns:
+            boolean: if the chain state can be loaded from this directory
+        """
+        return all(os.path.isdir(os.path.join(samples_dir, subdir))
+                   for subdir in ['chain_end_point', 'proposal_state', 'mh_state']) \
+            and os.path.isfile(os.path.join(samples_dir, 'mh_state', 'nmr_samples_drawn.txt'))
+
+    def get_chain_end_point(self, roi_indices):
+        """Get the last position of the chains of the given voxels.
+
+        Args:
+            roi_indices (ndarray): the ROI indices of the voxels we want the chain end point of
+
+        Returns:
+            ndarray: a (d, p) matrix with for every voxel the last position of the chain
+        """
+        return self._get_matrix(self._chain_end_point, self._param_names, roi_indices)
+
+    def get_proposal_state(self, roi_indices):
+        """Get the state of the proposals of the given voxels.
+
+        Args:
+            roi_indices (ndarray): the ROI indices of the voxels we want the proposal state of
+
+        Returns:
+            ndarray: a (d, k) matrix with for every voxel the value of the adaptable proposal parameters
+        """
+        return self._get_matrix(self._proposal_state, self._proposal_state_names, roi_indices)
+
+    def get_mh_state(self, roi_indices):
+        """Get the Metropolis Hastings state of the given voxels.
+
+        Args:
+            roi_indices (ndarray): the ROI indices of the voxels we want the MH state of
+
+        Returns:
+            mot.cl_routines.sampling.metropolis_hastings.SimpleMHState: the MH state of the given voxels
+        """
+        items = [self._get_matrix(self._mh_state, [name], roi_indices) for name in self._mh_state_maps]
+        return SimpleMHState(self._nmr_samples_drawn, *items)
+
+    @staticmethod
+    def _load_roi_maps(directory, mask):
+        return {name: create_roi(data, mask) for name, data in get_all_image_data(directory, deferred=False).items()}
+
+    @staticmethod
+    def _get_matrix(roi_maps, names, roi_indices):
+        """Get the values of the given maps for the given voxels as one (d, n) matrix."""
+        return np.concatenate([np.reshape(roi_maps[name][roi_indices], (len(roi_indices), -1)) for name in names],
+                              axis=1)
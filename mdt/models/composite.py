@@ -40,6 +40,8 @@ class DMRICompositeModel(SampleModelBuilder, DMRIOptimizable):
         self._logger = logging.getLogger(__name__)
         self._original_problem_data = None
         self.nmr_parameters_for_bic_calculation = self.get_nmr_estimable_parameters()
+        self._initial_proposal_state = None
+        self._initial_mh_state = None
 
     def set_problem_data(self, problem_data):
         """Overwrites the super implementation by adding a call to _prepare_problem_data() before the problem data is
@@ -154,6 +156,39 @@ class DMRICompositeModel(SampleModelBuilder, DMRIOptimizable):
                 #endif //GET_NEW_GRADIENT_RAW
             '''
 
+    def set_initial_sampling_states(self, proposal_state=None, mh_state=None):
+        """Set the proposal state and the Metropolis Hastings state with which the next sampling run starts.
+
+        Together with a starting point this allows continuing a previous sampling run. The states are used as given,
+        as such they should hold the states of only the problems in the current ``problems_to_analyze``.
+
+        Args:
+            proposal_state (ndarray): the proposal state to start with, set to None to use the default
+            mh_state (mot.cl_routines.sampling.metropolis_hastings.MHState): the Metropolis Hastings state to
+                start with, set to None to use the default
+        """
+        self._initial_proposal_state = proposal_state
+        self._initial_mh_state = mh_state
+
+    def get_proposal_state(self):
+        if self._initial_proposal_state is not None:
+            return self._initial_proposal_state
+        return super(DMRICompositeModel, self).get_proposal_state()
+
+    def get_metropolis_hastings_state(self):
+        if self._initial_mh_state is not None:
+            return self._initial_mh_state
+        return super(DMRICompositeModel, self).get_metropolis_hastings_state()
+
+    def get_parameter_sampling_statistics(self):
+        """Get the sampling statistics objects of the estimable parameters.
+
+        Returns:
+            dict: per parameter name the sampling statistics object used to summarize the samples of that parameter
+        """
+        return {'{}.{}'.format(m.name, p.name): p.sampling_statistics
+                for m, p in self._model_functions_info.get_estimable_parameters_list()}
+
     def _can_use_gradient_deviations(self):
         return self._problem_data.gradient_deviations is not None \
                and 'g' in list(self._get_protocol_data().keys())
@@ -1,6 +1,9 @@
 import glob
+import multiprocessing
 import os
 from contextlib import contextmanager
+from gzip import GzipFile
+from multiprocessing.pool import ThreadPool
 
 import nibabel as nib
 import numpy as np
@@ -80,7 +83,7 @@ def get_all_image_data(directory, map_names=None, deferred=True):
         return {k: v.get_data() for k, v in proxies.items()}
 
 
-def write_nifti(data, header, output_fname, affine=None, use_data_dtype=True, **kwargs):
+def write_nifti(data, header, output_fname, affine=None, use_data_dtype=True, compression_level=None, **kwargs):
     """Write data to a nifti file.
 
     Args:
@@ -91,6 +94,8 @@ def write_nifti(data, header, output_fname, affine=None, use_data_dtype=True, **
         affine (ndarray): the affine transformation matrix
         use_data_dtype (boolean): if we want to use the dtype from the data instead of that from the header
             when saving the nifti.
+        compression_level (int): the gzip compression level (1-9) to use when writing a .nii.gz file. If None we use
+            the NiBabel default.
         **kwargs: other arguments to Nifti1Image from NiBabel
     """
     @contextmanager
@@ -114,10 +119,63 @@ def write_nifti(data, header, output_fname, affine=None, use_data_dtype=True, **
         output_fname += '.nii.gz'
 
     with header_dtype() as header:
-        nib.Nifti1Image(data, affine, header, **kwargs).to_filename(output_fname)
+        image = nib.Nifti1Image(data, affine, header, **kwargs)
 
+        if compression_level is not None and output_fname.endswith('.gz'):
+            with GzipFile(output_fname, 'wb', compresslevel=int(compression_level)) as f:
+                image.to_file_map({'image': nib.FileHolder(filename=output_fname, fileobj=f)})
+        else:
+            image.to_filename(output_fname)
+
+
+def write_nifti_blocks(volume_blocks, shape, dtype, header, output_fname, compression_level=None):
+    """Write a four dimensional nifti file from blocks of volumes, without holding all the data in memory.
+
+    Since nifti files store the data in Fortran order, every volume (every index of the last dimension) is
+    a contiguous part of the file. This writes the header and then the given blocks of volumes one after another.
+
+    Args:
+        volume_blocks (iterable of ndarray): the (x, y, z, n) blocks of volumes, in order. The number of volumes of
+            all the blocks together should match the last dimension of the shape.
+        shape (tuple): the (x, y, z, t) shape of the complete data
+        dtype (np.dtype): the data type of the data
+        header (nibabel header): the nibabel header to use as header for the nifti file
+        output_fname (str): the name of the resulting nifti file, this function will append .nii.gz if no
+            suitable extension is given.
+        compression_level (int): the gzip compression level (1-9) to use when writing a .nii.gz file. If None we use
+            the NiBabel default.
+    """
+    if not (output_fname.endswith('.nii.gz') or output_fname.endswith('.nii')):
+        output_fname += '.nii.gz'
+
+    image = nib.Nifti1Image(np.zeros((1, 1, 1, 1), dtype=dtype), None, header)
+    image.update_header()
+
+    nifti_header = image.header
+    nifti_header.set_data_shape(shape)
+    nifti_header.set_data_dtype(dtype)
+    nifti_header.set_slope_inter(None, None)
+    data_dtype = nifti_header.get_data_dtype()
+
+    opener_kwargs = {}
+    if compression_level is not None and output_fname.endswith('.gz'):
+        opener_kwargs['compresslevel'] = int(compression_level)
+
+    nmr_volumes_written = 0
+    with nib.openers.Opener(output_fname, 'wb', **opener_kwargs) as f:
+        nifti_header.write_to(f)
+        f.write(b'\x00' * (int(nifti_header.get_data_offset()) - f.tell()))
+
+        for block in volume_blocks:
+            f.write(np.asarray(block, dtype=data_dtype).tobytes(order='F'))
+            nmr_volumes_written += block.shape[3]
 
-def write_all_as_nifti(volumes, directory, nifti_header, overwrite_volumes=True, gzip=True):
+    if nmr_volumes_written != shape[3]:
+        raise ValueError('Wrote {} volumes to the nifti file, expected {}.'.format(nmr_volumes_written, shape[3]))
+
+
+def write_all_as_nifti(volumes, directory, nifti_header, overwrite_volumes=True, gzip=True, compression_level=None,
+                       nmr_threads=1):
     """Write a number of volume maps to the specific directory.
 
     Args:
@@ -127,11 +185,16 @@ def write_all_as_nifti(volumes, directory, nifti_header, overwrite_volumes=True,
         nifti_header: the nifti header to use for each of the volumes
         overwrite_volumes (boolean): defaults to True, if we want to overwrite the volumes if they exists
         gzip (boolean): if True we write the files as .nii.gz, if False we write the files as .nii
+        compression_level (int): the gzip compression level (1-9), if None we use the NiBabel default
+        nmr_threads (int): the number of threads to use for writing the volumes. Since the compression releases
+            the GIL, this allows compressing multiple volumes concurrently.
     """
     if not os.path.exists(directory):
         os.makedirs(directory)
 
-    for key, volume in volumes.items():
+    def write_volume(key):
+        volume = volumes[key]
+
         extension = '.nii'
         if gzip:
             extension += '.gz'
@@ -142,9 +205,93 @@ def write_all_as_nifti(volumes, directory, nifti_header, overwrite_volumes=True,
         if os.path.exists(full_filename):
             if overwrite_volumes:
                 os.remove(full_filename)
-                write_nifti(volume, nifti_header, full_filename)
+                write_nifti(volume, nifti_header, full_filename, compression_level=compression_level)
         else:
-            write_nifti(volume, nifti_header, full_filename)
+            write_nifti(volume, nifti_header, full_filename, compression_level=compression_level)
+
+    map_threaded(write_volume, list(volumes.keys()), nmr_threads)
+
+
+class BackgroundNiftiWriter(object):
+
+    def __init__(self):
+        """Writes volumes to nifti files in a background thread.
+
+        This allows continuing with the computations while the (compressed) result files are being written.
+        Use :meth:`wait` to wait for the pending writes before reading the files. This can also be used as a context
+        manager, which waits for all the writes on exit.
+        """
+        self._pool = ThreadPool(1)
+        self._pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, volumes, directory, nifti_header, **kwargs):
+        """Schedule writing the given volumes, with the same arguments as :func:`write_all_as_nifti`.
+
+        The volumes are converted and written in the background thread, as such, the volumes dictionary can be a
+        deferred dictionary which only creates the volumes when requested.
+        """
+        self._pending.append((os.path.abspath(directory),
+                              self._pool.apply_async(write_all_as_nifti, (volumes, directory, nifti_header), kwargs)))
+
+    def wait(self, directory=None):
+        """Wait for the pending writes to finish.
+
+        Errors raised during writing are re-raised by this function.
+
+        Args:
+            directory (str): if given, we only wait for the volumes written to this directory
+        """
+        if directory is not None:
+            directory = os.path.abspath(directory)
+
+        to_wait = [el for el in self._pending if directory is None or el[0] == directory]
+        self._pending = [el for el in self._pending if el not in to_wait]
+
+        for _, result in to_wait:
+            result.get()
+
+    def close(self):
+        """Wait for all pending writes and stop the background thread."""
+        try:
+            self.wait()
+        finally:
+            self._pool.close()
+            self._pool.join()
+
+
+def map_threaded(func, items, nmr_threads):
+    """Apply the given function to all the given items using a pool of threads.
+
+    This is meant for I/O and compression bound work which releases the GIL.
+
+    Args:
+        func (func): the function to apply to every item
+        items (list): the items to process
+        nmr_threads (int): the number of threads to use. If None we use the number of CPU's, if one or lower
+            we process the items in the current thread.
+
+    Returns:
+        list: the results of the function for every item
+    """
+    if nmr_threads is None:
+        nmr_threads = multiprocessing.cpu_count()
+    nmr_threads = min(nmr_threads or 1, len(items))
+
+    if nmr_threads <= 1:
+        return list(map(func, items))
+
+    pool = ThreadPool(nmr_threads)
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
 
 
 def nifti_filepath_resolution(file_path):
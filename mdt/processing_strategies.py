@@ -1,21 +1,39 @@
 import glob
 import hashlib
+import json
 import logging
 import os
 import shutil
+import sys
+import threading
 import timeit
 from contextlib import contextmanager
 
+import six
+from six.moves import queue
+
 import numpy as np
 import time
 
+from mot.cl_routines.sampling.base import SimpleSampleOutput
+from mot.cl_routines.sampling.metropolis_hastings import MetropolisHastings, MHSampleOutput, SimpleMHState
+from mot.mcmc_diagnostics import minimum_multivariate_ess
 from mot.utils import results_to_dict
 import gc
 from numpy.lib.format import open_memmap
 
-from mdt.nifti import write_all_as_nifti, get_all_image_data
-from mdt.configuration import gzip_optimization_results, gzip_sampling_results
-from mdt.utils import create_roi, load_samples, post_process_samples, post_process_optimization
+from mdt.cl_program_cache import program_cache_context
+from mdt.nifti import write_all_as_nifti, map_threaded
+from mdt.configuration import gzip_optimization_results, gzip_sampling_results, get_tmp_results_storage, \
+    get_optimization_results_compression_level, get_sampling_results_compression_level, get_nmr_write_threads, \
+    get_sampling_streaming_settings, get_samples_storage_settings, get_sampling_adaptive_settings, \
+    get_sampling_post_processing_settings, get_sample_reduction_settings, get_sampling_multiple_chains_settings
+from mdt.deferred_mappings import DeferredActionDict
+from mdt.sample_statistics import OnlineSampleStatistics
+from mdt.sample_storage import CompressedSamples, SampleReduction, COMPRESSED_SAMPLES_EXTENSION
+from mdt.utils import create_roi, load_samples, post_process_samples, post_process_optimization, restore_volumes, \
+    post_process_sample_statistics, remove_sample_segments, \
+    calculate_sample_ess_maps, calculate_rhat_maps, create_process_pool
 
 __author__ = 'Robbert Harms'
 __date__ = "2016-07-29"
@@ -24,6 +42,7 @@ __email__ = "robbert.harms@maastrichtuniversity.nl"
 
 
 DEFAULT_TMP_RESULTS_SUBDIR_NAME = 'tmp_results'
+ROI_SPACE_SUBDIR_NAME = 'roi_space'
 
 
 class ModelProcessingStrategy(object):
@@ -153,32 +172,52 @@ class SimpleProcessingStrategy(ModelProcessingStrategy):
 
 class ChunksProcessingStrategy(SimpleProcessingStrategy):
 
+    def __init__(self, max_pending_chunks=1, **kwargs):
+        """Base class for the strategies that process the voxels in chunks generated by :meth:`_chunks_generator`.
+
+        The processing of every chunk is split in two parts, the computations which require the model to be set to the
+        voxels of that chunk (for example the optimization on the device and the post-processing depending on the
+        selected voxels) and the finalization of those results (for example writing the results to the temporary
+        storage). The finalization is done by a background thread such that it overlaps with the computations on the
+        next chunk.
+
+        Args:
+            max_pending_chunks (int): the maximum number of computed chunks waiting to be finalized by the background
+                thread. This bounds the memory used by the pipeline. Set to 0 to disable pipelining and process all
+                chunks synchronously.
+        """
+        super(ChunksProcessingStrategy, self).__init__(**kwargs)
+        self._max_pending_chunks = max_pending_chunks
+
     def run(self, model, problem_data, output_path, recalculate, worker_generator):
         """Compute all the slices using the implemented chunks generator"""
-        with self._tmp_storage_dir(output_path, recalculate) as tmp_storage_dir:
+        with self._tmp_storage_dir(output_path, recalculate) as tmp_storage_dir, program_cache_context():
             voxels_processed = 0
 
             worker = worker_generator.create_worker(model, problem_data, output_path,
                                                     tmp_storage_dir, self._honor_voxels_to_analyze,
                                                     clean_tmp_dir=self._auto_rm_tmp_dir)
+            try:
+                total_roi_indices = worker.get_voxels_to_compute()
+                if len(total_roi_indices):
 
-            total_roi_indices = worker.get_voxels_to_compute()
-            if len(total_roi_indices):
-
-                start_time = timeit.default_timer()
-                start_nmr_processed = (np.count_nonzero(problem_data.mask) - len(total_roi_indices))
+                    start_time = timeit.default_timer()
+                    start_nmr_processed = (np.count_nonzero(problem_data.mask) - len(total_roi_indices))
 
-                for chunk_indices in self._chunks_generator(model, problem_data, output_path, worker,
-                                                            total_roi_indices):
-                    with self._selected_indices(model, chunk_indices):
-                        self._run_on_chunk(problem_data, worker, chunk_indices, total_roi_indices,
-                                           voxels_processed, start_time, start_nmr_processed)
+                    with _ChunksPipeline(self._max_pending_chunks) as pipeline:
+                        for chunk_indices in self._chunks_generator(model, problem_data, output_path, worker,
+                                                                    total_roi_indices):
+                            with self._selected_indices(model, chunk_indices):
+                                self._run_on_chunk(problem_data, worker, chunk_indices, total_roi_indices,
+                                                   voxels_processed, start_time, start_nmr_processed, pipeline)
 
-                    voxels_processed += len(chunk_indices)
-                    gc.collect()
+                            voxels_processed += len(chunk_indices)
+                            gc.collect()
 
-            self._logger.info('Computed all voxels, now creating nifti\'s')
-            return_data = worker.combine()
+                self._logger.info('Computed all voxels, now creating nifti\'s')
+                return_data = worker.combine()
+            finally:
+                worker.close()
 
         return return_data
 
@@ -191,8 +230,12 @@ class ChunksProcessingStrategy(SimpleProcessingStrategy):
         raise NotImplementedError
 
     def _run_on_chunk(self, problem_data, worker, voxel_indices, voxels_to_process, voxels_processed, start_time,
-                      start_nmr_processed):
-        """Run the worker on the given chunk."""
+                      start_nmr_processed, pipeline):
+        """Run the worker on the given chunk.
+
+        This runs the computations of the worker in the current thread and hands the finalization of the results
+        over to the given pipeline.
+        """
         total_nmr_voxels = np.count_nonzero(problem_data.mask)
         total_processed = (total_nmr_voxels - len(voxels_to_process)) + voxels_processed
 
@@ -212,7 +255,69 @@ class ChunksProcessingStrategy(SimpleProcessingStrategy):
                                  time.strftime('%H:%M:%S', time.gmtime(run_time)),
                                  time.strftime('%H:%M:%S', time.gmtime(remaining_time)) if remaining_time else '?'))
 
-        worker.process(voxel_indices)
+        computed = worker.compute(voxel_indices)
+        pipeline.submit(worker.finalize, voxel_indices, computed)
+
+
+class _ChunksPipeline(object):
+
+    def __init__(self, max_pending_chunks):
+        """Runs the finalization of the processed chunks in a background thread.
+
+        Use this as a context manager, on exit we wait until all submitted chunks are finalized. Exceptions raised
+        in the background thread are re-raised in the calling thread at the next submit or on exit.
+
+        Args:
+            max_pending_chunks (int): the maximum number of chunks waiting to be finalized. If zero, every submitted
+                chunk is finalized directly in the calling thread.
+        """
+        self._max_pending_chunks = max_pending_chunks
+        self._queue = None
+        self._thread = None
+        self._exc_info = None
+
+    def __enter__(self):
+        if self._max_pending_chunks > 0:
+            self._queue = queue.Queue(maxsize=self._max_pending_chunks)
+            self._thread = threading.Thread(target=self._finalize_chunks, name='mdt-chunks-finalizer')
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+        if exc_type is None:
+            self._raise_background_exception()
+
+    def submit(self, finalize_func, *args):
+        """Finalize a chunk using the given function and arguments.
+
+        This blocks if the maximum number of chunks are already waiting to be finalized.
+
+        Args:
+            finalize_func (func): the function to call on the given arguments
+            *args: the arguments to the finalize function
+        """
+        self._raise_background_exception()
+
+        if self._thread is None:
+            finalize_func(*args)
+        else:
+            self._queue.put((finalize_func, args))
+
+    def _finalize_chunks(self):
+        for finalize_func, args in iter(self._queue.get, None):
+            if self._exc_info is None:
+                try:
+                    finalize_func(*args)
+                except Exception:
+                    self._exc_info = sys.exc_info()
+
+    def _raise_background_exception(self):
+        if self._exc_info is not None:
+            six.reraise(*self._exc_info)
 
 
 class ModelProcessingWorkerCreator(object):
@@ -271,6 +376,7 @@ class ModelProcessingWorker(object):
                 for things like memory mapping.
         """
         self._write_volumes_gzipped = True
+        self._compression_level = None
         self._used_mask_name = 'UsedMask'
         self._model = model
         self._problem_data = problem_data
@@ -294,6 +400,36 @@ class ModelProcessingWorker(object):
         """
         raise NotImplementedError()
 
+    def compute(self, roi_indices):
+        """Run the part of the processing that requires the model to be set to the indicated voxels.
+
+        Processing strategies may call this function followed by :meth:`finalize` instead of calling :meth:`process`.
+        This allows them to finalize the results of one chunk in parallel with the computations on the next chunk.
+        By default this calls :meth:`process`.
+
+        Args:
+            roi_indices (ndarray): The list of roi indices we want to compute
+
+        Returns:
+            the intermediate results, to be given to :meth:`finalize`
+        """
+        return self.process(roi_indices)
+
+    def finalize(self, roi_indices, computed):
+        """Finalize the intermediate results of :meth:`compute`, for example by post-processing and storing them.
+
+        This function should not depend on the voxels selected in the model, since the model may already be
+        processing the next chunk at the moment this is called.
+
+        Args:
+            roi_indices (ndarray): The list of roi indices we computed
+            computed: the intermediate results from :meth:`compute`
+
+        Returns:
+            the results for this single processing step
+        """
+        return computed
+
     def get_voxels_to_compute(self):
         """Get the ROI indices of the voxels we need to compute.
 
@@ -313,6 +449,13 @@ class ModelProcessingWorker(object):
         """
         raise NotImplementedError()
 
+    def close(self):
+        """Release the resources held by this worker, for example a pool of processes.
+
+        The processing strategies call this at the end of the processing, also if the processing failed.
+        """
+        pass
+
 
 class SimpleModelProcessingWorker(ModelProcessingWorker):
 
@@ -325,15 +468,31 @@ class SimpleModelProcessingWorker(ModelProcessingWorker):
         """
         super(SimpleModelProcessingWorker, self).__init__(*args)
         self._volume_indices = self._create_roi_to_volume_index_lookup_table()
+        self._store_in_roi_space = get_tmp_results_storage() == 'roi'
+        self._checkpoints = ChunksCheckpointManifest(
+            os.path.join(self._tmp_storage_dir, '_checkpoint_manifest.json'), self._volume_indices.shape[0])
 
     def process(self, roi_indices):
-        """Process the indicated voxels in the way prescribed by this worker.
+        return self.finalize(roi_indices, self.compute(roi_indices))
 
-        Since the processing strategy can use all voxels to do the analysis in one go, this function
-        should return all the output it can, i.e. the same kind of output as from the function :meth:`combine`.
+    def compute(self, roi_indices):
+        raise NotImplementedError()
+
+    def finalize(self, roi_indices, computed):
+        results = self._store_results(roi_indices, computed)
+        self._checkpoints.commit(roi_indices)
+        return results
+
+    def _store_results(self, roi_indices, computed):
+        """Store the intermediate results of the indicated voxels.
+
+        Since this is called from :meth:`finalize`, this should not depend on the voxels selected in the model.
+        After this function returns, the voxels are committed in the checkpoint manifest. As such, all the maps
+        written should be registered with the checkpoint manifest using :meth:`ChunksCheckpointManifest.record`.
 
         Args:
-            roi_indices (ndarray): The list of roi indices we want to compute
+            roi_indices (ndarray): The list of roi indices we computed
+            computed: the intermediate results from :meth:`compute`
 
         Returns:
             the results for this single processing step
@@ -346,16 +505,66 @@ class SimpleModelProcessingWorker(ModelProcessingWorker):
         else:
             roi_list = np.arange(0, np.count_nonzero(self._problem_data.mask))
 
-        mask_path = os.path.join(self._tmp_storage_dir, '{}.npy'.format(self._used_mask_name))
-        if os.path.exists(mask_path):
-            return roi_list[np.logical_not(np.squeeze(create_roi(np.load(mask_path, mmap_mode='r'),
-                                                                 self._problem_data.mask)[roi_list]))]
+        used_mask = self._get_used_roi_mask(self._tmp_storage_dir)
+        if used_mask is not None:
+            return roi_list[np.logical_not(used_mask[roi_list])]
         return roi_list
 
     def combine(self):
         del self._volume_indices
         os.remove(self._roi_lookup_path)
 
+    def _get_used_roi_mask(self, tmp_dir):
+        """Get the mask of the voxels for which results are stored in the temporary storage.
+
+        This uses the voxels committed in the checkpoint manifest. If there is no manifest we fall back on the
+        used mask in the given temporary directory.
+
+        Args:
+            tmp_dir (str): the directory with the used mask, used if there is no checkpoint manifest
+
+        Returns:
+            ndarray or None: a boolean array in ROI space with the voxels already processed, or None if there are no
+                results stored yet.
+        """
+        committed = self._checkpoints.get_committed_roi_indices(self._read_stored_rows)
+        if committed is not None:
+            used_mask = np.zeros(self._volume_indices.shape[0], dtype=np.bool)
+            used_mask[committed] = True
+            return used_mask
+
+        if self._store_in_roi_space:
+            mask_path = os.path.join(tmp_dir, ROI_SPACE_SUBDIR_NAME, '{}.npy'.format(self._used_mask_name))
+            if os.path.exists(mask_path):
+                return np.load(mask_path, mmap_mode='r')
+        else:
+            mask_path = os.path.join(tmp_dir, '{}.npy'.format(self._used_mask_name))
+            if os.path.exists(mask_path):
+                return np.squeeze(create_roi(np.load(mask_path, mmap_mode='r'), self._problem_data.mask))
+        return None
+
+    def _read_stored_rows(self, path, space, roi_indices):
+        """Read the stored values of the given voxels from one of the memory mapped result files.
+
+        Args:
+            path (str): the path to the .npy file, or to the index of a compressed samples store
+            space (str): 'volume' if the file holds a volume, 'roi' if it holds one row per voxel in the mask,
+                'compressed' if it is the index of a compressed samples store, of which we read the stored (compressed)
+                data, see :meth:`~mdt.sample_storage.CompressedSamples.get_stored_bytes`
+            roi_indices (ndarray): the voxels we want to read
+
+        Returns:
+            ndarray: the rows of the given voxels
+        """
+        if space == 'compressed':
+            return CompressedSamples(os.path.dirname(path)).get_stored_bytes(roi_indices)
+
+        data = np.load(path, mmap_mode='r')
+        if space == 'volume':
+            volume_indices = self._volume_indices[roi_indices, :]
+            return data[volume_indices[:, 0], volume_indices[:, 1], volume_indices[:, 2]]
+        return data[_get_roi_selection(roi_indices)]
+
     def _write_volumes(self, roi_indices, results, tmp_dir):
         """Write the result arrays to the temporary storage
 
@@ -364,10 +573,15 @@ class SimpleModelProcessingWorker(ModelProcessingWorker):
             results (dict): the dictionary with the results to save
             tmp_dir (str): the directory to save the intermediate results to
         """
+        if self._store_in_roi_space:
+            self._write_roi_arrays(roi_indices, results, os.path.join(tmp_dir, ROI_SPACE_SUBDIR_NAME))
+            return
+
         if not os.path.exists(tmp_dir):
             os.makedirs(tmp_dir)
 
         volume_indices = self._volume_indices[roi_indices, :]
+        block = _get_dense_block(volume_indices, self._problem_data.mask.shape)
 
         for param_name, result_array in results.items():
             storage_path = os.path.join(tmp_dir, param_name + '.npy')
@@ -383,14 +597,44 @@ class SimpleModelProcessingWorker(ModelProcessingWorker):
                 mode = 'r+'
             tmp_matrix = open_memmap(storage_path, mode=mode, dtype=result_array.dtype,
                                      shape=self._problem_data.mask.shape[0:3] + (map_4d_dim_len,))
-            tmp_matrix[volume_indices[:, 0], volume_indices[:, 1], volume_indices[:, 2]] = result_array
+            _write_to_block(tmp_matrix, volume_indices, block, result_array)
+            self._checkpoints.record(storage_path, 'volume', tmp_matrix,
+                                     tmp_matrix[volume_indices[:, 0], volume_indices[:, 1], volume_indices[:, 2]])
 
         mask_path = os.path.join(tmp_dir, '{}.npy'.format(self._used_mask_name))
         mode = 'w+'
         if os.path.isfile(mask_path):
             mode = 'r+'
         tmp_mask = open_memmap(mask_path, mode=mode, dtype=np.bool, shape=self._problem_data.mask.shape)
-        tmp_mask[volume_indices[:, 0], volume_indices[:, 1], volume_indices[:, 2]] = True
+        _write_to_block(tmp_mask, volume_indices, block, True)
+
+    def _write_roi_arrays(self, roi_indices, results, roi_dir):
+        """Write the result arrays in ROI space to the temporary storage.
+
+        Instead of a whole volume, every map is stored as an array with one row per voxel in the mask. These are
+        only expanded to whole volumes when combining the results.
+
+        Args:
+            roi_indices (ndarray): the indices of the voxels we computed
+            results (dict): the dictionary with the results to save
+            roi_dir (str): the directory to save the intermediate results to
+        """
+        if not os.path.exists(roi_dir):
+            os.makedirs(roi_dir)
+
+        nmr_roi_voxels = self._volume_indices.shape[0]
+        roi_selection = _get_roi_selection(roi_indices)
+
+        for param_name, result_array in results.items():
+            if len(result_array.shape) == 1:
+                result_array = np.reshape(result_array, (-1, 1))
+
+            _write_roi_array(os.path.join(roi_dir, param_name + '.npy'), result_array.dtype,
+                             (nmr_roi_voxels, result_array.shape[1]), roi_selection, result_array,
+                             checkpoints=self._checkpoints)
+
+        _write_roi_array(os.path.join(roi_dir, '{}.npy'.format(self._used_mask_name)), np.bool,
+                         (nmr_roi_voxels,), roi_selection, True)
 
     def _combine_volumes(self, output_dir, tmp_storage_dir, volume_header, maps_subdir=''):
         """Combine volumes found in subdirectories to a final volume.
@@ -408,16 +652,50 @@ class SimpleModelProcessingWorker(ModelProcessingWorker):
         if not os.path.exists(os.path.join(output_dir, maps_subdir)):
             os.makedirs(os.path.join(output_dir, maps_subdir))
 
+        chunks_dir = os.path.join(tmp_storage_dir, maps_subdir)
+        roi_mask = None
+        if self._store_in_roi_space:
+            chunks_dir = os.path.join(chunks_dir, ROI_SPACE_SUBDIR_NAME)
+            roi_mask = self._problem_data.mask
+
         map_names = list(map(lambda p: os.path.splitext(os.path.basename(p))[0],
-                             glob.glob(os.path.join(tmp_storage_dir, maps_subdir, '*.npy'))))
+                             glob.glob(os.path.join(chunks_dir, '*.npy'))))
 
-        basic_info = (os.path.join(tmp_storage_dir, maps_subdir),
+        basic_info = (chunks_dir,
                       os.path.join(output_dir, maps_subdir),
                       volume_header,
-                      self._write_volumes_gzipped)
+                      self._write_volumes_gzipped,
+                      self._compression_level,
+                      roi_mask)
         info_list = [(map_name, basic_info) for map_name in map_names]
 
-        list(map(_combine_volumes_write_out, info_list))
+        map_threaded(_combine_volumes_write_out, info_list, get_nmr_write_threads())
+
+    def _load_roi_results(self, tmp_storage_dir, maps_subdir=''):
+        """Load the stored intermediate results in ROI space into memory.
+
+        Args:
+            tmp_storage_dir (str): the directory with the temporary results
+            maps_subdir (str): the subdirectory in the tmp storage directory with the results to load
+
+        Returns:
+            dict: the loaded ROI arrays, each of shape (voxels, k), by map name
+        """
+        chunks_dir = os.path.join(tmp_storage_dir, maps_subdir)
+        if self._store_in_roi_space:
+            chunks_dir = os.path.join(chunks_dir, ROI_SPACE_SUBDIR_NAME)
+
+        results = {}
+        for path in glob.glob(os.path.join(chunks_dir, '*.npy')):
+            map_name = os.path.splitext(os.path.basename(path))[0]
+            if self._store_in_roi_space:
+                data = np.array(np.load(path, mmap_mode='r'))
+                if len(data.shape) == 1:
+                    data = np.expand_dims(data, axis=1)
+            else:
+                data = create_roi(np.load(path, mmap_mode='r'), self._problem_data.mask)
+            results[map_name] = data
+        return results
 
     def _create_roi_to_volume_index_lookup_table(self):
         """Creates and returns a lookup table for roi index -> volume index.
@@ -445,48 +723,450 @@ class SimpleModelProcessingWorker(ModelProcessingWorker):
         return np.load(self._roi_lookup_path, mmap_mode='r')
 
 
+def _get_dense_block(volume_indices, volume_shape, max_overhead=4):
+    """Get the range over the first dimension of the volume that contains all the given voxels.
+
+    Since the volumes are stored in C order, such a range of slices is one contiguous region in the memory mapped
+    files. Writing this region as a whole is much cheaper than scattering the voxels through the file one by one.
+
+    Args:
+        volume_indices (ndarray): the (n, 3) array with the volume indices of the voxels we want to write
+        volume_shape (tuple): the shape of the volume
+        max_overhead (int): the maximum ratio of the number of voxels in the block to the number of voxels
+            we write. If the block would be larger than this, we return None.
+
+    Returns:
+        slice or None: the slice over the first dimension containing all the voxels, or None if there is no suitable
+            dense block.
+    """
+    if not len(volume_indices):
+        return None
+
+    start = int(np.min(volume_indices[:, 0]))
+    end = int(np.max(volume_indices[:, 0])) + 1
+
+    block_size = (end - start) * int(np.prod(volume_shape[1:3]))
+    if block_size > max_overhead * len(volume_indices) + int(np.prod(volume_shape[1:3])):
+        return None
+    return slice(start, end)
+
+
+def _write_to_block(memmap, volume_indices, block, values):
+    """Write the given values at the given volume indices in the given memory mapped array.
+
+    If a block is given we read that block, place the values in memory and write the block back in one go.
+
+    Args:
+        memmap (ndarray): the memory mapped array to write to
+        volume_indices (ndarray): the (n, 3) array with the volume indices of the voxels
+        block (slice or None): the slice over the first dimension containing all the voxels, from
+            :func:`_get_dense_block`
+        values (ndarray or scalar): the values to write
+    """
+    if block is None:
+        memmap[volume_indices[:, 0], volume_indices[:, 1], volume_indices[:, 2]] = values
+    else:
+        dense = np.array(memmap[block])
+        dense[volume_indices[:, 0] - block.start, volume_indices[:, 1], volume_indices[:, 2]] = values
+        memmap[block] = dense
+
+
+def _get_roi_selection(roi_indices):
+    """Get the index to use for selecting the given ROI indices in an array in ROI space.
+
+    Args:
+        roi_indices (ndarray): the ROI indices we want to select
+
+    Returns:
+        slice or ndarray: a slice if the indices are a contiguous range, else the indices themselves
+    """
+    if len(roi_indices) and roi_indices[-1] - roi_indices[0] + 1 == len(roi_indices) \
+            and np.all(np.diff(roi_indices) == 1):
+        return slice(int(roi_indices[0]), int(roi_indices[-1]) + 1)
+    return roi_indices
+
+
+def _write_roi_array(path, dtype, shape, roi_selection, values, checkpoints=None):
+    """Write the given values to the given selection of the memory mapped ROI array at the given path.
+
+    Args:
+        path (str): the path to the .npy file, created if it does not exist yet
+        dtype (np.dtype): the data type of the array
+        shape (tuple): the shape of the entire array
+        roi_selection (slice or ndarray): the rows to write to
+        values (ndarray or scalar): the values to write
+        checkpoints (ChunksCheckpointManifest): if given, we record the written rows in this checkpoint manifest
+    """
+    mode = 'w+'
+    if os.path.isfile(path):
+        mode = 'r+'
+    roi_array = open_memmap(path, mode=mode, dtype=dtype, shape=shape)
+    roi_array[roi_selection] = values
+    if checkpoints is not None:
+        checkpoints.record(path, 'roi', roi_array, roi_array[roi_selection])
+    del roi_array  # flushes and closes the memmap
+
+
+def _restore_roi_array(data, mask):
+    """Restore an array written by :meth:`SimpleModelProcessingWorker._write_roi_arrays` to a volume.
+
+    This returns volumes of the same shape as the volumes written in volume space, that is, three dimensional
+    volumes for the one dimensional arrays (like the used mask) and four dimensional volumes for the maps.
+
+    Args:
+        data (ndarray): the array in ROI space
+        mask (ndarray): the mask in use
+
+    Returns:
+        ndarray: the data as a volume
+    """
+    if len(data.shape) == 1:
+        return restore_volumes(np.asarray(data), mask, with_volume_dim=False)
+    if data.shape[1] == 1:
+        return restore_volumes(np.asarray(data[:, 0]), mask, with_volume_dim=True)
+    return restore_volumes(np.asarray(data), mask, with_volume_dim=True)
+
+
+def _get_chain_state(sampling_output):
+    """Get the state at the end of the chains of the given sampling output.
+
+    Returns:
+        tuple: the current chain position, the proposal state and the MH state
+    """
+    return (sampling_output.get_current_chain_position(), sampling_output.get_proposal_state(),
+            sampling_output.get_mh_state())
+
+
+def _get_problem_bounds(bounds, problems):
+    """Get the bounds of the given problems as a (problems, parameters) matrix.
+
+    Args:
+        bounds (list): per parameter the bound, either a scalar or a value per problem
+        problems (ndarray): the indices of the problems we want the bounds of
+
+    Returns:
+        ndarray: the bounds per problem and parameter
+    """
+    problem_bounds = []
+    for bound in bounds:
+        bound = np.asarray(bound, dtype=np.float64)
+        if bound.ndim:
+            bound = np.reshape(bound, (bound.shape[0], -1))[problems, 0]
+        problem_bounds.append(np.broadcast_to(bound, (len(problems),)))
+    return np.stack(problem_bounds, axis=1)
+
+
+def _select_chain_state(chain_state, problems):
+    """Select the given problems from the given chain state.
+
+    Args:
+        chain_state (tuple): the chain state as returned by :func:`_get_chain_state`
+        problems (ndarray): the indices (or a boolean mask) of the problems to select
+
+    Returns:
+        tuple: the chain state of only the given problems
+    """
+    chain_position, proposal_state, mh_state = chain_state
+    return (chain_position[problems], proposal_state[problems],
+            SimpleMHState(mh_state.nmr_samples_drawn,
+                          mh_state.get_proposal_state_sampling_counter()[problems],
+                          mh_state.get_proposal_state_acceptance_counter()[problems],
+                          mh_state.get_online_parameter_variance()[problems],
+                          mh_state.get_online_parameter_variance_update_m2()[problems],
+                          mh_state.get_online_parameter_mean()[problems],
+                          mh_state.get_rng_state()[problems]))
+
+
+def _combine_chain_states(chain_states, order):
+    """Combine the chain states of separate groups of problems into one sampling output without samples.
+
+    Since the number of samples drawn is stored as a single value, the combined MH state uses the largest number of
+    samples drawn of the given states.
+
+    Args:
+        chain_states (list of tuple): the chain states to concatenate
+        order (ndarray): the order in which to place the problems of the concatenated states
+
+    Returns:
+        MHSampleOutput: the sampling output with the combined chain states and no samples
+    """
+    def combine(items):
+        return np.concatenate(items)[order]
+
+    mh_states = [state[2] for state in chain_states]
+    mh_state = SimpleMHState(
+        max(state.nmr_samples_drawn for state in mh_states),
+        combine([state.get_proposal_state_sampling_counter() for state in mh_states]),
+        combine([state.get_proposal_state_acceptance_counter() for state in mh_states]),
+        combine([state.get_online_parameter_variance() for state in mh_states]),
+        combine([state.get_online_parameter_variance_update_m2() for state in mh_states]),
+        combine([state.get_online_parameter_mean() for state in mh_states]),
+        combine([state.get_rng_state() for state in mh_states]))
+
+    return MHSampleOutput(None, combine([state[1] for state in chain_states]), mh_state,
+                          combine([state[0] for state in chain_states]))
+
+
+class ChunksCheckpointManifest(object):
+
+    def __init__(self, manifest_path, nmr_roi_voxels):
+        """Keeps track of the chunks of which the results are completely and safely stored.
+
+        While storing the results of a chunk, every map written is registered using :meth:`record`, which flushes the
+        map to disk and computes a checksum of the rows written. After all maps are written, :meth:`commit` adds the
+        chunk to the manifest. The manifest is replaced atomically, as such, after a crash the manifest only lists
+        chunks of which all the results were written to disk.
+
+        On resume, :meth:`get_committed_roi_indices` verifies the checksums of the committed chunks against the stored
+        data and returns the voxels that do not need to be processed again.
+
+        Args:
+            manifest_path (str): the path to the manifest file
+            nmr_roi_voxels (int): the number of voxels in the mask, used to check that the manifest applies
+        """
+        self._manifest_path = manifest_path
+        self._nmr_roi_voxels = int(nmr_roi_voxels)
+        self._logger = logging.getLogger(__name__)
+        self._chunks = None
+        self._pending_maps = {}
+
+    def record(self, path, space, memmap, rows):
+        """Flush the given memory mapped file and record the checksum of the rows written for the current chunk.
+
+        Args:
+            path (str): the path to the memory mapped file
+            space (str): 'volume' if the file holds a volume, 'roi' if it holds one row per voxel in the mask,
+                'compressed' if it is the index of a compressed samples store
+            memmap (ndarray): the memory mapped array we have written to
+            rows (ndarray): the values of the voxels written, as read back from the memory mapped array, or for
+                compressed samples the data stored for the voxels written
+        """
+        memmap.flush()
+        _fsync_file(path)
+        self._pending_maps[os.path.abspath(path)] = {'space': space, 'checksum': _rows_checksum(rows)}
+
+    def commit(self, roi_indices):
+        """Commit the current chunk with all the maps recorded since the last commit.
+
+        Args:
+            roi_indices (ndarray): the voxels of this chunk
+        """
+        chunks = self._get_chunks()
+        chunks.append({'id': max([c['id'] for c in chunks] or [-1]) + 1,
+                       'nmr_voxels': len(roi_indices),
+                       'voxel_ranges': _indices_to_ranges(roi_indices),
+                       'maps': self._pending_maps})
+        self._pending_maps = {}
+        self._write_manifest(chunks)
+
+    def get_committed_roi_indices(self, read_stored_rows):
+        """Get the voxels of all the committed chunks of which the stored data matches the recorded checksums.
+
+        Chunks of which the stored data does not match are removed from the manifest.
+
+        Args:
+            read_stored_rows (func): function called as ``read_stored_rows(path, space, roi_indices)`` returning the
+                stored rows of the given voxels
+
+        Returns:
+            ndarray or None: the committed voxels, or None if there is no manifest
+        """
+        if not os.path.isfile(self._manifest_path):
+            return None
+
+        verified = []
+        for chunk in self._get_chunks():
+            roi_indices = _ranges_to_indices(chunk['voxel_ranges'])
+            if self._verify_chunk(chunk, roi_indices, read_stored_rows):
+                verified.append(chunk)
+            else:
+                self._logger.warning('The stored results of the checkpointed chunk {} do not match the manifest, '
+                                     'this chunk will be recomputed.'.format(chunk['id']))
+
+        if len(verified) != len(self._chunks):
+            self._write_manifest(verified)
+
+        if not verified:
+            return np.array([], dtype=np.int64)
+        return np.concatenate([_ranges_to_indices(chunk['voxel_ranges']) for chunk in verified])
+
+    def _verify_chunk(self, chunk, roi_indices, read_stored_rows):
+        for path, info in chunk['maps'].items():
+            if not os.path.isfile(path):
+                return False
+            try:
+                if _rows_checksum(read_stored_rows(path, info['space'], roi_indices)) != info['checksum']:
+                    return False
+            except (IOError, ValueError, IndexError):
+                return False
+        return True
+
+    def _get_chunks(self):
+        if self._chunks is None:
+            self._chunks = self._read_manifest()
+        return self._chunks
+
+    def _read_manifest(self):
+        if not os.path.isfile(self._manifest_path):
+            return []
+
+        try:
+            with open(self._manifest_path, 'r') as f:
+                manifest = json.load(f)
+        except ValueError:
+            self._logger.warning('Could not read the checkpoint manifest, all voxels will be recomputed.')
+            return []
+
+        if manifest.get('nmr_roi_voxels') != self._nmr_roi_voxels:
+            self._logger.warning('The checkpoint manifest was created with a different mask, '
+                                 'all voxels will be recomputed.')
+            return []
+        return manifest.get('chunks', [])
+
+    def _write_manifest(self, chunks):
+        """Atomically replace the manifest with one listing the given chunks."""
+        self._chunks = chunks
+
+        tmp_path = self._manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': 1, 'nmr_roi_voxels': self._nmr_roi_voxels, 'chunks': chunks}, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        if hasattr(os, 'replace'):
+            os.replace(tmp_path, self._manifest_path)
+        else:
+            if os.name == 'nt' and os.path.exists(self._manifest_path):
+                os.remove(self._manifest_path)
+            os.rename(tmp_path, self._manifest_path)
+
+        if hasattr(os, 'O_DIRECTORY'):
+            dir_fd = os.open(os.path.dirname(os.path.abspath(self._manifest_path)), os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+
+def _fsync_file(path):
+    """Make sure the content of the given file is written to disk."""
+    fd = os.open(path, os.O_RDWR)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _rows_checksum(rows):
+    """Compute the checksum of the given array."""
+    return hashlib.sha1(np.ascontiguousarray(rows).tobytes()).hexdigest()
+
+
+def _indices_to_ranges(indices):
+    """Compress a list of indices into a list of [start, end) ranges of consecutive indices.
+
+    Args:
+        indices (ndarray): the indices to compress
+
+    Returns:
+        list: list of [start, end) pairs, reproducing the given indices in the same order
+    """
+    indices = np.asarray(indices)
+    if not len(indices):
+        return []
+
+    breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+    starts = np.concatenate(([0], breaks))
+    ends = np.concatenate((breaks, [len(indices)]))
+    return [[int(indices[start]), int(indices[end - 1]) + 1] for start, end in zip(starts, ends)]
+
+
+def _ranges_to_indices(ranges):
+    """The inverse of :func:`_indices_to_ranges`."""
+    if not ranges:
+        return np.array([], dtype=np.int64)
+    return np.concatenate([np.arange(start, end) for start, end in ranges])
+
+
 def _combine_volumes_write_out(info_pair):
     """Write out the given information to a nifti volume.
 
     Needs to be used by ModelProcessingWorker._combine_volumes
     """
     map_name, info_list = info_pair
-    chunks_dir, output_dir, volume_header, write_gzipped = info_list
+    chunks_dir, output_dir, volume_header, write_gzipped, compression_level, roi_mask = info_list
 
     data = np.load(os.path.join(chunks_dir, map_name + '.npy'), mmap_mode='r')
-    write_all_as_nifti({map_name: data}, output_dir, volume_header, gzip=write_gzipped)
+    if roi_mask is not None:
+        data = _restore_roi_array(data, roi_mask)
+    write_all_as_nifti({map_name: data}, output_dir, volume_header, gzip=write_gzipped,
+                       compression_level=compression_level)
+
+
+def roi_results_to_volumes(roi_results, mask, three_dimensional=('UsedMask',)):
+    """Get a deferred dictionary restoring the given ROI results to volumes.
+
+    Args:
+        roi_results (dict): the results in ROI space, by map name
+        mask (ndarray): the mask in use
+        three_dimensional (tuple of str): the names of the maps to restore to three dimensional volumes instead of
+            four dimensional volumes
+
+    Returns:
+        DeferredActionDict: the results as volumes, restored when requested
+    """
+    return DeferredActionDict(
+        lambda key, value: restore_volumes(value, mask, with_volume_dim=key not in three_dimensional), roi_results)
 
 
 class FittingProcessingWorker(SimpleModelProcessingWorker):
 
-    def __init__(self, optimizer, *args):
+    def __init__(self, optimizer, volumes_writer, *args):
         """The processing worker for model fitting.
 
         Use this if you want to use the model processing strategy to do model fitting.
 
         Args:
             optimizer: the optimization routine to use
+            volumes_writer (:class:`~mdt.nifti.BackgroundNiftiWriter`): if given we use this writer to write the
+                result volumes in the background. If None we write the volumes directly.
         """
         super(FittingProcessingWorker, self).__init__(*args)
         self._optimizer = optimizer
+        self._volumes_writer = volumes_writer
         self._write_volumes_gzipped = gzip_optimization_results()
+        self._compression_level = get_optimization_results_compression_level()
         self._logger = logging.getLogger(__name__)
 
-    def process(self, roi_indices):
+    def compute(self, roi_indices):
         optimization_results = self._optimizer.minimize(self._model)
 
+        # the post-processing depends on the voxels selected in the model, as such we can not defer it to finalize
         self._logger.info('Starting optimization post-processing')
         results = post_process_optimization(self._model, optimization_results)
         self._logger.info('Finished optimization post-processing')
+        return results
 
+    def _store_results(self, roi_indices, results):
         self._write_volumes(roi_indices, results, self._tmp_storage_dir)
         return results
 
     def combine(self):
         super(FittingProcessingWorker, self).combine()
 
-        self._combine_volumes(self._output_dir, self._tmp_storage_dir, self._problem_data.volume_header)
-        return create_roi(get_all_image_data(self._output_dir), self._problem_data.mask)
+        results = self._load_roi_results(self._tmp_storage_dir)
+
+        volumes = roi_results_to_volumes(results, self._problem_data.mask, three_dimensional=(self._used_mask_name,))
+        write_arguments = (volumes, self._output_dir, self._problem_data.volume_header)
+        write_kwargs = dict(gzip=self._write_volumes_gzipped, compression_level=self._compression_level,
+                            nmr_threads=get_nmr_write_threads())
+
+        if self._volumes_writer is None:
+            write_all_as_nifti(*write_arguments, **write_kwargs)
+        else:
+            self._volumes_writer.write(*write_arguments, **write_kwargs)
+
+        return results
 
 
 class SamplingProcessingWorker(SimpleModelProcessingWorker):
@@ -494,7 +1174,7 @@ class SamplingProcessingWorker(SimpleModelProcessingWorker):
     class SampleChainNotStored(object):
         pass
 
-    def __init__(self, sampler, store_samples=False, store_volume_maps=True, *args):
+    def __init__(self, sampler, store_samples=False, store_volume_maps=True, chain_state=None, nmr_chains=1, *args):
         """The processing worker for model sampling.
 
         Use this if you want to use the model processing strategy to do model sampling.
@@ -504,14 +1184,40 @@ class SamplingProcessingWorker(SimpleModelProcessingWorker):
             store_samples (boolean): if set to False we will store none of the samples. Use this
                 if you are only interested in the volume maps and not in the entire sample chain.
                 If set to True the process and combine function will no longer return any results.
+                If the samples are not stored, and streaming is enabled in the configuration, we sample in blocks
+                and compute the statistics online such that the full chains are never held in memory.
+                If the samples are stored, they are first reduced as configured for this model in the sample
+                reduction settings, see :func:`~mdt.configuration.get_sample_reduction_settings`.
             store_volume_maps (boolean): if we want to store the elements in the 'volume_maps' directory.
                 This stores the mean and std maps and some other maps based on the samples.
+            chain_state (mdt.model_sampling.SamplingChainState): if given, we continue the chains from this state
+                of a previous sampling run, without burn-in.
+            nmr_chains (int): the number of independent chains per voxel. Multiple chains are sampled together as
+                one set of problems. The samples of every chain are stored as a separate (voxels, samples) matrix,
+                the first chain in the output directory and every other chain in a ``chain_<index>`` subdirectory.
+                The R-hat and split R-hat maps are added to the volume maps.
+                The statistics are computed over the samples of all chains, the ESS is summed over the chains and
+                the stored chain state is that of the first chain.
         """
         super(SamplingProcessingWorker, self).__init__(*args)
         self._sampler = sampler
+        self._chain_state = chain_state
         self._write_volumes_gzipped = gzip_sampling_results()
+        self._compression_level = get_sampling_results_compression_level()
         self._store_samples = store_samples
         self._store_volume_maps = store_volume_maps
+        self._streaming_settings = get_sampling_streaming_settings()
+        self._adaptive_settings = get_sampling_adaptive_settings()
+        self._post_processing_settings = get_sampling_post_processing_settings()
+        self._ess_pool = None
+        self._sample_reduction = SampleReduction(**get_sample_reduction_settings(self._model.name))
+        self._nmr_chains = int(nmr_chains)
+        self._multiple_chains_settings = get_sampling_multiple_chains_settings()
+        self._samples_storage = get_samples_storage_settings()
+
+        if self._nmr_chains > 1:
+            if chain_state is not None:
+                raise ValueError('Continuing the chains of a previous run is not supported with multiple chains.')
         self._logger = logging.getLogger(__name__)
 
     def get_voxels_to_compute(self):
@@ -528,25 +1234,253 @@ class SamplingProcessingWorker(SimpleModelProcessingWorker):
         else:
             roi_list = np.arange(0, np.count_nonzero(self._problem_data.mask))
 
-        samples_paths = glob.glob(os.path.join(self._output_dir, '*.samples.npy'))
-        if samples_paths:
-            samples_file = samples_paths[0]
-            current_results = open_memmap(samples_file, mode='r')
-            if current_results.shape[0] == np.count_nonzero(self._problem_data.mask):
-                mask_path = os.path.join(self._tmp_storage_dir, 'volume_maps', '{}.npy'.format(self._used_mask_name))
-                if os.path.exists(mask_path):
-                    return roi_list[np.logical_not(np.squeeze(create_roi(np.load(mask_path, mmap_mode='r'),
-                                                                         self._problem_data.mask)[roi_list]))]
+        current_results = load_samples(self._output_dir)
+        if current_results:
+            nmr_voxels = current_results[list(current_results.keys())[0]].shape[0]
             del current_results  # force closing memmap
+            if nmr_voxels == np.count_nonzero(self._problem_data.mask):
+                used_mask = self._get_used_roi_mask(os.path.join(self._tmp_storage_dir, 'volume_maps'))
+                if used_mask is not None:
+                    return roi_list[np.logical_not(used_mask[roi_list])]
         return roi_list
 
-    def process(self, roi_indices):
-        sampling_output = self._sampler.sample(self._model)
+    def compute(self, roi_indices):
+        if self._use_streaming():
+            return self._compute_streaming(roi_indices)
+
+        if self._nmr_chains > 1:
+            return self._compute_multiple_chains(roi_indices)
+
+        if self._chain_state is None:
+            sampling_output = self._sampler.sample(self._model)
+        else:
+            sampling_output = self._sample_block(roi_indices, self._sampler.nmr_samples)
+
+        # the residual calculation in the post-processing depends on the voxels selected in the model,
+        # the ESS maps do not and are computed in finalize, overlapping with the sampling of the next chunk
+        self._logger.info('Starting sampling post-processing')
+        results, volume_maps = post_process_samples(self._model, sampling_output, calculate_ess=False)
+        self._logger.info('Finished sampling post-processing')
+
+        return sampling_output, results, volume_maps
+
+    def _compute_multiple_chains(self, roi_indices):
+        """Sample multiple chains per voxel, as one set of problems.
+
+        Every voxel is repeated once per chain in the problems to analyze of the model, such that all chains are
+        sampled in the same run. The first chain of every voxel starts at the starting point of the model, the other
+        chains at a perturbation thereof, see :meth:`_get_dispersed_starting_points`.
+
+        Returns:
+            tuple: the sampling output of all the chains, the samples per parameter as (voxels, chains, samples)
+                matrices and the volume maps computed over the samples of all chains
+        """
+        problems_to_analyze = self._model.problems_to_analyze
+        try:
+            self._model.problems_to_analyze = np.repeat(roi_indices, self._nmr_chains)
+            sampling_output = self._sampler.sample(self._model, init_params=self._get_dispersed_starting_points())
+        finally:
+            self._model.problems_to_analyze = problems_to_analyze
+
+        samples = sampling_output.get_samples()
+        samples = np.reshape(samples, (len(roi_indices), self._nmr_chains) + samples.shape[1:])
+        pooled_samples = np.reshape(np.transpose(samples, (0, 2, 1, 3)), samples.shape[:1] + (samples.shape[2], -1))
+
+        self._logger.info('Starting sampling post-processing')
+        _, volume_maps = post_process_samples(self._model, SimpleSampleOutput(pooled_samples), calculate_ess=False)
+        self._logger.info('Finished sampling post-processing')
+
+        results = {name: samples[:, :, ind] for ind, name in enumerate(self._model.get_optimized_param_names())}
+        return sampling_output, results, volume_maps
+
+    def _get_dispersed_starting_points(self):
+        """Get the starting points for the chains of the problems currently selected in the model.
+
+        This expects every voxel to be repeated once per chain in the problems to analyze. The first chain of every
+        voxel starts at the starting point of the model, the other chains start at a random perturbation of that
+        point, clipped to the parameter bounds.
+
+        Returns:
+            ndarray: the (problems, parameters) matrix with the starting points
+        """
+        starting_points = np.array(self._model.get_initial_parameters(), dtype=np.float64)
+        problems = self._model.problems_to_analyze
+
+        lower_bounds = _get_problem_bounds(self._model.get_lower_bounds(), problems)
+        upper_bounds = _get_problem_bounds(self._model.get_upper_bounds(), problems)
+
+        scale = upper_bounds - lower_bounds
+        scale = np.where(np.isfinite(scale), scale, np.abs(starting_points))
+        scale *= self._multiple_chains_settings['start_dispersion']
+
+        # seeded per chunk by its first voxel, such that every chunk gets its own (reproducible) perturbations
+        random_state = np.random.RandomState([self._multiple_chains_settings['seed'], int(problems[0])])
+        dispersed = starting_points + random_state.normal(size=starting_points.shape) * scale
+        dispersed = np.clip(dispersed, lower_bounds, upper_bounds)
+
+        is_first_chain = (np.arange(len(problems)) % self._nmr_chains) == 0
+        return np.where(is_first_chain[:, None], starting_points, dispersed)
+
+    def _use_streaming(self):
+        """Check if we sample in blocks with online statistics.
+
+        This is only possible if the samples are not stored and if we can continue the chains of the sampler.
+        """
+        return (not self._store_samples
+                and self._nmr_chains == 1
+                and self._streaming_settings['block_size']
+                and isinstance(self._sampler, MetropolisHastings))
+
+    def _compute_streaming(self, roi_indices):
+        """Sample the chains in consecutive blocks, accumulating the sample statistics online.
+
+        Every block continues the chains of the previous block, see :meth:`_sample_block`. Only one block of samples
+        is held in memory at any time.
+
+        If adaptive termination is enabled, we check the ESS of every voxel after every block (once the minimum number
+        of samples is reached) and stop sampling the voxels that reached the target ESS. The next blocks are then
+        only sampled for the remaining voxels, by restricting the problems to analyze of the model.
+
+        Returns:
+            tuple: the (combined) sampling output of the last block of every voxel, None for the samples and the
+                volume maps
+        """
+        nmr_samples = self._sampler.nmr_samples
+        block_size = int(self._streaming_settings['block_size'])
+
+        target_ess = None
+        if self._adaptive_settings['enabled']:
+            target_ess = self._get_target_ess()
+            self._logger.info('Sampling until an ESS of {} is reached, with at most {} samples.'.format(
+                target_ess, nmr_samples))
+
+        statistics = OnlineSampleStatistics(
+            self._model.get_optimized_param_names(), self._model.get_parameter_sampling_statistics(), nmr_samples,
+            quantiles=self._streaming_settings['quantiles'],
+            sketch_size=self._streaming_settings['quantile_sketch_size'])
+
+        active = np.arange(len(roi_indices))
+        chain_state = None
+        finished = []
+        problems_to_analyze = self._model.problems_to_analyze
+
+        try:
+            while len(active):
+                self._model.problems_to_analyze = roi_indices[active]
+
+                sampling_output = self._sample_block(roi_indices[active],
+                                                     min(block_size, nmr_samples - statistics.nmr_samples),
+                                                     previous_state=chain_state)
+                statistics.update(sampling_output.get_samples())
+                chain_state = _get_chain_state(sampling_output)
+                self._logger.info('Processed {} of {} samples'.format(statistics.nmr_samples, nmr_samples))
+
+                if statistics.nmr_samples >= nmr_samples:
+                    finished_voxels = np.ones(len(active), dtype=np.bool_)
+                elif target_ess is not None and statistics.nmr_samples >= self._adaptive_settings['min_nmr_samples']:
+                    finished_voxels = self._get_ess(statistics) >= target_ess
+                else:
+                    continue
+
+                if np.any(finished_voxels):
+                    maps = statistics.subset(finished_voxels).get_all_maps()
+                    if target_ess is not None:
+                        maps['NumberOfSamples'] = np.full(np.count_nonzero(finished_voxels), statistics.nmr_samples)
+                    finished.append((active[finished_voxels], maps,
+                                     _select_chain_state(chain_state, finished_voxels)))
+
+                    remaining = np.logical_not(finished_voxels)
+                    active = active[remaining]
+                    statistics = statistics.subset(remaining)
+                    chain_state = _select_chain_state(chain_state, remaining)
+
+                    if target_ess is not None and len(active):
+                        self._logger.info('{} voxels reached the target ESS, {} voxels remaining.'.format(
+                            np.count_nonzero(finished_voxels), len(active)))
+        finally:
+            self._model.problems_to_analyze = problems_to_analyze
+
+        order = np.argsort(np.concatenate([item[0] for item in finished]))
+        statistics_maps = {key: np.concatenate([item[1][key] for item in finished])[order]
+                           for key in finished[0][1]}
+        sampling_output = _combine_chain_states([item[2] for item in finished], order)
 
         self._logger.info('Starting sampling post-processing')
-        results, volume_maps = post_process_samples(self._model, sampling_output)
+        volume_maps = post_process_sample_statistics(self._model, statistics_maps)
         self._logger.info('Finished sampling post-processing')
 
+        return sampling_output, None, volume_maps
+
+    def _get_target_ess(self):
+        """Get the ESS at which we stop sampling a voxel in adaptive sampling."""
+        if self._adaptive_settings['min_ess'] is not None:
+            return float(self._adaptive_settings['min_ess'])
+
+        nmr_params = len(self._model.get_optimized_param_names())
+        if self._adaptive_settings['ess'] == 'univariate':
+            nmr_params = 1
+        return minimum_multivariate_ess(nmr_params, alpha=self._adaptive_settings['alpha'],
+                                        epsilon=self._adaptive_settings['epsilon'])
+
+    def _get_ess(self, statistics):
+        """Get the ESS per voxel used to decide if a voxel has converged in adaptive sampling."""
+        if self._adaptive_settings['ess'] == 'univariate':
+            return np.min(statistics.get_univariate_ess(), axis=1)
+        return statistics.get_multivariate_ess()
+
+    def _sample_block(self, roi_indices, nmr_samples, previous_state=None):
+        """Sample the given number of samples, continuing the existing chains if possible.
+
+        If the state of the previous block is given we continue from the end of those chains. Else, if a chain state
+        of a previous sampling run is available we continue from that state. In both cases no burn-in is applied.
+        If neither is available we start new chains, with burn-in.
+
+        Args:
+            roi_indices (ndarray): the ROI indices of the voxels we are sampling
+            nmr_samples (int): the number of samples to draw
+            previous_state (tuple): the chain position, the proposal state and the MH state at the end of the
+                previous block of samples of these voxels
+
+        Returns:
+            MHSampleOutput: the sampling output
+        """
+        if previous_state is not None:
+            init_params, proposal_state, mh_state = previous_state
+        elif self._chain_state is not None:
+            init_params = self._chain_state.get_chain_end_point(roi_indices)
+            proposal_state = self._chain_state.get_proposal_state(roi_indices)
+            mh_state = self._chain_state.get_mh_state(roi_indices)
+        else:
+            return self._get_block_sampler(nmr_samples, self._sampler.burn_length).sample(self._model)
+
+        self._model.set_initial_sampling_states(proposal_state, mh_state)
+        try:
+            return self._get_block_sampler(nmr_samples, 0).sample(self._model, init_params=init_params)
+        finally:
+            self._model.set_initial_sampling_states()
+
+    def _get_block_sampler(self, nmr_samples, burn_length):
+        """Get a sampler with the settings of our sampler, but for the given number of samples and burn length."""
+        return type(self._sampler)(nmr_samples=nmr_samples, burn_length=burn_length,
+                                   sample_intervals=self._sampler.sample_intervals,
+                                   use_adaptive_proposals=self._sampler.use_adaptive_proposals,
+                                   cl_environments=self._sampler.cl_environments,
+                                   load_balancer=self._sampler.load_balancer,
+                                   compile_flags=self._sampler.compile_flags)
+
+    def _store_results(self, roi_indices, computed):
+        sampling_output, results, volume_maps = computed
+
+        if self._store_volume_maps and results is not None:
+            self._logger.info('Starting the ESS estimation')
+            volume_maps.update(self._get_convergence_maps(sampling_output.get_samples()))
+            self._logger.info('Finished the ESS estimation')
+
+        if self._nmr_chains > 1:
+            sampling_output = _combine_chain_states(
+                [_select_chain_state(_get_chain_state(sampling_output), slice(None, None, self._nmr_chains))],
+                np.arange(len(roi_indices)))
+
         if self._store_volume_maps:
             self._write_volumes(roi_indices, volume_maps, os.path.join(self._tmp_storage_dir, 'volume_maps'))
 
@@ -556,15 +1490,64 @@ class SamplingProcessingWorker(SimpleModelProcessingWorker):
 
         self._tmp_store_mh_state(roi_indices, sampling_output.get_mh_state())
 
-        chain_end_point = {key: result[:, -1] for key, result in results.items()}
+        if results is None or self._nmr_chains > 1:
+            chain_end_point = results_to_dict(sampling_output.get_current_chain_position(),
+                                              self._model.get_optimized_param_names())
+        else:
+            chain_end_point = {key: result[:, -1] for key, result in results.items()}
         self._write_volumes(roi_indices, chain_end_point, os.path.join(self._tmp_storage_dir, 'chain_end_point'))
 
         if self._store_samples:
-            self._write_sample_results(results, self._problem_data.mask, roi_indices)
+            if not self._sample_reduction.stores_chains:
+                self._write_volumes(roi_indices, self._sample_reduction.get_quantile_maps(results),
+                                    os.path.join(self._tmp_storage_dir, 'quantiles'))
+                return SamplingProcessingWorker.SampleChainNotStored()
+
+            results = self._sample_reduction.reduce_chains(results)
+            self._write_sample_chains(results, roi_indices)
             return results
 
         return SamplingProcessingWorker.SampleChainNotStored()
 
+    def _get_convergence_maps(self, samples):
+        """Get the ESS maps and, when sampling multiple chains, the R-hat maps of the given samples.
+
+        With multiple chains the ESS is estimated per chain and summed over the chains of every voxel.
+
+        Args:
+            samples (ndarray): the (problems, parameters, samples) matrix, with every voxel repeated once per chain
+
+        Returns:
+            dict: the volume maps per voxel
+        """
+        param_names = self._model.get_optimized_param_names()
+
+        ess_maps = calculate_sample_ess_maps(samples, param_names, pool=self._get_ess_pool(),
+                                             voxels_per_block=self._post_processing_settings['voxels_per_block'])
+        if self._nmr_chains == 1:
+            return ess_maps
+
+        volume_maps = {key: np.sum(np.reshape(value, (-1, self._nmr_chains)), axis=1)
+                       for key, value in ess_maps.items()}
+        volume_maps.update(calculate_rhat_maps(
+            np.reshape(samples, (-1, self._nmr_chains) + samples.shape[1:]), param_names))
+        return volume_maps
+
+    def _get_ess_pool(self):
+        """Get the pool of processes for estimating the ESS, created at first use and shared by all chunks.
+
+        The pool is closed in :meth:`close`.
+        """
+        if self._ess_pool is None:
+            self._ess_pool = create_process_pool(self._post_processing_settings['nmr_processes'])
+        return self._ess_pool
+
+    def close(self):
+        if self._ess_pool is not None:
+            self._ess_pool.close()
+            self._ess_pool.join()
+            self._ess_pool = None
+
     def combine(self):
         super(SamplingProcessingWorker, self).combine()
 
@@ -576,6 +1559,14 @@ class SamplingProcessingWorker(SimpleModelProcessingWorker):
             self._combine_volumes(self._output_dir, self._tmp_storage_dir,
                                   self._problem_data.volume_header, maps_subdir=subdir)
 
+        if self._store_samples:
+            self._sample_reduction.save(self._output_dir)
+
+        if self._store_samples and not self._sample_reduction.stores_chains:
+            self._combine_volumes(self._output_dir, self._tmp_storage_dir,
+                                  self._problem_data.volume_header, maps_subdir='quantiles')
+            return SamplingProcessingWorker.SampleChainNotStored()
+
         if self._store_samples:
             for samples in glob.glob(os.path.join(self._tmp_storage_dir, '*.samples.npy')):
                 shutil.move(samples, self._output_dir)
@@ -598,40 +1589,116 @@ class SamplingProcessingWorker(SimpleModelProcessingWorker):
         with open(os.path.join(self._output_dir, 'mh_state', 'nmr_samples_drawn.txt'), 'w') as f:
             f.write(str(mh_state.nmr_samples_drawn))
 
-    def _write_sample_results(self, results, full_mask, roi_indices):
-        """Write the sample results to a .npy file.
+    def _write_sample_chains(self, results, roi_indices):
+        """Write the samples of the given voxels, with multiple chains every chain is written separately.
+
+        Args:
+            results (dict): per parameter the (voxels, samples) matrix, or the (voxels, chains, samples) matrix when
+                sampling multiple chains
+            roi_indices (ndarray): the roi indices of the voxels we computed
+        """
+        if self._nmr_chains == 1:
+            self._write_sample_results(results, self._problem_data.mask, roi_indices)
+            return
+
+        for chain in range(self._nmr_chains):
+            self._write_sample_results({name: samples[:, chain] for name, samples in results.items()},
+                                       self._problem_data.mask, roi_indices,
+                                       output_dir=self._get_chain_samples_dir(chain))
+
+    def _get_chain_samples_dir(self, chain):
+        """Get the directory in which we store the samples of the given chain, when sampling multiple chains.
+
+        The samples of the first chain are stored in the output directory, as with a single chain, such that they
+        match the stored chain state. The samples of every other chain are stored in a ``chain_<index>`` subdirectory.
+        """
+        if chain == 0:
+            return self._output_dir
+        return os.path.join(self._output_dir, 'chain_{}'.format(chain))
+
+    def _write_sample_results(self, results, full_mask, roi_indices, output_dir=None):
+        """Write the sample results to a .npy file, or to a compressed samples store.
 
         If the given sample files do not exists or if the existing file is not large enough it will create one
         with enough storage to hold all the samples for the given total_nmr_voxels.
         On storing it should also be given a list of voxel indices with the indices of the voxels that are being stored.
 
+        The storage format is taken from the configuration, see
+        :func:`~mdt.configuration.get_samples_storage_settings`.
+
         Args:
             results (dict): the samples to write
             full_mask (ndarray): the complete mask for the entire brain
             roi_indices (ndarray): the roi indices of the voxels we computed
+            output_dir (str): the directory to write the samples to, defaults to the output directory
         """
+        output_dir = output_dir or self._output_dir
         total_nmr_voxels = np.count_nonzero(full_mask)
-
-        if not os.path.exists(self._output_dir):
-            os.makedirs(self._output_dir)
-
-        for fname in os.listdir(self._output_dir):
-            if fname.endswith('.samples.npy'):
-                chain_name = fname[0:-len('.samples.npy')]
-                if chain_name not in results:
-                    os.remove(os.path.join(self._output_dir, fname))
+        use_compression = self._samples_storage['format'] == 'compressed'
+
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        extension_in_use = COMPRESSED_SAMPLES_EXTENSION if use_compression else '.samples.npy'
+        for fname in os.listdir(output_dir):
+            for extension in ['.samples.npy', COMPRESSED_SAMPLES_EXTENSION]:
+                if fname.endswith(extension):
+                    chain_name = fname[0:-len(extension)]
+                    if chain_name not in results or extension != extension_in_use:
+                        path = os.path.join(output_dir, fname)
+                        if os.path.isdir(path):
+                            shutil.rmtree(path)
+                        else:
+                            os.remove(path)
 
         for map_name, samples in results.items():
-            samples_path = os.path.join(self._output_dir, map_name + '.samples.npy')
+            if use_compression:
+                self._write_compressed_samples(map_name, samples, total_nmr_voxels, roi_indices, output_dir)
+                continue
+
+            samples_path = os.path.join(output_dir, map_name + '.samples.npy')
             mode = 'w+'
             if os.path.isfile(samples_path):
                 mode = 'r+'
                 current_results = open_memmap(samples_path, mode='r')
-                if current_results.shape[1] != samples.shape[1]:
+                if current_results.shape[1:] != samples.shape[1:]:
                     mode = 'w+'
                 del current_results # closes the memmap
 
+            if mode == 'w+':
+                remove_sample_segments(output_dir)
+
             saved = open_memmap(samples_path, mode=mode, dtype=samples.dtype,
-                                shape=(total_nmr_voxels, samples.shape[1]))
-            saved[roi_indices, :] = samples
+                                shape=(total_nmr_voxels,) + samples.shape[1:])
+            saved[roi_indices] = samples
+            self._checkpoints.record(samples_path, 'roi', saved, saved[roi_indices])
             del saved
+
+    def _write_compressed_samples(self, map_name, samples, total_nmr_voxels, roi_indices, output_dir):
+        """Write the samples of one parameter to a compressed samples store.
+
+        Args:
+            map_name (str): the name of the parameter
+            samples (ndarray): the samples of the voxels we computed
+            total_nmr_voxels (int): the number of voxels in the complete mask
+            roi_indices (ndarray): the roi indices of the voxels we computed
+            output_dir (str): the directory to write the samples store to
+        """
+        samples_path = os.path.join(output_dir, map_name + COMPRESSED_SAMPLES_EXTENSION)
+        shape = (total_nmr_voxels, samples.shape[1])
+
+        store = None
+        if CompressedSamples.is_store(samples_path):
+            store = CompressedSamples(samples_path)
+            if store.shape != shape:
+                store = None
+
+        if store is None:
+            remove_sample_segments(output_dir)
+            store = CompressedSamples.create(samples_path, shape, samples.dtype,
+                                             storage_dtype=self._samples_storage['dtype'],
+                                             voxels_per_block=self._samples_storage['voxels_per_block'],
+                                             compression_level=self._samples_storage['compression_level'])
+
+        store.write(roi_indices, samples)
+        self._checkpoints.record(store.index_path, 'compressed', store, store.get_stored_bytes(roi_indices))
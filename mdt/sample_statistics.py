@@ -0,0 +1,352 @@
+"""Online (streaming) statistics of MCMC sample chains.
+
+The routines in this module compute the sample statistics block by block, such that a chain never has to be held in
+memory in its entirety. This is used when sampling without storing the samples, where the chains are generated in
+blocks and the statistics are accumulated per voxel while sampling.
+"""
+import copy
+
+import numpy as np
+from mot.model_building.parameter_functions.sample_statistics import CircularGaussianPSS
+
+__author__ = 'Robbert Harms'
+__date__ = "2017-03-28"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+class OnlineSampleStatistics(object):
+
+    def __init__(self, param_names, sampling_statistics, chain_length, quantiles=(), sketch_size=1000, seed=0):
+        r"""Accumulates per problem the statistics of a chain that is given in consecutive blocks of samples.
+
+        This computes per problem and parameter the mean and standard deviation (circular for parameters with a
+        :class:`~mot.model_building.parameter_functions.sample_statistics.CircularGaussianPSS`), the quantiles and
+        the univariate and multivariate Effective Sample Size (ESS).
+
+        The mean, standard deviation and covariance matrix are merged per block (Chan et al.). The ESS is
+        estimated with batch means using a batch size of :math:`\lfloor \sqrt{n} \rfloor`, with :math:`n` the given
+        chain length. This is the same estimator as the MOT defaults for the univariate and multivariate ESS, except
+        that for the multivariate ESS we only use the batches from the start of the chain.
+
+        The quantiles are estimated from a sketch of the chain, a uniform random subsample (reservoir) of at most
+        ``sketch_size`` samples per chain. The positions in the reservoir are shared between all problems.
+
+        Args:
+            param_names (list of str): the names of the parameters, in the order of the samples
+            sampling_statistics (dict): per parameter name the sampling statistics object of that parameter
+            chain_length (int): the total length of the chains we will receive, used to determine the batch size
+            quantiles (list of float): the quantiles (between 0 and 1) we would like to estimate
+            sketch_size (int): the number of samples per chain we keep for estimating the quantiles
+            seed (int): the seed for the random generator of the quantile sketch
+        """
+        self._param_names = list(param_names)
+        self._max_angles = [_get_max_angle(sampling_statistics[name]) for name in self._param_names]
+        self._circular_ind = [ind for ind, angle in enumerate(self._max_angles) if angle is not None]
+        self._quantiles = list(quantiles)
+        self._sketch_size = int(sketch_size)
+        self._random_state = np.random.RandomState(seed)
+
+        self._batch_size = max(1, int(np.floor(chain_length ** (1 / 2.0))))
+
+        self._nmr_samples = 0
+        self._mean = None
+        self._comoment = None
+        self._circular_sum = None
+        self._batch_sum = None
+        self._batch_means = []
+        self._sketch = None
+
+    @property
+    def nmr_samples(self):
+        """Get the number of samples per chain processed so far.
+
+        Returns:
+            int: the number of samples processed
+        """
+        return self._nmr_samples
+
+    def update(self, samples):
+        """Update the statistics with the next block of samples.
+
+        Args:
+            samples (ndarray): the samples of this block, a (d, p, n) matrix with d problems, p parameters and
+                n samples
+        """
+        if self._mean is None:
+            self._initialize(samples)
+
+        self._update_moments(samples)
+        self._update_circular(samples)
+        self._update_batches(samples)
+        if self._quantiles:
+            self._update_sketch(samples)
+
+        self._nmr_samples += samples.shape[2]
+
+    def get_state(self):
+        """Get the sufficient statistics accumulated so far.
+
+        Together with :meth:`set_state` this allows storing the statistics and updating them later with new samples.
+        The quantile sketch is not part of the state.
+
+        Returns:
+            dict: the state, with 'nmr_samples' and 'batch_size' as scalars and with 'mean', 'comoment',
+                'circular_sum', 'batch_sum' and 'batch_means' as arrays with the problems on the first axis
+        """
+        nmr_problems, nmr_params = self._mean.shape
+        if self._batch_means:
+            batch_means = np.stack(self._batch_means, axis=2)
+        else:
+            batch_means = np.zeros((nmr_problems, nmr_params, 0), dtype=np.float64)
+
+        return {'nmr_samples': self._nmr_samples,
+                'batch_size': self._batch_size,
+                'mean': self._mean,
+                'comoment': self._comoment,
+                'circular_sum': self._circular_sum,
+                'batch_sum': self._batch_sum,
+                'batch_means': batch_means}
+
+    def set_state(self, state):
+        """Continue from the given sufficient statistics, as returned by :meth:`get_state`.
+
+        Args:
+            state (dict): the state to continue from, the arrays may be given for a subset of the problems
+
+        Raises:
+            ValueError: if quantiles are requested, since the quantile sketch can not be restored from a state
+        """
+        if self._quantiles:
+            raise ValueError('The quantile sketch can not be restored from a state.')
+
+        self._nmr_samples = int(state['nmr_samples'])
+        self._batch_size = int(state['batch_size'])
+        self._mean = np.array(state['mean'], dtype=np.float64)
+        self._comoment = np.array(state['comoment'], dtype=np.float64)
+        self._circular_sum = np.array(state['circular_sum'], dtype=np.complex128)
+        self._batch_sum = np.array(state['batch_sum'], dtype=np.float64)
+        self._batch_means = [np.array(state['batch_means'][..., ind], dtype=np.float64)
+                             for ind in range(state['batch_means'].shape[2])]
+
+    def adapt_batch_size(self, chain_length):
+        r"""Adapt the batch size of the ESS estimation to a new total chain length.
+
+        This is used when appending samples to a chain of which we only have the state (see :meth:`set_state`). Since
+        the batches already stored can only be merged, not split, the new batch size is the multiple of the current
+        batch size closest to :math:`\lfloor \sqrt{n} \rfloor`, with :math:`n` the given chain length. This deviates
+        at most half the current batch size from the batch size used for a chain of that length processed at once.
+
+        Args:
+            chain_length (int): the new total length of the chains
+        """
+        factor = max(1, int(round(np.floor(chain_length ** (1 / 2.0)) / float(self._batch_size))))
+        if factor == 1:
+            return
+
+        nmr_merged = len(self._batch_means) // factor
+
+        # the batches that do not fill a merged batch are added to the current (incomplete) batch
+        for batch_means in self._batch_means[nmr_merged * factor:]:
+            self._batch_sum = self._batch_sum + batch_means * self._batch_size
+
+        self._batch_means = [np.mean(self._batch_means[ind * factor:(ind + 1) * factor], axis=0)
+                             for ind in range(nmr_merged)]
+        self._batch_size *= factor
+
+    def subset(self, problems):
+        """Get the statistics of only the given problems.
+
+        Args:
+            problems (ndarray): the indices (or a boolean mask) of the problems we want to keep
+
+        Returns:
+            OnlineSampleStatistics: a new statistics object with only the given problems
+        """
+        subset = copy.copy(self)
+        if self._mean is not None:
+            subset._mean = self._mean[problems]
+            subset._comoment = self._comoment[problems]
+            subset._circular_sum = self._circular_sum[problems]
+            subset._batch_sum = self._batch_sum[problems]
+            subset._batch_means = [batch_means[problems] for batch_means in self._batch_means]
+            if self._sketch is not None:
+                subset._sketch = self._sketch[problems]
+        return subset
+
+    def get_all_maps(self):
+        """Get all the statistics as one dictionary of maps.
+
+        Returns:
+            dict: the maps of :meth:`get_statistics` and :meth:`get_quantiles`, the univariate ESS per parameter
+                (with key ``<param>.UnivariateESS``) and the multivariate ESS (with key ``MultivariateESS``)
+        """
+        maps = self.get_statistics()
+        maps.update(self.get_quantiles())
+
+        univariate_ess = self.get_univariate_ess()
+        for ind, name in enumerate(self._param_names):
+            maps[name + '.UnivariateESS'] = univariate_ess[:, ind]
+
+        maps['MultivariateESS'] = self.get_multivariate_ess()
+        return maps
+
+    def get_statistics(self):
+        """Get the mean and standard deviation of every parameter.
+
+        This is the online counterpart of the ``samples_to_statistics`` method of the composite models.
+
+        Returns:
+            dict: per parameter the mean and the standard deviation (with key ``<param>.std``), in ROI space
+        """
+        mean = self._mean.copy()
+        std = np.sqrt(np.maximum(np.diagonal(self._comoment, axis1=1, axis2=2) / self._nmr_samples, 0))
+
+        for circular_ind, param_ind in enumerate(self._circular_ind):
+            max_angle = self._max_angles[param_ind]
+            resultant = self._circular_sum[:, circular_ind] / self._nmr_samples
+
+            angle = np.angle(resultant)
+            angle[angle < 0] += 2 * np.pi
+            mean[:, param_ind] = angle * max_angle / 2.0 / np.pi
+
+            length = np.abs(resultant)
+            length[length >= 1] = 1 - np.finfo(np.float64).eps
+            std[:, param_ind] = (max_angle / 2.0 / np.pi) * np.sqrt(-2 * np.log(length))
+
+        results = {}
+        for ind, name in enumerate(self._param_names):
+            results[name] = mean[:, ind]
+            results[name + '.std'] = std[:, ind]
+        return results
+
+    def get_quantiles(self):
+        """Get the estimated quantiles of every parameter.
+
+        Returns:
+            dict: per parameter and quantile the estimated value, with keys ``<param>.percentile_<percentile>``
+        """
+        if not self._quantiles:
+            return {}
+
+        sketch = self._sketch[..., :min(self._sketch_size, self._nmr_samples)]
+        percentiles = np.percentile(sketch, [q * 100 for q in self._quantiles], axis=2)
+
+        results = {}
+        for quantile, values in zip(self._quantiles, percentiles):
+            for ind, name in enumerate(self._param_names):
+                results['{}.percentile_{:g}'.format(name, quantile * 100)] = values[:, ind]
+        return results
+
+    def get_univariate_ess(self):
+        """Get the univariate Effective Sample Size of every parameter.
+
+        Returns:
+            ndarray: a (d, p) matrix with for every problem and every parameter the ESS
+        """
+        nmr_batches = len(self._batch_means)
+        if nmr_batches < 2:
+            return np.zeros_like(self._mean)
+
+        centered = self._get_centered_batch_means()
+        sigma = self._batch_size * np.sum(centered ** 2, axis=2) / (nmr_batches - 1)
+        variance = np.diagonal(self._comoment, axis1=1, axis2=2) / self._nmr_samples
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.nan_to_num(self._nmr_samples * variance / sigma)
+
+    def get_multivariate_ess(self):
+        """Get the multivariate Effective Sample Size.
+
+        Returns:
+            ndarray: the multivariate ESS per problem
+        """
+        nmr_batches = len(self._batch_means)
+        nmr_params = self._mean.shape[1]
+        if nmr_batches < 2 or self._nmr_samples < 2:
+            return np.zeros(self._mean.shape[0])
+
+        centered = self._get_centered_batch_means()
+        sigma = np.einsum('dpb,dqb->dpq', centered, centered) * self._batch_size / (nmr_batches - 1)
+        covariance = self._comoment / (self._nmr_samples - 1)
+
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            ess = self._nmr_samples * (np.linalg.det(covariance) ** (1.0 / nmr_params)
+                                       / np.linalg.det(sigma) ** (1.0 / nmr_params))
+        return np.nan_to_num(ess)
+
+    def _initialize(self, samples):
+        nmr_problems, nmr_params = samples.shape[:2]
+        self._mean = np.zeros((nmr_problems, nmr_params), dtype=np.float64)
+        self._comoment = np.zeros((nmr_problems, nmr_params, nmr_params), dtype=np.float64)
+        self._circular_sum = np.zeros((nmr_problems, len(self._circular_ind)), dtype=np.complex128)
+        self._batch_sum = np.zeros((nmr_problems, nmr_params), dtype=np.float64)
+        if self._quantiles:
+            self._sketch = np.zeros((nmr_problems, nmr_params, self._sketch_size), dtype=samples.dtype)
+
+    def _update_moments(self, samples):
+        """Merge the mean and co-moment of this block with the running mean and co-moment (Chan et al.)."""
+        block_length = samples.shape[2]
+        total_length = self._nmr_samples + block_length
+
+        block_mean = np.mean(samples, axis=2, dtype=np.float64)
+        centered = samples - block_mean[..., None]
+        block_comoment = np.einsum('dpn,dqn->dpq', centered, centered)
+
+        delta = block_mean - self._mean
+        self._comoment += block_comoment + (np.einsum('dp,dq->dpq', delta, delta)
+                                            * (self._nmr_samples * block_length / float(total_length)))
+        self._mean += delta * (block_length / float(total_length))
+
+    def _update_circular(self, samples):
+        for circular_ind, param_ind in enumerate(self._circular_ind):
+            max_angle = self._max_angles[param_ind]
+            angles = np.mod(samples[:, param_ind], max_angle) * 2 * np.pi / max_angle
+            self._circular_sum[:, circular_ind] += np.sum(np.exp(1j * angles), axis=1)
+
+    def _update_batches(self, samples):
+        """Add the samples to the batches, storing the mean of every completed batch."""
+        position = 0
+        while position < samples.shape[2]:
+            nmr_in_batch = (self._nmr_samples + position) % self._batch_size
+            nmr_to_add = min(self._batch_size - nmr_in_batch, samples.shape[2] - position)
+
+            self._batch_sum += np.sum(samples[..., position:position + nmr_to_add], axis=2, dtype=np.float64)
+            position += nmr_to_add
+
+            if nmr_in_batch + nmr_to_add == self._batch_size:
+                self._batch_means.append(self._batch_sum / self._batch_size)
+                self._batch_sum = np.zeros_like(self._batch_sum)
+
+    def _update_sketch(self, samples):
+        """Update the reservoir of samples used for estimating the quantiles (Vitter's algorithm R)."""
+        block_length = samples.shape[2]
+
+        nmr_to_fill = max(0, min(self._sketch_size - self._nmr_samples, block_length))
+        if nmr_to_fill:
+            self._sketch[..., self._nmr_samples:self._nmr_samples + nmr_to_fill] = samples[..., :nmr_to_fill]
+
+        sample_ind = np.arange(nmr_to_fill, block_length)
+        if not len(sample_ind):
+            return
+
+        nmr_seen = self._nmr_samples + sample_ind + 1
+        sketch_ind = (self._random_state.random_sample(len(sample_ind)) * nmr_seen).astype(np.int64)
+        selected = sketch_ind < self._sketch_size
+
+        # later samples overwrite earlier samples at the same position in the reservoir
+        sketch_ind = sketch_ind[selected][::-1]
+        sample_ind = sample_ind[selected][::-1]
+        sketch_ind, last = np.unique(sketch_ind, return_index=True)
+
+        self._sketch[..., sketch_ind] = samples[..., sample_ind[last]]
+
+    def _get_centered_batch_means(self):
+        return np.stack(self._batch_means, axis=2) - self._mean[..., None]
+
+
+def _get_max_angle(sampling_statistics):
+    """Get the maximum angle of a circular parameter, or None if the parameter is not circular."""
+    if isinstance(sampling_statistics, CircularGaussianPSS):
+        return sampling_statistics.max_angle
+    return None
@@ -0,0 +1,428 @@
+"""Compressed storage of sample chains.
+
+Next to the plain ``.npy`` files, the sample chains can be stored in a compressed format. In this format every
+parameter is stored in its own directory, ``<parameter>.samples``, holding blocks of voxels of which the samples are
+byte-shuffled and compressed with zlib. An index maps every voxel to its block, such that the samples of a single voxel
+can be read by decompressing only one block.
+
+Blocks are only ever appended to the data file. Voxels that are written again point to their new block, the old block
+is left unused.
+
+Before storing, the chains can be reduced, see :class:`SampleReduction`.
+"""
+import json
+import operator
+import os
+import shutil
+import zlib
+
+import numpy as np
+
+__author__ = 'Robbert Harms'
+__date__ = "2017-03-30"
+__maintainer__ = "Robbert Harms"
+__email__ = "robbert.harms@maastrichtuniversity.nl"
+
+
+COMPRESSED_SAMPLES_EXTENSION = '.samples'
+"""The extension of the directories with compressed samples."""
+
+SAMPLE_REDUCTION_FNAME = 'sample_reduction.json'
+"""The name of the file in the samples directory recording the reduction of the stored samples."""
+
+
+class CompressedSamples(object):
+
+    def __init__(self, path):
+        """Open an existing compressed samples store.
+
+        This presents the stored samples as a two dimensional (voxels, samples) array that supports the shape, dtype
+        and indexing (with at most two indices) of a regular samples array. Voxels that are not yet written read as
+        zeros, as in a new memory mapped ``.npy`` file.
+
+        Use :meth:`create` to create a new store.
+
+        Args:
+            path (str): the directory of the store
+        """
+        self._path = path
+
+        with open(os.path.join(path, 'info.json'), 'r') as f:
+            self._info = json.load(f)
+
+        self._index = np.load(self.index_path)
+        self._blocks = np.load(os.path.join(path, 'blocks.npy'))
+        self._cached_block = (None, None)
+
+    @classmethod
+    def create(cls, path, shape, dtype, storage_dtype=None, voxels_per_block=256, compression_level=1):
+        """Create a new (empty) compressed samples store, removing any existing store at the given path.
+
+        Args:
+            path (str): the directory of the store
+            shape (tuple): the (voxels, samples) shape of the samples we will store
+            dtype (np.dtype): the data type of the samples
+            storage_dtype (np.dtype): the data type in which we store the samples. If not given we use the given
+                dtype. Setting this to a smaller type, for example float16, reduces the storage at the cost of
+                precision.
+            voxels_per_block (int): the number of voxels compressed together in one block
+            compression_level (int): the zlib compression level (1 is fastest, 9 is smallest)
+
+        Returns:
+            CompressedSamples: the opened store
+        """
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+
+        info = {'version': 1,
+                'shape': [int(shape[0]), int(shape[1])],
+                'dtype': np.dtype(dtype).str,
+                'storage_dtype': np.dtype(storage_dtype or dtype).str,
+                'compression': 'zlib',
+                'compression_level': int(compression_level),
+                'shuffle': True,
+                'voxels_per_block': int(voxels_per_block)}
+
+        with open(os.path.join(path, 'info.json'), 'w') as f:
+            json.dump(info, f)
+        open(os.path.join(path, 'data.bin'), 'wb').close()
+
+        _save_atomic(os.path.join(path, 'index.npy'), np.full((shape[0], 2), -1, dtype=np.int64))
+        _save_atomic(os.path.join(path, 'blocks.npy'), np.zeros((0, 3), dtype=np.int64))
+
+        return cls(path)
+
+    @staticmethod
+    def is_store(path):
+        """Check if the given path is a compressed samples store.
+
+        Args:
+            path (str): the path to check
+
+        Returns:
+            boolean: if the path is a directory with compressed samples
+        """
+        return os.path.isfile(os.path.join(path, 'info.json')) and os.path.isfile(os.path.join(path, 'index.npy'))
+
+    @property
+    def index_path(self):
+        """The path to the file with the voxel index, this file is replaced on every write."""
+        return os.path.join(self._path, 'index.npy')
+
+    @property
+    def shape(self):
+        return tuple(self._info['shape'])
+
+    @property
+    def dtype(self):
+        return np.dtype(self._info['dtype'])
+
+    @property
+    def ndim(self):
+        return 2
+
+    @property
+    def size(self):
+        return self.shape[0] * self.shape[1]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        if dtype is None:
+            return self[:, :]
+        return self[:, :].astype(dtype)
+
+    def __getitem__(self, item):
+        if not isinstance(item, tuple):
+            item = (item,)
+        if len(item) > 2:
+            raise IndexError('Too many indices for the compressed samples.')
+
+        voxel_ind, is_scalar_voxel = self._get_voxel_indices(item[0])
+
+        # the samples are selected per block, such that we never hold all the samples of the selected voxels
+        sample_ind = np.arange(self.shape[1])
+        if len(item) > 1:
+            sample_ind = sample_ind[item[1]]
+
+        block_ind = self._index[voxel_ind, 0]
+        row_ind = self._index[voxel_ind, 1]
+
+        result = np.zeros((len(voxel_ind),) + sample_ind.shape, dtype=self.dtype)
+        for block in np.unique(block_ind[block_ind >= 0]):
+            selected = block_ind == block
+            rows = self._read_block(block)[row_ind[selected]]
+            result[selected] = rows if len(item) == 1 else rows[:, sample_ind]
+
+        if is_scalar_voxel:
+            return result[0]
+        return result
+
+    def get_stored_bytes(self, roi_indices):
+        """Get the data stored for the given voxels, without decompressing.
+
+        This consists of the index entries of the given voxels, followed by the compressed blocks holding these voxels.
+        This is cheaper to obtain than the samples themselves and changes if the stored samples change, which makes it
+        suitable for computing checksums.
+
+        Args:
+            roi_indices (ndarray): the indices of the voxels
+
+        Returns:
+            ndarray: the stored data as an array of bytes
+        """
+        index = self._index[roi_indices]
+        parts = [np.ascontiguousarray(index).view(np.uint8).ravel()]
+
+        with open(os.path.join(self._path, 'data.bin'), 'rb') as f:
+            for block in np.unique(index[index[:, 0] >= 0, 0]):
+                offset, nmr_bytes, _ = self._blocks[block]
+                f.seek(offset)
+                parts.append(np.frombuffer(f.read(nmr_bytes), dtype=np.uint8))
+        return np.concatenate(parts)
+
+    def write(self, roi_indices, samples):
+        """Write the samples of the given voxels.
+
+        The samples are compressed in blocks of voxels and appended to the data file, after which the voxel index is
+        replaced to point to the new blocks.
+
+        Args:
+            roi_indices (ndarray): the indices of the voxels we are writing
+            samples (ndarray): the (voxels, samples) matrix with the samples of the given voxels
+        """
+        samples = np.asarray(samples).astype(self._info['storage_dtype'], copy=False)
+        voxels_per_block = self._info['voxels_per_block']
+
+        new_blocks = []
+        new_index = np.array(self._index)
+
+        with open(os.path.join(self._path, 'data.bin'), 'ab') as f:
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+
+            for start in range(0, len(roi_indices), voxels_per_block):
+                block_samples = samples[start:start + voxels_per_block]
+                data = zlib.compress(_shuffle(block_samples), self._info['compression_level'])
+                f.write(data)
+
+                block = len(self._blocks) + len(new_blocks)
+                new_index[roi_indices[start:start + voxels_per_block], 0] = block
+                new_index[roi_indices[start:start + voxels_per_block], 1] = np.arange(block_samples.shape[0])
+
+                new_blocks.append([offset, len(data), block_samples.shape[0]])
+                offset += len(data)
+
+            f.flush()
+            os.fsync(f.fileno())
+
+        if new_blocks:
+            self._blocks = np.concatenate([self._blocks, np.array(new_blocks, dtype=np.int64)])
+        self._index = new_index
+
+        _save_atomic(os.path.join(self._path, 'blocks.npy'), self._blocks)
+        _save_atomic(self.index_path, self._index)
+
+    def flush(self):
+        """Everything is written to disk on every write, this exists for compatibility with memory mapped arrays."""
+
+    def _get_voxel_indices(self, item):
+        """Get the voxels selected by the given index, without creating an index over all the voxels.
+
+        Args:
+            item: an integer, a slice, or an array of integers or booleans
+
+        Returns:
+            tuple: the one dimensional array with the selected voxels and a boolean indicating if a single voxel was
+                selected with an integer index
+        """
+        nmr_voxels = self.shape[0]
+
+        if isinstance(item, slice):
+            return np.arange(*item.indices(nmr_voxels)), False
+
+        try:
+            index = operator.index(item)
+        except TypeError:
+            pass
+        else:
+            if not -nmr_voxels <= index < nmr_voxels:
+                raise IndexError('Index {} is out of bounds for {} voxels.'.format(index, nmr_voxels))
+            return np.array([index % nmr_voxels]), True
+
+        indices = np.asarray(item)
+        if indices.dtype == np.bool_:
+            if indices.shape != (nmr_voxels,):
+                raise IndexError('The boolean index should have one element per voxel.')
+            return np.flatnonzero(indices), False
+
+        indices = indices.astype(np.int64).ravel()
+        if np.any((indices < -nmr_voxels) | (indices >= nmr_voxels)):
+            raise IndexError('Index out of bounds for {} voxels.'.format(nmr_voxels))
+        return np.where(indices < 0, indices + nmr_voxels, indices), False
+
+    def _read_block(self, block):
+        if self._cached_block[0] == block:
+            return self._cached_block[1]
+
+        offset, nmr_bytes, nmr_rows = self._blocks[block]
+        with open(os.path.join(self._path, 'data.bin'), 'rb') as f:
+            f.seek(offset)
+            data = zlib.decompress(f.read(nmr_bytes))
+
+        values = _unshuffle(data, self._info['storage_dtype'], (nmr_rows, self.shape[1])).astype(self.dtype)
+        self._cached_block = (block, values)
+        return values
+
+
+class SampleReduction(object):
+
+    def __init__(self, thinning=1, last_n=None, parameters=None, quantiles=None):
+        """Reduces the sample chains before they are stored.
+
+        This only changes what we store, the sampling itself is not affected. The chains are first thinned, after
+        which only the last samples are kept.
+
+        Args:
+            thinning (int): store only every k-th sample, the last sample of every chain is always kept
+            last_n (int): if set, only store the last n (thinned) samples
+            parameters (list of str): if set, only store the chains of these parameters
+            quantiles (list of float): if set, we do not store the chains but only these quantiles of every chain
+        """
+        self.thinning = int(thinning or 1)
+        self.last_n = last_n
+        self.parameters = parameters
+        self.quantiles = quantiles
+
+        if self.thinning < 1:
+            raise ValueError('The thinning should be a positive integer, {} given.'.format(thinning))
+        if self.last_n is not None and self.last_n < 1:
+            raise ValueError('The last_n should be a positive integer, {} given.'.format(last_n))
+
+    @classmethod
+    def load(cls, directory):
+        """Load the reduction with which the samples in the given directory were stored.
+
+        Args:
+            directory (str): the samples directory
+
+        Returns:
+            SampleReduction: the recorded reduction, or the identity reduction if none was recorded
+        """
+        path = os.path.join(directory, SAMPLE_REDUCTION_FNAME)
+        if not os.path.isfile(path):
+            return cls()
+        with open(path, 'r') as f:
+            return cls(**json.load(f))
+
+    def save(self, directory):
+        """Record this reduction in the given samples directory, see :meth:`load`.
+
+        The identity reduction is not recorded, an existing record is then removed.
+
+        Args:
+            directory (str): the samples directory
+        """
+        path = os.path.join(directory, SAMPLE_REDUCTION_FNAME)
+        if self.is_identity:
+            if os.path.isfile(path):
+                os.remove(path)
+            return
+
+        with open(path, 'w') as f:
+            json.dump({'thinning': self.thinning, 'last_n': self.last_n,
+                       'parameters': self.parameters, 'quantiles': self.quantiles}, f)
+
+    @property
+    def is_identity(self):
+        """If the complete chains of all parameters are stored, that is, if this does not reduce anything."""
+        return self.thinning == 1 and self.last_n is None and self.parameters is None and not self.quantiles
+
+    @property
+    def stores_chains(self):
+        """If the (reduced) chains are stored, if False only the quantiles are stored."""
+        return not self.quantiles
+
+    def reduce_chains(self, samples):
+        """Reduce the given chains.
+
+        Args:
+            samples (dict): per parameter the (d, n) matrix with the samples of d voxels, or a (d, m, n) matrix when
+                sampling m chains per voxel
+
+        Returns:
+            dict: per selected parameter the reduced samples
+        """
+        return {name: self._reduce_chain(chain) for name, chain in self._select(samples).items()}
+
+    def get_quantile_maps(self, samples):
+        """Get the configured quantiles of the given chains.
+
+        With multiple chains per voxel, the quantiles are taken over the samples of all chains.
+
+        Args:
+            samples (dict): per parameter the (d, n) matrix with the samples of d voxels, or a (d, m, n) matrix when
+                sampling m chains per voxel
+
+        Returns:
+            dict: per selected parameter and quantile a map of d values, with keys ``<param>.percentile_<percentile>``
+        """
+        results = {}
+        for name, chain in self._select(samples).items():
+            chain = self._reduce_chain(chain)
+            percentiles = np.percentile(np.reshape(chain, (chain.shape[0], -1)),
+                                        [q * 100 for q in self.quantiles], axis=1)
+            for quantile, values in zip(self.quantiles, percentiles):
+                results['{}.percentile_{:g}'.format(name, quantile * 100)] = values
+        return results
+
+    def _select(self, samples):
+        if self.parameters is None:
+            return samples
+
+        unknown = set(self.parameters) - set(samples)
+        if unknown:
+            raise ValueError('Can not store the samples of the unknown parameters {}.'.format(sorted(unknown)))
+        return {name: samples[name] for name in self.parameters}
+
+    def _reduce_chain(self, chain):
+        if self.thinning > 1:
+            chain = chain[..., (chain.shape[-1] - 1) % self.thinning::self.thinning]
+        if self.last_n is not None:
+            chain = chain[..., -self.last_n:]
+        return chain
+
+
+def _shuffle(values):
+    """Byte-shuffle the given array, grouping the n-th byte of every value together.
+
+    This groups the bytes of the exponents and of the mantissas of floating point values, which makes similar
+    values much better compressible.
+    """
+    values = np.ascontiguousarray(values)
+    return np.ascontiguousarray(values.view(np.uint8).reshape(-1, values.dtype.itemsize).T).tobytes()
+
+
+def _unshuffle(data, dtype, shape):
+    """Undo the byte-shuffling of :func:`_shuffle`."""
+    dtype = np.dtype(dtype)
+    shuffled = np.frombuffer(data, dtype=np.uint8).reshape(dtype.itemsize, -1)
+    return np.ascontiguousarray(shuffled.T).view(dtype).reshape(shape)
+
+
+def _save_atomic(path, array):
+    """Save the given array to a .npy file by replacing the current file in one step."""
+    tmp_path = path + '.tmp.npy'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+        f.flush()
+        os.fsync(f.fileno())
+
+    if hasattr(os, 'replace'):
+        os.replace(tmp_path, path)
+    else:
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path)
+        os.rename(tmp_path, path)
@@ -1,8 +1,10 @@
 import collections
 import distutils.dir_util
 import glob
+import json
 import logging
 import logging.config as logging_config
+import multiprocessing
 import os
 import re
 import shutil
@@ -19,7 +21,7 @@ from scipy.special import jnp_zeros
 from six import string_types
 
 import mot.utils
-from mdt.nifti import load_nifti, write_nifti, write_all_as_nifti, get_all_image_data
+from mdt.nifti import load_nifti, write_nifti, write_all_as_nifti, get_all_image_data, map_threaded
 from mdt.cl_routines.mapping.calculate_eigenvectors import CalculateEigenvectors
 from mdt.components_loader import get_model
 from mdt.configuration import get_config_dir
@@ -31,12 +33,13 @@ from mdt.deferred_mappings import DeferredActionDict, DeferredActionTuple
 from mdt.exceptions import NoiseStdEstimationNotPossible
 from mdt.log_handlers import ModelOutputLogHandler
 from mdt.protocols import load_protocol, write_protocol
+from mdt.sample_storage import CompressedSamples, COMPRESSED_SAMPLES_EXTENSION
 from mot.cl_environments import CLEnvironmentFactory
 from mot.cl_routines.mapping.calculate_model_estimates import CalculateModelEstimates
 from mot.cl_routines.mapping.error_measures import ErrorMeasures
 from mot.cl_routines.mapping.loglikelihood_calculator import LogLikelihoodCalculator
 from mot.cl_routines.mapping.residual_calculator import ResidualCalculator
-from mot.mcmc_diagnostics import multivariate_ess, univariate_ess
+from mot.mcmc_diagnostics import estimate_multivariate_ess, estimate_univariate_ess_standard_error
 from mot.model_building.problem_data import AbstractProblemData
 from mot.utils import results_to_dict
 
@@ -54,6 +57,9 @@ __email__ = "robbert.harms@maastrichtuniversity.nl"
 
 class DMRIProblemData(AbstractProblemData):
 
+    max_cached_subsets = 2
+    """The number of volume subsets cached by :meth:`get_subset`."""
+
     def __init__(self, protocol, dwi_volume, mask, volume_header, static_maps=None, gradient_deviations=None,
                  noise_std=None):
         """An implementation of the problem data for diffusion MRI models.
@@ -83,6 +89,9 @@ class DMRIProblemData(AbstractProblemData):
         self._static_maps = static_maps or {}
         self.gradient_deviations = gradient_deviations
         self._noise_std = noise_std
+        self._subsets_cache = collections.OrderedDict()
+        self._static_maps_roi = None
+        self._noise_std_roi = None
 
     def copy_with_updates(self, *args, **kwargs):
         """Create a copy of this problem data, while setting some of the arguments to new values.
@@ -120,6 +129,13 @@ class DMRIProblemData(AbstractProblemData):
         One can either specify a list with volumes to keep or a list with volumes to remove (and we will keep the rest).
         At least one and at most one list must be specified.
 
+        The most recently used subsets are cached per selection of volumes, such that consecutive models fitted on
+        the same subject with the same volume selection share the subset DWI volume and its ROI observations. Only
+        the last ``max_cached_subsets`` subsets are kept, such that the subset copies of the DWI volume do not
+        accumulate over a cascade. If the observations of this problem data are already loaded (see
+        :meth:`load_observations`), the observations of the subset are taken from those instead of extracting them
+        again from the DWI volume.
+
         Args:
             volumes_to_keep (list): the list with volumes we would like to keep.
             volumes_to_remove (list): the list with volumes we would like to remove (keeping the others).
@@ -143,9 +159,22 @@ class DMRIProblemData(AbstractProblemData):
             for remove_ind in volumes_to_remove:
                 del volumes_to_keep[remove_ind]
 
-        new_protocol = self.protocol.get_new_protocol_with_indices(volumes_to_keep)
-        new_dwi_volume = self.dwi_volume[..., volumes_to_keep]
-        return self.copy_with_updates(new_protocol, new_dwi_volume)
+        cache_key = tuple(int(ind) for ind in volumes_to_keep)
+        subset = self._subsets_cache.pop(cache_key, None)
+
+        if subset is None:
+            new_protocol = self.protocol.get_new_protocol_with_indices(volumes_to_keep)
+            new_dwi_volume = self.dwi_volume[..., volumes_to_keep]
+            subset = self.copy_with_updates(new_protocol, new_dwi_volume)
+
+            if self._observation_list is not None:
+                subset._observation_list = self._observation_list[:, volumes_to_keep]
+            subset._static_maps_roi = self._static_maps_roi
+
+        self._subsets_cache[cache_key] = subset
+        while len(self._subsets_cache) > self.max_cached_subsets:
+            self._subsets_cache.popitem(last=False)
+        return subset
 
     def get_nmr_inst_per_problem(self):
         return self._protocol.length
@@ -154,12 +183,23 @@ class DMRIProblemData(AbstractProblemData):
     def protocol(self):
         return self._protocol
 
-    @property
-    def observations(self):
+    def load_observations(self):
+        """Extract the observations of the voxels in the mask from the DWI volume, if not already done.
+
+        Subsets created afterwards with :meth:`get_subset` take their observations from these, instead of extracting
+        them again from the DWI volume.
+
+        Returns:
+            ndarray: the observations
+        """
         if self._observation_list is None:
             self._observation_list = create_roi(self.dwi_volume, self._mask)
         return self._observation_list
 
+    @property
+    def observations(self):
+        return self.load_observations()
+
     @property
     def mask(self):
         """Return the mask in use
@@ -178,33 +218,34 @@ class DMRIProblemData(AbstractProblemData):
         """
         self._mask = new_mask
         self._observation_list = None
+        self._subsets_cache = collections.OrderedDict()
+        self._static_maps_roi = None
+        self._noise_std_roi = None
 
     @property
     def static_maps(self):
         """Get the static maps. They are used as data for the static parameters.
 
+        The static maps are loaded lazily, on first request of every map, and are cached until the mask changes.
+
         Returns:
             Dict[str, val]: per static map the value for the static map. This can either be an one or two dimensional
                 matrix containing the values for each problem instance or it can be a single value we will use
                 for all problem instances.
         """
         if self._static_maps is not None:
-            return_items = {}
-
-            for key, val in self._static_maps.items():
-
-                loaded_val = None
-
-                if isinstance(val, six.string_types):
-                    loaded_val = create_roi(load_nifti(val).get_data(), self.mask)
-                elif isinstance(val, np.ndarray):
-                    loaded_val = create_roi(val, self.mask)
-                elif is_scalar(val):
-                    loaded_val = val
-
-                return_items[key] = loaded_val
-
-            return return_items
+            if self._static_maps_roi is None:
+                def load_static_map(_, val):
+                    if isinstance(val, six.string_types):
+                        return create_roi(load_nifti(val).get_data(), self.mask)
+                    elif isinstance(val, np.ndarray):
+                        return create_roi(val, self.mask)
+                    elif is_scalar(val):
+                        return val
+                    return None
+
+                self._static_maps_roi = DeferredActionDict(load_static_map, self._static_maps)
+            return self._static_maps_roi
 
         return self._static_maps
 
@@ -215,9 +256,14 @@ class DMRIProblemData(AbstractProblemData):
         During optimization or sampling the model will be evaluated against the observations using an evaluation
         model. Most of these evaluation models need to have a standard deviation.
 
+        The noise std is determined once and is cached until the mask changes.
+
         Returns:
             number of ndarray: either a scalar or a 2d matrix with one value per problem instance.
         """
+        if self._noise_std_roi is not None:
+            return self._noise_std_roi
+
         try:
             noise_std = autodetect_noise_std_loader(self._noise_std).get_noise_std(self)
         except NoiseStdEstimationNotPossible:
@@ -228,9 +274,10 @@ class DMRIProblemData(AbstractProblemData):
         self._noise_std = noise_std
 
         if is_scalar(noise_std):
-            return noise_std
+            self._noise_std_roi = noise_std
         else:
-            return create_roi(noise_std, self.mask)
+            self._noise_std_roi = create_roi(noise_std, self.mask)
+        return self._noise_std_roi
 
 
 class MockDMRIProblemData(DMRIProblemData):
@@ -726,7 +773,7 @@ def restore_volumes(data, brain_mask, with_volume_dim=True):
             else:
                 return restore_3d(voxel_list[:, 0])
         else:
-            volume = restore_3d(voxel_list)
+            volume = restore_3d(np.reshape(voxel_list, (-1,)))
 
             if with_volume_dim:
                 return np.expand_dims(volume, axis=3)
@@ -1282,9 +1329,18 @@ def apply_mask_to_file(input_fname, mask, output_fname=None):
     write_nifti(apply_mask(input_fname, mask), load_nifti(input_fname).get_header(), output_fname)
 
 
+SAMPLE_SEGMENTS_DIR_NAME = 'sample_segments'
+"""The subdirectory of a samples directory containing the appended sample segments."""
+
+
 def load_samples(data_folder, mode='r'):
     """Load sampled results as a dictionary of numpy memmap.
 
+    The samples of a sampling run are stored as one ``.npy`` file per parameter, or, in the compressed format, as
+    one :class:`~mdt.sample_storage.CompressedSamples` directory per parameter. If samples were appended to the
+    run (see :func:`append_sample_segment`), the appended samples are stored as separate segments. In that case we
+    return per parameter a :class:`SegmentedSamples` object which presents the segments as one (read only) array.
+
     Args:
         data_folder (str): the folder from which to use the samples
         mode (str): the mode in which to open the memory mapped sample files (see numpy mode parameter)
@@ -1292,14 +1348,170 @@ def load_samples(data_folder, mode='r'):
     Returns:
         dict: the memory loaded samples per sampled parameter.
     """
+    data_dict = _load_samples_segment(data_folder, mode)
+
+    segment_dirs = get_sample_segment_dirs(data_folder)
+    if segment_dirs:
+        segments = [data_dict] + [_load_samples_segment(segment_dir, mode) for segment_dir in segment_dirs]
+        data_dict = {map_name: SegmentedSamples([segment[map_name] for segment in segments])
+                     for map_name in data_dict}
+
+    return data_dict
+
+
+def _load_samples_segment(data_folder, mode):
     data_dict = {}
     for fname in glob.glob(os.path.join(data_folder, '*.samples.npy')):
         samples = open_memmap(fname, mode=mode)
         map_name = os.path.basename(fname)[0:-len('.samples.npy')]
         data_dict.update({map_name: samples})
+
+    for path in glob.glob(os.path.join(data_folder, '*' + COMPRESSED_SAMPLES_EXTENSION)):
+        if CompressedSamples.is_store(path):
+            map_name = os.path.basename(path)[0:-len(COMPRESSED_SAMPLES_EXTENSION)]
+            data_dict.update({map_name: CompressedSamples(path)})
     return data_dict
 
 
+def get_sample_segment_dirs(data_folder):
+    """Get the directories of the sample segments appended to the samples in the given folder.
+
+    Args:
+        data_folder (str): the folder with the samples
+
+    Returns:
+        list of str: the directories with the appended segments, in the order in which they were appended
+    """
+    index_file = os.path.join(data_folder, SAMPLE_SEGMENTS_DIR_NAME, 'index.json')
+    if not os.path.isfile(index_file):
+        return []
+
+    with open(index_file, 'r') as f:
+        segments = json.load(f)['segments']
+    return [os.path.join(data_folder, SAMPLE_SEGMENTS_DIR_NAME, segment) for segment in segments]
+
+
+def append_sample_segment(data_folder, samples_dir):
+    """Append the samples in the given directory as a new segment to the samples in the data folder.
+
+    This moves the ``.samples.npy`` files from the samples directory into a new segment directory, as such this
+    does not copy or rewrite any of the existing or new samples.
+
+    Args:
+        data_folder (str): the folder with the samples we append to
+        samples_dir (str): the folder with the samples to append, these should have the same parameters and the
+            same number of voxels as the samples in the data folder.
+
+    Returns:
+        str: the directory of the new segment
+    """
+    segments_dir = os.path.join(data_folder, SAMPLE_SEGMENTS_DIR_NAME)
+    segment_names = [os.path.basename(d) for d in get_sample_segment_dirs(data_folder)]
+
+    segment_name = 'segment_{0:04d}'.format(len(segment_names) + 1)
+    segment_dir = os.path.join(segments_dir, segment_name)
+    if os.path.exists(segment_dir):
+        shutil.rmtree(segment_dir)
+    os.makedirs(segment_dir)
+
+    for fname in glob.glob(os.path.join(samples_dir, '*.samples.npy')) + \
+            glob.glob(os.path.join(samples_dir, '*' + COMPRESSED_SAMPLES_EXTENSION)):
+        shutil.move(fname, os.path.join(segment_dir, os.path.basename(fname)))
+
+    tmp_index_file = os.path.join(segments_dir, 'index.json.tmp')
+    with open(tmp_index_file, 'w') as f:
+        json.dump({'segments': segment_names + [segment_name]}, f)
+    os.rename(tmp_index_file, os.path.join(segments_dir, 'index.json'))
+
+    return segment_dir
+
+
+def remove_sample_segments(data_folder):
+    """Remove all the appended sample segments from the given samples folder.
+
+    Args:
+        data_folder (str): the folder with the samples
+    """
+    if os.path.isdir(os.path.join(data_folder, SAMPLE_SEGMENTS_DIR_NAME)):
+        shutil.rmtree(os.path.join(data_folder, SAMPLE_SEGMENTS_DIR_NAME))
+
+
+class SegmentedSamples(object):
+
+    def __init__(self, segments):
+        """Presents a list of sample segments as a single (read only) array concatenated over the samples.
+
+        This supports the shape, dtype and indexing (with at most two indices) of a regular samples array. Only
+        the segments covering the selected samples are read.
+
+        Args:
+            segments (list of ndarray): the (v, n_i) sample matrices of the segments, with v the number of voxels
+                and n_i the number of samples in segment i.
+        """
+        self._segments = segments
+        self._offsets = np.cumsum([0] + [segment.shape[1] for segment in segments])
+
+    @property
+    def segments(self):
+        return self._segments
+
+    @property
+    def shape(self):
+        return self._segments[0].shape[0], int(self._offsets[-1])
+
+    @property
+    def dtype(self):
+        return self._segments[0].dtype
+
+    @property
+    def ndim(self):
+        return 2
+
+    @property
+    def size(self):
+        return self.shape[0] * self.shape[1]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        if dtype is None:
+            return self[:, :]
+        return self[:, :].astype(dtype)
+
+    def __getitem__(self, item):
+        if not isinstance(item, tuple):
+            item = (item,)
+        if len(item) > 2:
+            raise IndexError('Too many indices for the segmented samples.')
+
+        rows = item[0]
+        sample_ind = np.arange(self.shape[1])[item[1] if len(item) > 1 else slice(None)]
+        is_scalar_sample = sample_ind.ndim == 0
+        sample_ind = np.atleast_1d(sample_ind)
+
+        segment_ind = np.searchsorted(self._offsets[1:], sample_ind, side='right')
+
+        result = None
+        for segment in np.unique(segment_ind):
+            positions = np.flatnonzero(segment_ind == segment)
+            local_ind = sample_ind[positions] - self._offsets[segment]
+
+            start, end = local_ind.min(), local_ind.max() + 1
+            values = self._segments[segment][rows, start:end][..., local_ind - start]
+
+            if result is None:
+                result = np.empty(values.shape[:-1] + (len(sample_ind),), dtype=self.dtype)
+            result[..., positions] = values
+
+        if result is None:
+            result = np.empty(self._segments[0][rows, 0:0].shape, dtype=self.dtype)
+
+        if is_scalar_sample:
+            return result[..., 0]
+        return result
+
+
 def estimate_noise_std(problem_data, estimator=None):
     """Estimate the noise standard deviation.
 
@@ -1700,7 +1912,8 @@ def get_example_data(output_directory):
                 shutil.copy(full_fname, dataset_output_path)
 
 
-def sort_orientations(data_input, weight_names, extra_sortable_maps):
+def sort_orientations(data_input, weight_names, extra_sortable_maps, mask=None, voxels_per_block=100000,
+                      nmr_threads=1):
     """Sort the orientations of multi-direction models voxel-wise.
 
     For instance, the optimization results of a BallStick_r3 fit (hence, with three Sticks) gives angles and volume
@@ -1713,6 +1926,11 @@ def sort_orientations(data_input, weight_names, extra_sortable_maps):
     This method accepts as input results from (MDT) model fitting and is able to sort all the maps belonging to
     a given set of equal compartments per voxel.
 
+    The sorting is done in blocks of voxels, such that next to the sorted maps only a few small temporary arrays are
+    needed. If a directory is given, the loaded maps are sorted in place. If a dictionary is given, the given maps are
+    left unchanged and every sorted map is a copy, made just before its group of maps is sorted. The sorted maps have
+    the same shape as the input maps.
+
     Example::
 
         sort_orientations('./output/BallStick_r3',
@@ -1727,6 +1945,11 @@ def sort_orientations(data_input, weight_names, extra_sortable_maps):
         extra_sortable_maps (iterable of iterable): the list of additional maps to sort. Every element in the given
             list should be another list with the names of the maps. The length of these second layer of lists should
             match the length of the ``weight_names``.
+        mask (str or ndarray): the mask with the voxels to sort, either a 3d volume or the path to one. Voxels outside
+            the mask keep their input values. If not given, all the voxels are sorted.
+        voxels_per_block (int): the number of voxels we sort at once, this bounds the size of the temporary arrays
+        nmr_threads (int): the number of threads used to sort the groups of maps, if None we use the number of CPU's,
+            if one or lower we sort all the groups in the current thread.
 
     Returns:
         dict: the sorted results in a new dictionary.
@@ -1734,30 +1957,69 @@ def sort_orientations(data_input, weight_names, extra_sortable_maps):
     if isinstance(data_input, six.string_types):
         input_maps = get_all_image_data(data_input)
         result_maps = input_maps
+        copy_maps = False
     else:
         input_maps = data_input
         result_maps = copy(input_maps)
+        copy_maps = True
 
     weight_names = list(weight_names)
-    sortable_maps = copy(extra_sortable_maps)
+    sortable_maps = [list(names) for names in extra_sortable_maps]
     sortable_maps.append(weight_names)
 
-    sort_index_matrix = create_sort_matrix([input_maps[k] for k in weight_names], reversed_sort=True)
+    volume_shape = np.shape(input_maps[weight_names[0]])[:3]
+    if mask is None:
+        voxel_indices = None
+        nmr_voxels = int(np.prod(volume_shape))
+    else:
+        voxel_indices = np.flatnonzero(autodetect_brain_mask_loader(mask).get_data() > 0)
+        nmr_voxels = len(voxel_indices)
+
+    def get_block(start):
+        if voxel_indices is None:
+            indices = np.arange(start, min(start + voxels_per_block, nmr_voxels))
+        else:
+            indices = voxel_indices[start:start + voxels_per_block]
+        return np.unravel_index(indices, volume_shape)
+
+    def get_values(volume, block):
+        values = volume[block]
+        return np.reshape(values, (values.shape[0], -1))
+
+    sort_indices = []
+    for start in range(0, nmr_voxels, voxels_per_block):
+        block = get_block(start)
+        weights = np.stack([get_values(input_maps[name], block)[:, 0] for name in weight_names], axis=1)
+        sort_indices.append(np.argsort(weights, axis=1)[:, ::-1])
+
+    def sort_group(names):
+        if copy_maps:
+            volumes = [np.array(input_maps[name]) for name in names]
+        else:
+            volumes = [np.asarray(input_maps[name]) for name in names]
+
+        for start, sort_index in zip(range(0, nmr_voxels, voxels_per_block), sort_indices):
+            block = get_block(start)
+            values = np.stack([get_values(volume, block) for volume in volumes], axis=1)
+            values = values[np.arange(values.shape[0])[:, None], sort_index]
+            for ind, volume in enumerate(volumes):
+                volume[block] = np.reshape(values[:, ind], (values.shape[0],) + volume.shape[3:])
 
-    for sortable_map_names in sortable_maps:
-        sorted = dict(zip(sortable_map_names, sort_volumes_per_voxel([input_maps[k] for k in sortable_map_names],
-                                                                     sort_index_matrix)))
-        result_maps.update(sorted)
+        return dict(zip(names, volumes))
 
+    for sorted_maps in map_threaded(sort_group, sortable_maps, nmr_threads):
+        result_maps.update(sorted_maps)
     return result_maps
 
 
-def post_process_samples(model, sampling_output):
+def post_process_samples(model, sampling_output, calculate_ess=True):
     """Post process MCMC samples
 
     Args:
         model (mdt.models.composite.DMRICompositeModel): the model corresponding to the samples results
         sampling_output (mot.cl_routines.sampling.base.SamplingOutput): the sampling output
+        calculate_ess (boolean): if we want to add the ESS maps. Since these do not depend on the model, these
+            can also be computed afterwards, and in parallel, using :func:`calculate_sample_ess_maps`.
 
     Returns:
         tuple: first element a dictionary with the samples split up into parameters.
@@ -1767,19 +2029,178 @@ def post_process_samples(model, sampling_output):
 
     samples_dict = results_to_dict(samples, model.get_optimized_param_names())
     volume_maps = model.add_extra_result_maps(model.samples_to_statistics(samples_dict))
+    volume_maps.update(_get_sampling_error_measures(model, volume_maps))
 
-    errors = ResidualCalculator().calculate(model, volume_maps)
-    error_measures = ErrorMeasures(double_precision=model.double_precision).calculate(errors)
-    volume_maps.update(error_measures)
+    if calculate_ess:
+        volume_maps.update(calculate_sample_ess_maps(samples, model.get_optimized_param_names()))
 
-    mv_ess = multivariate_ess(samples)
-    volume_maps.update(MultivariateESS=mv_ess)
+    return samples_dict, volume_maps
 
-    uv_ess = univariate_ess(samples, method='standard_error')
-    uv_ess_maps = results_to_dict(uv_ess, [a + '.UnivariateESS' for a in model.get_optimized_param_names()])
-    volume_maps.update(uv_ess_maps)
 
-    return samples_dict, volume_maps
+def calculate_sample_ess_maps(samples, param_names, pool=None, voxels_per_block=100):
+    """Estimate the multivariate and the univariate Effective Sample Size maps of the given samples.
+
+    This gives the same results as :func:`mot.mcmc_diagnostics.multivariate_ess` and
+    :func:`mot.mcmc_diagnostics.univariate_ess` (using the standard error method), but partitions the voxels
+    in blocks which can be processed on a pool of processes. This does not depend on the model, as such it is safe
+    to call while the model is processing other voxels.
+
+    Args:
+        samples (ndarray): a matrix of shape (d, p, n) with d problems, p parameters and n samples
+        param_names (list of str): the names of the p parameters
+        pool (multiprocessing.Pool): the pool of processes to use, see :func:`create_process_pool`. If None we
+            process the blocks in the current process.
+        voxels_per_block (int): the number of voxels to process per block
+
+    Returns:
+        dict: the volume maps, 'MultivariateESS' and a '<param_name>.UnivariateESS' map per parameter
+    """
+    blocks = [samples[ind:ind + voxels_per_block] for ind in range(0, samples.shape[0], voxels_per_block)]
+
+    if pool is not None and len(blocks) > 1:
+        block_results = pool.map(_calculate_ess_block, blocks)
+    else:
+        block_results = list(map(_calculate_ess_block, blocks))
+
+    if not block_results:
+        block_results = [(np.zeros((0,)), np.zeros((0, len(param_names))))]
+
+    volume_maps = {'MultivariateESS': np.concatenate([mv_ess for mv_ess, _ in block_results])}
+    volume_maps.update(results_to_dict(np.concatenate([uv_ess for _, uv_ess in block_results]),
+                                       [name + '.UnivariateESS' for name in param_names]))
+    return volume_maps
+
+
+def create_process_pool(nmr_processes=None):
+    """Create a pool of processes for the CPU bound post-processing, like :func:`calculate_sample_ess_maps`.
+
+    Where possible (Python 3.4 and up) the processes are started using the 'spawn' method. Contrary to forking, this
+    does not copy the state of the current process, like the OpenCL contexts and the locks held by other threads,
+    which makes it safe to create the pool from a background thread. Since the spawned processes import the main
+    module, scripts using the pool should guard their main code with ``if __name__ == '__main__'``.
+
+    Args:
+        nmr_processes (int): the number of processes, if None we use one per CPU
+
+    Returns:
+        multiprocessing.Pool or None: the pool, or None if one or fewer processes were requested or if the pool
+            could not be created. Please close the pool after use.
+    """
+    if nmr_processes is None:
+        nmr_processes = multiprocessing.cpu_count()
+    if nmr_processes <= 1:
+        return None
+
+    context = multiprocessing
+    if hasattr(multiprocessing, 'get_context'):
+        context = multiprocessing.get_context('spawn')
+
+    try:
+        return context.Pool(nmr_processes)
+    except OSError:
+        return None
+
+
+def calculate_rhat_maps(samples, param_names):
+    r"""Calculate the potential scale reduction factor (R-hat) and the split R-hat of multiple chains per voxel.
+
+    The R-hat compares the variance between the chains with the variance within the chains:
+
+    .. math::
+
+        \hat{R} = \sqrt{\frac{\frac{n - 1}{n} W + \frac{1}{n} B}{W}}
+
+    with :math:`W` the mean of the within chain variances and :math:`B / n` the variance of the chain means. For the
+    split R-hat every chain is first split in two halves, which also detects chains that did not converge within
+    themselves. Values close to one indicate convergence.
+
+    Args:
+        samples (ndarray): a matrix of shape (d, m, p, n) with d problems, m chains, p parameters and n samples
+        param_names (list of str): the names of the p parameters
+
+    Returns:
+        dict: per parameter a '<param_name>.RHat' and a '<param_name>.SplitRHat' map
+
+    References:
+        Gelman A, Carlin JB, Stern HS, Dunson DB, Vehtari A, Rubin DB (2013). Bayesian Data Analysis,
+        third edition. Chapman and Hall/CRC.
+    """
+    nmr_samples = samples.shape[3]
+    half_length = nmr_samples // 2
+    split_samples = np.concatenate([samples[..., :half_length], samples[..., nmr_samples - half_length:]], axis=1)
+
+    rhat = _potential_scale_reduction(samples)
+    split_rhat = _potential_scale_reduction(split_samples)
+
+    volume_maps = {}
+    for ind, name in enumerate(param_names):
+        volume_maps[name + '.RHat'] = rhat[:, ind]
+        volume_maps[name + '.SplitRHat'] = split_rhat[:, ind]
+    return volume_maps
+
+
+def _potential_scale_reduction(samples):
+    """Compute the R-hat of the (d, m, p, n) chains, returns a (d, p) matrix."""
+    nmr_samples = samples.shape[3]
+    samples = samples.astype(np.float64)
+
+    within_chain_variance = np.mean(np.var(samples, axis=3, ddof=1), axis=1)
+    between_chain_variance = np.var(np.mean(samples, axis=3), axis=1, ddof=1)
+
+    pooled_variance = (nmr_samples - 1.) / nmr_samples * within_chain_variance + between_chain_variance
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sqrt(pooled_variance / within_chain_variance)
+
+
+def _calculate_ess_block(samples):
+    """Estimate the multivariate and univariate ESS of a block of voxels, used by :func:`calculate_sample_ess_maps`.
+
+    Args:
+        samples (ndarray): the (d, p, n) samples of a block of voxels
+
+    Returns:
+        tuple: the multivariate ESS as a (d,) vector and the univariate ESS as a (d, p) matrix
+    """
+    mv_ess = np.array([estimate_multivariate_ess(voxel_samples) for voxel_samples in samples])
+
+    uv_ess = np.zeros(samples.shape[:2])
+    for voxel_ind, voxel_samples in enumerate(samples):
+        for param_ind in range(samples.shape[1]):
+            uv_ess[voxel_ind, param_ind] = estimate_univariate_ess_standard_error(voxel_samples[param_ind])
+
+    return mv_ess, uv_ess
+
+
+def post_process_sample_statistics(model, statistics_maps):
+    """Post process the MCMC sample statistics that were computed online.
+
+    This is the counterpart of :func:`post_process_samples` for when the statistics are accumulated while sampling,
+    instead of computed from the complete chains.
+
+    Args:
+        model (mdt.models.composite.DMRICompositeModel): the model corresponding to the samples results
+        statistics_maps (dict): the maps with the sample statistics, as returned by
+            :meth:`mdt.sample_statistics.OnlineSampleStatistics.get_all_maps`
+
+    Returns:
+        dict: the volumetric voxel values (in ROI space)
+    """
+    param_maps = {}
+    for name in model.get_optimized_param_names():
+        param_maps[name] = statistics_maps[name]
+        param_maps[name + '.std'] = statistics_maps[name + '.std']
+
+    volume_maps = model.add_extra_result_maps(param_maps)
+    volume_maps.update(_get_sampling_error_measures(model, volume_maps))
+    volume_maps.update({key: value for key, value in statistics_maps.items() if key not in param_maps})
+    return volume_maps
+
+
+def _get_sampling_error_measures(model, volume_maps):
+    """Get the error measures of the residuals of the model evaluated at the mean of the samples."""
+    errors = ResidualCalculator().calculate(model, volume_maps)
+    return ErrorMeasures(double_precision=model.double_precision).calculate(errors)
 
 
 def post_process_optimization(model, optimization_results):
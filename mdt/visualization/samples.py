@@ -1,8 +1,11 @@
+import collections
+import threading
+
 import matplotlib.pyplot as plt
+import numpy as np
 from matplotlib.gridspec import GridSpec
 from matplotlib.widgets import Slider
 from scipy.stats import norm
-import matplotlib.mlab as mlab
 
 __author__ = 'Robbert Harms'
 __date__ = "2016-09-02"
@@ -12,7 +15,18 @@ __email__ = "robbert.harms@maastrichtuniversity.nl"
 
 class SampleVisualizer(object):
 
-    def __init__(self, voxels):
+    def __init__(self, voxels, cache_size=100, nmr_prefetch=5):
+        """Visualizes the samples per voxel.
+
+        The plots are created once and updated in place when the voxel changes. The samples, histograms and
+        Gaussian fits of the voxels are cached, and the neighbouring voxels of the shown voxel are loaded in the
+        background, such that scrubbing through the voxels of (memory mapped) sample files stays interactive.
+
+        Args:
+            voxels (dict): per map the (voxels, samples) matrix with the samples, this can be memory mapped
+            cache_size (int): the maximum number of voxels kept in the cache
+            nmr_prefetch (int): the number of voxels before and after the shown voxel we load in the background
+        """
         self._voxels = voxels
         self.voxel_ind = 0
         self.maps_to_show = sorted(self._voxels.keys())
@@ -26,6 +40,10 @@ class SampleVisualizer(object):
         self._nmr_bins = 30
         self._show_slider = True
         self._fit_gaussian = True
+        self._cache_size = cache_size
+        self._nmr_prefetch = nmr_prefetch
+        self._plot_data = None
+        self._artists = {}
 
     def show(self, voxel_ind=0, names=None, maps_to_show=None, to_file=None, block=True, maximize=False,
              show_trace=True, nmr_bins=20, window_title=None, show_sliders=True, fit_gaussian=True,
@@ -60,12 +78,20 @@ class SampleVisualizer(object):
             self.names = names
         if maps_to_show:
             self.maps_to_show = maps_to_show
-        self.voxel_ind = voxel_ind
+        self.voxel_ind = int(round(voxel_ind))
         self._nmr_bins = nmr_bins or self._nmr_bins
         self._show_trace = show_trace
         self.show_sliders = show_sliders
         self._fit_gaussian = fit_gaussian
 
+        if self._plot_data is not None:
+            self._plot_data.close()
+        self._plot_data = _VoxelPlotDataCache(self._voxels, {name: self._get_nmr_bins(name)
+                                                             for name in self.maps_to_show},
+                                              self._fit_gaussian, cache_size=self._cache_size,
+                                              nmr_prefetch=0 if to_file else self._nmr_prefetch)
+        self._figure.canvas.mpl_connect('close_event', _get_close_callback(self._plot_data))
+
         self._setup()
 
         if maximize:
@@ -96,6 +122,7 @@ class SampleVisualizer(object):
             self._updating_sliders = False
 
     def _setup(self):
+        self._create_plots()
         self._rerender()
 
         self._max_voxel_ind = max([self._voxels[map_name].shape[0] for map_name in self.maps_to_show])
@@ -109,42 +136,198 @@ class SampleVisualizer(object):
                                                      color='DarkSeaGreen', closedmin=True, closedmax=True)
             self._voxel_slider.on_changed(self.set_voxel)
 
-    def _rerender(self):
+    def _create_plots(self):
+        """Create the subplots and their (empty) artists, these are updated in place by :meth:`_rerender`."""
         nmr_maps = len(self.maps_to_show)
         if self._show_trace:
             nmr_maps *= 2
 
         grid = GridSpec(nmr_maps, 1, left=0.04, right=0.96, top=0.94, bottom=0.06, hspace=0.2)
 
+        self._artists = {}
+
         i = 0
         for map_name in self.maps_to_show:
-            samples = self._voxels[map_name]
-
-            title = map_name
-            if map_name in self.names:
-                title = self.names[map_name]
+            nmr_bins = self._get_nmr_bins(map_name)
+            artists = {}
 
-            if isinstance(self._nmr_bins, dict) and map_name in self._nmr_bins:
-                nmr_bins = self._nmr_bins[map_name]
-            else:
-                nmr_bins = self._nmr_bins
-
-            hist_plot = plt.subplot(grid[i])
-            n, bins, patches = hist_plot.hist(samples[self.voxel_ind, :], nmr_bins, normed=True)
-            plt.title(title)
+            hist_plot = self._figure.add_subplot(grid[i])
+            hist_plot.set_title(self.names.get(map_name, map_name))
+            artists['histogram'] = hist_plot.bar(np.arange(nmr_bins), np.zeros(nmr_bins), width=1, align='edge')
             i += 1
 
             if self._fit_gaussian:
-                mu, sigma = norm.fit(samples[self.voxel_ind, :])
-                bincenters = 0.5*(bins[1:] + bins[:-1])
-                y = mlab.normpdf(bincenters, mu, sigma)
-                hist_plot.plot(bincenters, y, 'r', linewidth=1)
+                artists['gaussian'] = hist_plot.plot([], [], 'r', linewidth=1)[0]
 
             if self._show_trace:
-                trace_plot = plt.subplot(grid[i])
-                trace_plot.plot(samples[self.voxel_ind, :])
+                trace_plot = self._figure.add_subplot(grid[i])
+                artists['trace'] = trace_plot.plot([], [])[0]
                 i += 1
 
+            self._artists[map_name] = artists
+
+    def _rerender(self):
+        plot_data = self._plot_data.get(self.voxel_ind)
+
+        for map_name in self.maps_to_show:
+            data = plot_data[map_name]
+            artists = self._artists[map_name]
+
+            for patch, left, width, height in zip(artists['histogram'], data.bin_edges[:-1],
+                                                  np.diff(data.bin_edges), data.histogram):
+                patch.set_x(left)
+                patch.set_width(width)
+                patch.set_height(height)
+
+            if self._fit_gaussian:
+                artists['gaussian'].set_data(*data.gaussian)
+            _rescale(artists['histogram'][0].axes)
+
+            if self._show_trace:
+                artists['trace'].set_data(np.arange(len(data.samples)), data.samples)
+                _rescale(artists['trace'].axes)
+
+        self._figure.canvas.draw_idle()
+        self._plot_data.prefetch(self.voxel_ind)
+
+    def _get_nmr_bins(self, map_name):
+        if isinstance(self._nmr_bins, dict) and map_name in self._nmr_bins:
+            return self._nmr_bins[map_name]
+        return self._nmr_bins
+
+
+_VoxelPlotData = collections.namedtuple('_VoxelPlotData', ['samples', 'histogram', 'bin_edges', 'gaussian'])
+"""The data of one map of one voxel as shown by the :class:`SampleVisualizer`."""
+
+
+class _VoxelPlotDataCache(object):
+
+    def __init__(self, voxels, nmr_bins, fit_gaussian, cache_size=100, nmr_prefetch=5):
+        """Loads and caches the plot data per voxel, and prefetches the neighbouring voxels in a background thread.
+
+        Args:
+            voxels (dict): per map the (voxels, samples) matrix with the samples
+            nmr_bins (dict): per map the number of histogram bins, this also determines which maps we load
+            fit_gaussian (boolean): if we fit a Gaussian to the samples
+            cache_size (int): the maximum number of voxels in the cache, the least recently used are removed first
+            nmr_prefetch (int): the number of voxels on either side of the requested voxel we load in the background
+        """
+        self._voxels = voxels
+        self._nmr_bins = nmr_bins
+        self._fit_gaussian = fit_gaussian
+        self._cache_size = max(cache_size, 2 * nmr_prefetch + 1)
+        self._nmr_prefetch = nmr_prefetch
+        self._nmr_voxels = min(voxels[map_name].shape[0] for map_name in nmr_bins)
+
+        self._cache = collections.OrderedDict()
+        self._pending = collections.deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = None
+
+    def get(self, voxel_ind):
+        """Get the plot data of the given voxel, loading it directly if it is not yet in the cache.
+
+        Returns:
+            dict: per map a :class:`_VoxelPlotData`
+        """
+        with self._condition:
+            if voxel_ind in self._cache:
+                self._cache[voxel_ind] = self._cache.pop(voxel_ind)
+                return self._cache[voxel_ind]
+
+        data = self._load(voxel_ind)
+        self._add_to_cache(voxel_ind, data)
+        return data
+
+    def prefetch(self, voxel_ind):
+        """Load the voxels around the given voxel in the background, nearest first.
+
+        This replaces the voxels of a previous prefetch request that are not yet loaded.
+        """
+        if not self._nmr_prefetch:
+            return
+
+        neighbours = []
+        for distance in range(1, self._nmr_prefetch + 1):
+            neighbours.extend(ind for ind in (voxel_ind + distance, voxel_ind - distance)
+                              if 0 <= ind < self._nmr_voxels)
+
+        with self._condition:
+            self._pending.clear()
+            self._pending.extend(neighbours)
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._prefetch_voxels, name='mdt-samples-prefetch')
+                self._thread.daemon = True
+                self._thread.start()
+
+            self._condition.notify()
+
+    def close(self):
+        """Stop the background loading and release the cached data.
+
+        The data of voxels requested after closing is loaded but no longer cached.
+        """
+        with self._condition:
+            self._closed = True
+            self._pending.clear()
+            self._cache.clear()
+            self._condition.notify()
+
+    def _prefetch_voxels(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+
+                voxel_ind = self._pending.popleft()
+                if voxel_ind in self._cache:
+                    continue
+
+            self._add_to_cache(voxel_ind, self._load(voxel_ind))
+
+    def _add_to_cache(self, voxel_ind, data):
+        with self._condition:
+            if self._closed:
+                return
+            self._cache[voxel_ind] = data
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+    def _load(self, voxel_ind):
+        results = {}
+        for map_name, nmr_bins in self._nmr_bins.items():
+            samples = np.array(self._voxels[map_name][voxel_ind, :])
+            histogram, bin_edges = np.histogram(samples, nmr_bins, density=True)
+
+            gaussian = ([], [])
+            if self._fit_gaussian:
+                mu, sigma = norm.fit(samples)
+                bin_centers = 0.5 * (bin_edges[1:] + bin_edges[:-1])
+                gaussian = (bin_centers, norm.pdf(bin_centers, mu, sigma))
+
+            results[map_name] = _VoxelPlotData(samples, histogram, bin_edges, gaussian)
+        return results
+
+
+def _get_close_callback(plot_data):
+    """Get the figure close event callback which closes the given plot data cache.
+
+    This binds the cache of the figure itself, such that closing an old figure does not close the cache of a newer one.
+    """
+    def close_callback(event):
+        plot_data.close()
+    return close_callback
+
+
+def _rescale(axes):
+    """Rescale the view limits of the given axes to the current data of its artists."""
+    axes.relim()
+    axes.autoscale_view()
+
 
 class _DiscreteSlider(Slider):
     """A matplotlib slider widget with discrete steps."""
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_cl_program_cache
+----------------------------------
+
+Tests for the `mdt.cl_program_cache` module.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from mot.load_balance_strategies import Worker
+
+from mdt.cl_program_cache import ProgramCache, get_cache_key, program_cache_context, _build_worker_kernel
+
+
+class _Platform(object):
+
+    def __init__(self, name='Platform', version='OpenCL 1.2'):
+        self.name = name
+        self.version = version
+
+
+class _Device(object):
+
+    def __init__(self, name='Device', version='OpenCL 1.2', driver_version='1.0'):
+        self.name = name
+        self.version = version
+        self.driver_version = driver_version
+        self.platform = _Platform()
+
+
+class CacheKeyTest(unittest.TestCase):
+
+    def test_deterministic(self):
+        self.assertEqual(get_cache_key(_Device(), 'kernel', '-w'), get_cache_key(_Device(), 'kernel', '-w'))
+
+    def test_differs(self):
+        key = get_cache_key(_Device(), 'kernel', '-w')
+        self.assertNotEqual(key, get_cache_key(_Device(), 'other kernel', '-w'))
+        self.assertNotEqual(key, get_cache_key(_Device(), 'kernel', ''))
+        self.assertNotEqual(key, get_cache_key(_Device(name='Other device'), 'kernel', '-w'))
+        self.assertNotEqual(key, get_cache_key(_Device(driver_version='2.0'), 'kernel', '-w'))
+
+    def test_separated(self):
+        """The items are separated in the key, such that moving text between the source and the options changes it."""
+        self.assertNotEqual(get_cache_key(_Device(), 'kernel -w', ''), get_cache_key(_Device(), 'kernel', ' -w'))
+
+
+class ProgramCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_cl_program_cache_test')
+        self._cache_dir = os.path.join(self._tmp_dir, 'programs')
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_memory(self):
+        cache = ProgramCache()
+        self.assertIsNone(cache._get_binary('key'))
+
+        cache._set_binary('key', b'binary')
+        self.assertEqual(cache._get_binary('key'), b'binary')
+
+    def test_disk(self):
+        ProgramCache(self._cache_dir)._set_binary('key', b'binary')
+        self.assertEqual(os.listdir(self._cache_dir), ['key.bin'])
+        self.assertEqual(ProgramCache(self._cache_dir)._get_binary('key'), b'binary')
+
+    def test_empty_binary(self):
+        cache = ProgramCache(self._cache_dir)
+        cache._set_binary('key', b'')
+        self.assertFalse(os.path.exists(os.path.join(self._cache_dir, 'key.bin')))
+
+    def test_clear(self):
+        cache = ProgramCache(self._cache_dir)
+        cache._set_binary('key', b'binary')
+        cache.clear()
+
+        self.assertEqual(os.listdir(self._cache_dir), [])
+        self.assertIsNone(cache._get_binary('key'))
+
+
+class ProgramCacheContextTest(unittest.TestCase):
+
+    def setUp(self):
+        self._build_kernel = Worker.__dict__['_build_kernel']
+
+    def test_nested(self):
+        with program_cache_context():
+            self.assertIs(Worker.__dict__['_build_kernel'], _build_worker_kernel)
+            with program_cache_context():
+                self.assertIs(Worker.__dict__['_build_kernel'], _build_worker_kernel)
+            self.assertIs(Worker.__dict__['_build_kernel'], _build_worker_kernel)
+        self.assertIs(Worker.__dict__['_build_kernel'], self._build_kernel)
+
+    def test_restore_on_error(self):
+        with self.assertRaises(ValueError):
+            with program_cache_context():
+                raise ValueError()
+        self.assertIs(Worker.__dict__['_build_kernel'], self._build_kernel)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_cl_routines
+----------------------------------
+
+Tests for the `mdt.cl_routines` module.
+"""
+import unittest
+import numpy as np
+
+from mdt.cl_routines.mapping.calculate_eigenvectors import CalculateEigenvectors, _convert_theta_phi_psi, \
+    _get_rotation_sign
+from mdt.cl_routines.mapping.dti_measures import DTIMeasures, _calculate_fa_md
+from mdt.configuration import config_context, YamlStringAction
+
+
+class CalculateEigenvectorsTest(unittest.TestCase):
+
+    def test_known_angles(self):
+        theta = np.array([0, 0, np.pi, np.pi / 2])
+        phi = np.array([0, 0, 0, np.pi / 2])
+        psi = np.array([0, np.pi / 2, np.pi / 2, 0])
+
+        expected = np.array([[[0, 0, 1], [1, 0, 0], [0, 1, 0]],
+                             [[0, 0, 1], [0, -1, 0], [1, 0, 0]],
+                             [[0, 0, -1], [0, 1, 0], [1, 0, 0]],
+                             [[0, 1, 0], [0, 0, -1], [-1, 0, 0]]])
+
+        np.testing.assert_allclose(_convert_theta_phi_psi(theta, phi, psi, 3), expected, atol=1e-7)
+
+    def test_orthonormal(self):
+        theta, phi, psi = np.random.uniform(-2 * np.pi, 2 * np.pi, (3, 1000))
+        evecs = _convert_theta_phi_psi(theta, phi, psi, 300)
+        np.testing.assert_allclose(np.einsum('nij,nkj->nik', evecs, evecs), np.tile(np.eye(3), (1000, 1, 1)),
+                                   atol=1e-7)
+
+    def test_rotation_sign(self):
+        vec0 = np.array([[0, 0, 1], [0, 0, -1], [1, 0, 0], [-1, 0, 0], [0, 1, 0], [-1, 0, 1e-30]], dtype=np.float32)
+        np.testing.assert_array_equal(_get_rotation_sign(vec0), [1, -1, 1, -1, 1, 1])
+
+    def test_opencl(self):
+        theta, phi, psi = np.random.uniform(0, np.pi, (3, 100))
+        numpy_evecs = CalculateEigenvectors().convert_theta_phi_psi(theta, phi, psi, double_precision=True)
+
+        with config_context(YamlStringAction('numpy_fast_path: {max_voxels: 0}')):
+            cl_evecs = CalculateEigenvectors().convert_theta_phi_psi(theta, phi, psi, double_precision=True)
+
+        np.testing.assert_allclose(numpy_evecs, cl_evecs, atol=1e-6)
+
+
+class DTIMeasuresTest(unittest.TestCase):
+
+    def test_known_eigenvalues(self):
+        eigenvalues = np.array([[1, 0, 0], [1, 1, 1], [3e-3, 1e-3, 1e-3]])
+        fa, md = _calculate_fa_md(eigenvalues, 2)
+
+        np.testing.assert_allclose(fa[:, 0], [1, 0, np.sqrt(4 / 11.)])
+        np.testing.assert_allclose(md[:, 0], [1 / 3., 1, 5e-3 / 3])
+
+    def test_opencl(self):
+        eigenvalues = np.random.uniform(1e-4, 3e-3, (100, 3))
+        eigenvectors = np.tile(np.eye(3), (100, 1, 1))
+        numpy_measures = DTIMeasures().calculate(eigenvalues, eigenvectors)
+
+        with config_context(YamlStringAction('numpy_fast_path: {max_voxels: 0}')):
+            cl_measures = DTIMeasures().calculate(eigenvalues, eigenvectors)
+
+        for key in ['FA', 'MD']:
+            np.testing.assert_allclose(numpy_measures[key], cl_measures[key], rtol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
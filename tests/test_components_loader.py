@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_components_loader
+----------------------------------
+
+Tests for the `mdt.components_loader` module.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from mdt.components_loader import ComponentsIndex
+
+
+class ComponentsIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_components_loader_test')
+        self._index_path = os.path.join(self._tmp_dir, 'components_index.json')
+        self._components_path = self._write_file('components.py', 'class A(object): pass\n')
+        self._components = [{'name': 'A', 'meta_info': {'description': 'A component'}}]
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def _write_file(self, name, contents):
+        path = os.path.join(self._tmp_dir, name)
+        with open(path, 'w') as f:
+            f.write(contents)
+        return path
+
+    def test_not_indexed(self):
+        self.assertIsNone(ComponentsIndex(self._index_path).get_components(self._components_path))
+
+    def test_set_components(self):
+        index = ComponentsIndex(self._index_path)
+        index.set_components(self._components_path, self._components)
+        self.assertEqual(index.get_components(self._components_path), self._components)
+
+    def test_changed_file(self):
+        index = ComponentsIndex(self._index_path)
+        index.set_components(self._components_path, self._components)
+
+        self._write_file('components.py', 'class A(object): pass\nclass B(object): pass\n')
+        self.assertIsNone(index.get_components(self._components_path))
+
+    def test_removed_file(self):
+        index = ComponentsIndex(self._index_path)
+        index.set_components(self._components_path, self._components)
+
+        os.remove(self._components_path)
+        self.assertIsNone(index.get_components(self._components_path))
+
+    def test_save(self):
+        index = ComponentsIndex(self._index_path)
+        index.set_components(self._components_path, self._components)
+        index.save()
+
+        self.assertTrue(os.path.isfile(self._index_path))
+        self.assertEqual(ComponentsIndex(self._index_path).get_components(self._components_path), self._components)
+
+    def test_save_removed_files(self):
+        other_path = self._write_file('other.py', '')
+
+        index = ComponentsIndex(self._index_path)
+        index.set_components(self._components_path, self._components)
+        index.set_components(other_path, [])
+        os.remove(other_path)
+        index.save()
+
+        loaded = ComponentsIndex(self._index_path)
+        self.assertEqual(list(loaded._files), [self._components_path])
+
+    def test_invalid_index_file(self):
+        self._write_file('components_index.json', '{"version": 1')
+        self.assertIsNone(ComponentsIndex(self._index_path).get_components(self._components_path))
+
+        self._write_file('components_index.json', '{"version": 0, "files": {}}')
+        self.assertEqual(ComponentsIndex(self._index_path)._files, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
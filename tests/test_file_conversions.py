@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_file_conversions
+----------------------------------
+
+Tests for the `mdt.file_conversions` module.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import nibabel as nib
+import numpy as np
+
+from mdt.file_conversions.npy import samples_npy_to_nifti
+from mdt.sample_storage import CompressedSamples
+
+
+class SamplesToNiftiTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_file_conversions_test')
+
+        self._mask = np.zeros((3, 4, 2), dtype=np.bool_)
+        self._mask[1:, 1:3] = True
+        self._samples = np.random.rand(np.count_nonzero(self._mask), 10).astype(np.float32)
+
+        self._expected = np.zeros(self._mask.shape + (10,), dtype=np.float32)
+        self._expected[self._mask] = self._samples
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_npy(self):
+        samples_fname = os.path.join(self._tmp_dir, 'S0.s0.samples.npy')
+        np.save(samples_fname, self._samples)
+
+        nifti_fname = os.path.join(self._tmp_dir, 'S0.s0.nii.gz')
+        samples_npy_to_nifti(samples_fname, self._mask, nib.Nifti1Header(), nifti_fname, max_block_memory=1000)
+        np.testing.assert_array_equal(np.asarray(nib.load(nifti_fname).dataobj), self._expected)
+
+    def test_compressed(self):
+        samples_path = os.path.join(self._tmp_dir, 'S0.s0.samples')
+        store = CompressedSamples.create(samples_path, self._samples.shape, self._samples.dtype, voxels_per_block=3)
+        store.write(np.arange(self._samples.shape[0]), self._samples)
+
+        samples_npy_to_nifti(samples_path, self._mask, nib.Nifti1Header(), compression_level=1,
+                             max_block_memory=1000)
+        np.testing.assert_array_equal(np.asarray(nib.load(os.path.join(self._tmp_dir, 'S0.s0.nii.gz')).dataobj),
+                                      self._expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
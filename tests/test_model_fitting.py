@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_model_fitting
+----------------------------------
+
+Tests for the `mdt.model_fitting` module.
+"""
+import os
+import pickle
+import unittest
+
+from mdt.model_fitting import _BatchFitRunner, _get_device_subsets, _run_batch_fit_workers
+
+
+class _Subject(object):
+
+    def __init__(self, subject_id):
+        self.subject_id = subject_id
+
+
+class _RunFunc(object):
+
+    def __init__(self, failing_subject=None, dying_subject=None):
+        """Stand-in for the batch fit runner, raises an error or kills the worker process on the given subjects."""
+        self._failing_subject = failing_subject
+        self._dying_subject = dying_subject
+
+    def __call__(self, subject_info):
+        if subject_info.subject_id == self._failing_subject:
+            raise ValueError('Processing failed.')
+        if subject_info.subject_id == self._dying_subject:
+            os._exit(3)
+
+
+class DeviceSubsetsTest(unittest.TestCase):
+
+    def test_more_devices(self):
+        self.assertEqual(_get_device_subsets([0, 1, 2], 2), [[0, 2], [1]])
+        self.assertEqual(_get_device_subsets([3, 5], 2), [[3], [5]])
+
+    def test_more_workers(self):
+        self.assertEqual(_get_device_subsets([0], 3), [[0], [0], [0]])
+        self.assertEqual(_get_device_subsets([1, 4], 3), [[1], [4], [1]])
+
+
+class BatchFitRunnerTest(unittest.TestCase):
+
+    def test_pickle(self):
+        runner = _BatchFitRunner(['BallStick_r1'], True, False, [1], True, None)
+        unpickled = pickle.loads(pickle.dumps(runner))
+
+        self.assertEqual(unpickled._models_to_fit, ['BallStick_r1'])
+        self.assertEqual(unpickled._cl_device_ind, [1])
+        self.assertTrue(unpickled._double_precision)
+        self.assertIsNotNone(unpickled._logger)
+
+
+class BatchFitWorkersTest(unittest.TestCase):
+
+    def setUp(self):
+        self._subjects = [_Subject('subject_{}'.format(ind)) for ind in range(4)]
+
+    def test_all_succeed(self):
+        results = _run_batch_fit_workers(self._subjects, [_RunFunc(), _RunFunc()], status_poll_interval=0.1)
+        self.assertEqual(results, {subject.subject_id: None for subject in self._subjects})
+
+    def test_failing_subject(self):
+        run_func = _RunFunc(failing_subject='subject_1')
+        results = _run_batch_fit_workers(self._subjects, [run_func, run_func], status_poll_interval=0.1)
+
+        self.assertIn('Processing failed.', results['subject_1'])
+        self.assertEqual(sorted(subject_id for subject_id, error in results.items() if error is None),
+                         ['subject_0', 'subject_2', 'subject_3'])
+
+    def test_dying_worker(self):
+        run_func = _RunFunc(dying_subject='subject_2')
+        results = _run_batch_fit_workers(self._subjects, [run_func, run_func], status_poll_interval=0.1)
+
+        self.assertIn('exited with code 3', results['subject_2'])
+        self.assertEqual(sorted(subject_id for subject_id, error in results.items() if error is None),
+                         ['subject_0', 'subject_1', 'subject_3'])
+
+    def test_all_workers_dying(self):
+        run_func = _RunFunc(dying_subject='subject_0')
+        results = _run_batch_fit_workers(self._subjects, [run_func], status_poll_interval=0.1)
+
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(error is not None for error in results.values()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_nifti
+----------------------------------
+
+Tests for the `mdt.nifti` module.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import nibabel as nib
+import numpy as np
+
+from mdt.nifti import write_nifti_blocks
+
+
+class WriteNiftiBlocksTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_nifti_test')
+        self._data = np.random.rand(3, 4, 5, 7).astype(np.float32)
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def _write(self, fname, block_sizes, compression_level=None):
+        starts = np.cumsum([0] + list(block_sizes))
+        blocks = (self._data[..., start:end] for start, end in zip(starts[:-1], starts[1:]))
+
+        output_fname = os.path.join(self._tmp_dir, fname)
+        write_nifti_blocks(blocks, self._data.shape, self._data.dtype, nib.Nifti1Header(), output_fname,
+                           compression_level=compression_level)
+        return output_fname
+
+    def test_gzipped(self):
+        output_fname = self._write('volumes.nii.gz', [2, 4, 1], compression_level=1)
+        np.testing.assert_array_equal(np.asarray(nib.load(output_fname).dataobj), self._data)
+
+    def test_not_gzipped(self):
+        output_fname = self._write('volumes.nii', [7], compression_level=1)
+        np.testing.assert_array_equal(np.asarray(nib.load(output_fname).dataobj), self._data)
+
+    def test_extension_added(self):
+        self._write('volumes', [3, 4])
+        self.assertTrue(os.path.isfile(os.path.join(self._tmp_dir, 'volumes.nii.gz')))
+
+    def test_wrong_number_of_volumes(self):
+        self.assertRaises(ValueError, self._write, 'volumes.nii', [2, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_processing_strategies
+----------------------------------
+
+Tests for the `mdt.processing_strategies` module.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from mdt.components_loader import ProcessingStrategiesLoader
+from mdt.configuration import config_context, YamlStringAction
+from mdt.processing_strategies import SamplingProcessingWorker, ChunksCheckpointManifest, _ChunksPipeline
+from mdt.sample_storage import CompressedSamples
+from mdt.utils import load_samples
+
+
+class _Model(object):
+
+    def __init__(self, name='BallStick_r1'):
+        self.name = name
+        self.problems_to_analyze = None
+
+    def get_initial_parameters(self):
+        return np.ones((len(self.problems_to_analyze), 2))
+
+    def get_lower_bounds(self):
+        return [0, 0]
+
+    def get_upper_bounds(self):
+        return [2, 2]
+
+
+class _ProblemData(object):
+
+    def __init__(self, mask):
+        self.mask = mask
+
+
+class SamplingProcessingWorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_processing_strategies_test')
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def _create_worker(self, store_samples, nmr_chains):
+        return SamplingProcessingWorker(None, store_samples, True, None, nmr_chains,
+                                        _Model(), _ProblemData(np.ones((2, 2, 1), dtype=np.bool_)),
+                                        self._tmp_dir, self._tmp_dir, True, False)
+
+    def test_multiple_chains(self):
+        worker = self._create_worker(True, 2)
+        self.assertEqual(worker._nmr_chains, 2)
+
+    def test_multiple_chains_storage(self):
+        samples = {'a': np.random.rand(4, 3, 5)}
+        self._create_worker(True, 3)._write_sample_chains(samples, np.arange(4))
+
+        np.testing.assert_array_equal(load_samples(self._tmp_dir)['a'], samples['a'][:, 0])
+        for chain in [1, 2]:
+            chain_samples = load_samples(os.path.join(self._tmp_dir, 'chain_{}'.format(chain)))
+            np.testing.assert_array_equal(chain_samples['a'], samples['a'][:, chain])
+
+    def test_multiple_chains_compressed_storage(self):
+        config = '''
+            output_format:
+                sampling:
+                    samples_storage:
+                        format: compressed
+        '''
+        samples = {'a': np.random.rand(4, 2, 5).astype(np.float32)}
+        with config_context(YamlStringAction(config)):
+            self._create_worker(True, 2)._write_sample_chains(samples, np.arange(4))
+
+        np.testing.assert_array_equal(CompressedSamples(os.path.join(self._tmp_dir, 'a.samples'))[:],
+                                      samples['a'][:, 0])
+        np.testing.assert_array_equal(CompressedSamples(os.path.join(self._tmp_dir, 'chain_1', 'a.samples'))[:],
+                                      samples['a'][:, 1])
+
+    def test_close_ess_pool(self):
+        with config_context(YamlStringAction('sampling: {post_processing: {nmr_processes: 2}}')):
+            worker = self._create_worker(False, 1)
+
+        pool = worker._get_ess_pool()
+        self.assertIs(worker._get_ess_pool(), pool)
+
+        worker.close()
+        self.assertIsNone(worker._ess_pool)
+        self.assertRaises(ValueError, pool.apply, abs, (-1,))
+
+    def test_dispersed_starting_points(self):
+        worker = self._create_worker(False, 2)
+
+        starting_points = []
+        for roi_indices in [np.array([0, 1]), np.array([2, 3])]:
+            worker._model.problems_to_analyze = np.repeat(roi_indices, 2)
+            starting_points.append(worker._get_dispersed_starting_points())
+
+        for points in starting_points:
+            np.testing.assert_array_equal(points[::2], 1)
+            self.assertTrue(np.all(points[1::2] != 1))
+        self.assertFalse(np.array_equal(starting_points[0], starting_points[1]))
+
+        worker._model.problems_to_analyze = np.repeat(np.array([0, 1]), 2)
+        np.testing.assert_array_equal(worker._get_dispersed_starting_points(), starting_points[0])
+
+
+class _FailingWorker(object):
+
+    def __init__(self, nmr_voxels):
+        self.nmr_voxels = nmr_voxels
+        self.closed = False
+
+    def get_voxels_to_compute(self):
+        return np.arange(self.nmr_voxels)
+
+    def compute(self, roi_indices):
+        raise ValueError('Processing failed.')
+
+    def finalize(self, roi_indices, computed):
+        pass
+
+    def combine(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class _WorkerGenerator(object):
+
+    def __init__(self, worker):
+        self._worker = worker
+
+    def create_worker(self, *args, **kwargs):
+        return self._worker
+
+
+class ChunksProcessingStrategyTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_processing_strategies_test')
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_close_on_error(self):
+        worker = _FailingWorker(4)
+        strategy = ProcessingStrategiesLoader().load('SlabRange', nmr_voxels=2)
+
+        with self.assertRaises(ValueError):
+            strategy.run(_Model(), _ProblemData(np.ones((2, 2, 1), dtype=np.bool_)), self._tmp_dir, False,
+                         _WorkerGenerator(worker))
+        self.assertTrue(worker.closed)
+
+
+class ChunksPipelineTest(unittest.TestCase):
+
+    def test_order(self):
+        for max_pending_chunks in [0, 1, 3]:
+            finalized = []
+            with _ChunksPipeline(max_pending_chunks) as pipeline:
+                for ind in range(10):
+                    pipeline.submit(finalized.append, ind)
+            self.assertEqual(finalized, list(range(10)))
+
+    def test_exception(self):
+        def finalize(ind):
+            if ind == 2:
+                raise ValueError('Finalizing failed.')
+            finalized.append(ind)
+
+        for max_pending_chunks in [0, 1]:
+            finalized = []
+            with self.assertRaises(ValueError):
+                with _ChunksPipeline(max_pending_chunks) as pipeline:
+                    for ind in range(5):
+                        pipeline.submit(finalize, ind)
+            self.assertEqual(finalized, [0, 1])
+
+
+class ChunksCheckpointManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_processing_strategies_test')
+        self._manifest_path = os.path.join(self._tmp_dir, '_checkpoint_manifest.json')
+        self._data_path = os.path.join(self._tmp_dir, 'S0.s0.npy')
+        self._data = open_memmap(self._data_path, mode='w+', dtype=np.float64, shape=(20, 2))
+
+    def tearDown(self):
+        del self._data
+        shutil.rmtree(self._tmp_dir)
+
+    def _write_chunk(self, manifest, roi_indices):
+        self._data[roi_indices] = np.random.rand(len(roi_indices), 2)
+        manifest.record(self._data_path, 'roi', self._data, self._data[roi_indices])
+        manifest.commit(roi_indices)
+
+    @staticmethod
+    def _read_stored_rows(path, space, roi_indices):
+        return np.load(path, mmap_mode='r')[roi_indices]
+
+    def test_no_manifest(self):
+        manifest = ChunksCheckpointManifest(self._manifest_path, 20)
+        self.assertIsNone(manifest.get_committed_roi_indices(self._read_stored_rows))
+
+    def test_committed(self):
+        manifest = ChunksCheckpointManifest(self._manifest_path, 20)
+        self._write_chunk(manifest, np.arange(0, 5))
+        self._write_chunk(manifest, np.array([7, 9, 10, 11]))
+
+        self._data[15] = 1  # not committed
+
+        committed = ChunksCheckpointManifest(self._manifest_path, 20).get_committed_roi_indices(self._read_stored_rows)
+        np.testing.assert_array_equal(committed, [0, 1, 2, 3, 4, 7, 9, 10, 11])
+
+    def test_changed_data(self):
+        manifest = ChunksCheckpointManifest(self._manifest_path, 20)
+        self._write_chunk(manifest, np.arange(0, 5))
+        self._write_chunk(manifest, np.arange(5, 10))
+
+        self._data[6] += 1
+        self._data.flush()
+
+        manifest = ChunksCheckpointManifest(self._manifest_path, 20)
+        np.testing.assert_array_equal(manifest.get_committed_roi_indices(self._read_stored_rows), np.arange(0, 5))
+
+        # the changed chunk is removed from the manifest
+        manifest = ChunksCheckpointManifest(self._manifest_path, 20)
+        np.testing.assert_array_equal(manifest.get_committed_roi_indices(self._read_stored_rows), np.arange(0, 5))
+
+    def test_other_mask(self):
+        manifest = ChunksCheckpointManifest(self._manifest_path, 20)
+        self._write_chunk(manifest, np.arange(0, 5))
+
+        committed = ChunksCheckpointManifest(self._manifest_path, 30).get_committed_roi_indices(self._read_stored_rows)
+        self.assertEqual(len(committed), 0)
+
+    def test_uncommitted_maps(self):
+        manifest = ChunksCheckpointManifest(self._manifest_path, 20)
+        self._write_chunk(manifest, np.arange(0, 5))
+
+        self._data[5:10] = 1
+        manifest.record(self._data_path, 'roi', self._data, self._data[5:10])
+
+        committed = ChunksCheckpointManifest(self._manifest_path, 20).get_committed_roi_indices(self._read_stored_rows)
+        np.testing.assert_array_equal(committed, np.arange(0, 5))
+
+
+class SlabRangeTest(unittest.TestCase):
+
+    def setUp(self):
+        self._mask = np.zeros((4, 5, 3), dtype=np.bool_)
+        self._mask[0, :2] = True
+        self._mask[1] = True
+        self._mask[3, 1:4, 1] = True
+        self._problem_data = _ProblemData(self._mask)
+
+    def _get_chunks(self, nmr_voxels, roi_indices=None):
+        if roi_indices is None:
+            roi_indices = np.arange(np.count_nonzero(self._mask))
+
+        strategy = ProcessingStrategiesLoader().load('SlabRange', nmr_voxels=nmr_voxels)
+        return list(strategy._chunks_generator(None, self._problem_data, None, None, roi_indices))
+
+    def _get_slices(self, chunk):
+        return set(np.nonzero(self._mask)[0][chunk])
+
+    def test_whole_slices(self):
+        chunks = self._get_chunks(22)
+        self.assertEqual([len(chunk) for chunk in chunks], [21, 3])
+        self.assertEqual([self._get_slices(chunk) for chunk in chunks], [{0, 1}, {3}])
+
+    def test_split_slices(self):
+        chunks = self._get_chunks(10)
+        self.assertEqual([len(chunk) for chunk in chunks], [6, 10, 8])
+        self.assertEqual([self._get_slices(chunk) for chunk in chunks], [{0}, {1}, {1, 3}])
+        np.testing.assert_array_equal(np.concatenate(chunks), np.arange(24))
+
+    def test_subset(self):
+        roi_indices = np.array([20, 3, 2, 23, 10])
+        chunks = self._get_chunks(2, roi_indices)
+        np.testing.assert_array_equal(np.concatenate(chunks), np.sort(roi_indices))
+        self.assertEqual([self._get_slices(chunk) for chunk in chunks], [{0}, {1}, {3}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_sample_model
+----------------------------------
+
+Tests for the `mdt.sample_model` function.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import mdt
+from mdt.configuration import config_context, YamlStringAction
+from mdt.sample_storage import SampleReduction
+
+
+class _Model(object):
+
+    name = 'BallStick_r1'
+
+    def is_protocol_sufficient(self, protocol):
+        return True
+
+
+class _ProblemData(object):
+
+    protocol = None
+
+
+class AppendSamplesTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_sample_model_test')
+        self._samples_dir = os.path.join(self._tmp_dir, _Model.name, 'samples')
+        os.makedirs(self._samples_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def _append(self):
+        mdt.sample_model(_Model(), _ProblemData(), self._tmp_dir, append_samples=True, save_user_script_info=False)
+
+    def test_configured_reduction(self):
+        config = '''
+            sampling:
+                sample_reduction:
+                    general:
+                        thinning: 2
+        '''
+        with config_context(YamlStringAction(config)):
+            self.assertRaises(ValueError, self._append)
+
+    def test_stored_reduction(self):
+        SampleReduction(parameters=['S0.s0']).save(self._samples_dir)
+        self.assertRaises(ValueError, self._append)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_sample_statistics
+----------------------------------
+
+Tests for the `mdt.sample_statistics` module.
+"""
+import unittest
+import numpy as np
+from mot.model_building.parameter_functions.sample_statistics import GaussianPSS
+
+from mdt.sample_statistics import OnlineSampleStatistics
+
+
+class OnlineSampleStatisticsTest(unittest.TestCase):
+
+    def setUp(self):
+        self._param_names = ['a', 'b']
+        self._sampling_statistics = {name: GaussianPSS() for name in self._param_names}
+
+        random_state = np.random.RandomState(0)
+        innovations = random_state.normal(size=(3, 2, 2000))
+        self._samples = np.zeros_like(innovations)
+        for ind in range(1, innovations.shape[2]):
+            self._samples[..., ind] = 0.8 * self._samples[..., ind - 1] + innovations[..., ind]
+
+    def _get_statistics(self, samples, chain_length, block_size):
+        statistics = OnlineSampleStatistics(self._param_names, self._sampling_statistics, chain_length)
+        for start in range(0, samples.shape[2], block_size):
+            statistics.update(samples[..., start:start + block_size])
+        return statistics
+
+    def _append(self, nmr_first, block_size=100):
+        first = self._get_statistics(self._samples[..., :nmr_first], nmr_first, block_size)
+
+        appended = OnlineSampleStatistics(self._param_names, self._sampling_statistics, self._samples.shape[2])
+        appended.set_state(first.get_state())
+        appended.adapt_batch_size(self._samples.shape[2])
+        appended.update(self._samples[..., nmr_first:])
+        return appended
+
+    def _assert_equal_statistics(self, first, second):
+        first_statistics = first.get_statistics()
+        second_statistics = second.get_statistics()
+        for key in first_statistics:
+            np.testing.assert_allclose(first_statistics[key], second_statistics[key])
+
+        np.testing.assert_allclose(first.get_univariate_ess(), second.get_univariate_ess())
+        np.testing.assert_allclose(first.get_multivariate_ess(), second.get_multivariate_ess())
+
+    def test_blocks(self):
+        statistics = self._get_statistics(self._samples, self._samples.shape[2], 300)
+        np.testing.assert_allclose(statistics.get_statistics()['a'], np.mean(self._samples[:, 0], axis=1))
+        np.testing.assert_allclose(statistics.get_statistics()['b.std'], np.std(self._samples[:, 1], axis=1))
+
+        self._assert_equal_statistics(statistics, self._get_statistics(self._samples, self._samples.shape[2], 2000))
+
+    def test_append_multiple_batch_size(self):
+        """The batch size of the first 500 samples is 22, twice that is the batch size of the complete chains."""
+        appended = self._append(500)
+        self.assertEqual(appended.get_state()['batch_size'], 44)
+        self._assert_equal_statistics(appended, self._get_statistics(self._samples, self._samples.shape[2], 2000))
+
+    def test_append_other_batch_size(self):
+        """The batch size of the first 1000 samples is 31, which can not be merged to the batch size of 44."""
+        appended = self._append(1000)
+        self.assertEqual(appended.get_state()['batch_size'], 31)
+        self._assert_equal_statistics(appended, self._get_statistics(self._samples, 31 ** 2, 2000))
+
+        full_chain_ess = self._get_statistics(self._samples, self._samples.shape[2], 2000).get_multivariate_ess()
+        np.testing.assert_allclose(appended.get_multivariate_ess(), full_chain_ess, rtol=0.25)
+
+
+if __name__ == '__main__':
+    unittest.main()
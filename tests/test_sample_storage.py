@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_sample_storage
+----------------------------------
+
+Tests for the `mdt.sample_storage` module.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from mdt.sample_storage import CompressedSamples, SampleReduction
+
+
+class CompressedSamplesTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp_dir = tempfile.mkdtemp('mdt_sample_storage_test')
+        self._path = os.path.join(self._tmp_dir, 'S0.s0.samples')
+
+        self._samples = np.random.rand(20, 15).astype(np.float32)
+        self._roi_indices = np.arange(2, 18)
+
+        store = CompressedSamples.create(self._path, self._samples.shape, self._samples.dtype, voxels_per_block=6)
+        store.write(self._roi_indices, self._samples[self._roi_indices])
+
+        self._expected = np.zeros_like(self._samples)
+        self._expected[self._roi_indices] = self._samples[self._roi_indices]
+
+    def tearDown(self):
+        shutil.rmtree(self._tmp_dir)
+
+    def test_is_store(self):
+        self.assertTrue(CompressedSamples.is_store(self._path))
+        self.assertFalse(CompressedSamples.is_store(self._tmp_dir))
+
+    def test_properties(self):
+        store = CompressedSamples(self._path)
+        self.assertEqual(store.shape, self._samples.shape)
+        self.assertEqual(store.dtype, self._samples.dtype)
+        self.assertEqual(len(store), self._samples.shape[0])
+        np.testing.assert_array_equal(np.asarray(store), self._expected)
+
+    def test_indexing(self):
+        store = CompressedSamples(self._path)
+
+        indices = [3, -3, slice(None), slice(1, 15, 3), slice(-2, None), slice(None, None, -1),
+                   np.array([17, 0, 5, 5]), np.array([-1, 4]), [1, 2], self._expected[:, 0] > 0.5]
+        for index in indices:
+            np.testing.assert_array_equal(store[index], self._expected[index])
+            np.testing.assert_array_equal(store[index, 4], self._expected[index, 4])
+            np.testing.assert_array_equal(store[index, 2:9:2], self._expected[index, 2:9:2])
+
+    def test_indexing_out_of_bounds(self):
+        store = CompressedSamples(self._path)
+
+        self.assertRaises(IndexError, store.__getitem__, 20)
+        self.assertRaises(IndexError, store.__getitem__, -21)
+        self.assertRaises(IndexError, store.__getitem__, np.array([0, 20]))
+        self.assertRaises(IndexError, store.__getitem__, np.ones(3, dtype=np.bool_))
+        self.assertRaises(IndexError, store.__getitem__, (0, 0, 0))
+
+    def test_rewrite(self):
+        store = CompressedSamples(self._path)
+        new_samples = np.random.rand(3, 15).astype(np.float32)
+        store.write(np.array([0, 5, 19]), new_samples)
+
+        self._expected[[0, 5, 19]] = new_samples
+        np.testing.assert_array_equal(CompressedSamples(self._path)[:], self._expected)
+
+    def test_storage_dtype(self):
+        path = os.path.join(self._tmp_dir, 'half.samples')
+        store = CompressedSamples.create(path, self._samples.shape, np.float32, storage_dtype=np.float16)
+        store.write(np.arange(20), self._samples)
+
+        self.assertEqual(store.dtype, np.float32)
+        np.testing.assert_allclose(store[:], self._samples, rtol=1e-3)
+
+    def test_stored_bytes(self):
+        store = CompressedSamples(self._path)
+        stored_bytes = store.get_stored_bytes(self._roi_indices)
+        np.testing.assert_array_equal(CompressedSamples(self._path).get_stored_bytes(self._roi_indices), stored_bytes)
+
+        store.write(np.array([4]), np.zeros((1, 15), dtype=np.float32))
+        self.assertFalse(np.array_equal(store.get_stored_bytes(self._roi_indices), stored_bytes))
+
+
+class SampleReductionTest(unittest.TestCase):
+
+    def setUp(self):
+        self._samples = {'a': np.tile(np.arange(10.), (3, 1)), 'b': np.tile(np.arange(10.), (3, 1)) * 2}
+
+    def test_no_reduction(self):
+        reduced = SampleReduction().reduce_chains(self._samples)
+        np.testing.assert_array_equal(reduced['a'], self._samples['a'])
+        np.testing.assert_array_equal(reduced['b'], self._samples['b'])
+
+    def test_thinning(self):
+        reduced = SampleReduction(thinning=4).reduce_chains(self._samples)
+        np.testing.assert_array_equal(reduced['a'][0], [1, 5, 9])
+
+    def test_last_n(self):
+        reduced = SampleReduction(thinning=2, last_n=2).reduce_chains(self._samples)
+        np.testing.assert_array_equal(reduced['a'][0], [7, 9])
+
+    def test_multiple_chains(self):
+        samples = {'a': np.tile(np.arange(10.), (3, 2, 1))}
+        reduced = SampleReduction(thinning=3).reduce_chains(samples)
+        self.assertEqual(reduced['a'].shape, (3, 2, 4))
+
+    def test_parameters(self):
+        reduction = SampleReduction(parameters=['b'])
+        self.assertEqual(list(reduction.reduce_chains(self._samples)), ['b'])
+        self.assertRaises(ValueError, SampleReduction(parameters=['c']).reduce_chains, self._samples)
+
+    def test_quantiles(self):
+        reduction = SampleReduction(quantiles=[0.5])
+        self.assertFalse(reduction.stores_chains)
+
+        quantiles = reduction.get_quantile_maps(self._samples)
+        np.testing.assert_allclose(quantiles['a.percentile_50'], [4.5] * 3)
+        np.testing.assert_allclose(quantiles['b.percentile_50'], [9] * 3)
+
+    def test_identity(self):
+        self.assertTrue(SampleReduction().is_identity)
+        self.assertFalse(SampleReduction(thinning=2).is_identity)
+        self.assertFalse(SampleReduction(last_n=5).is_identity)
+        self.assertFalse(SampleReduction(parameters=['a']).is_identity)
+        self.assertFalse(SampleReduction(quantiles=[0.5]).is_identity)
+
+    def test_save_load(self):
+        tmp_dir = tempfile.mkdtemp('mdt_sample_storage_test')
+        try:
+            self.assertTrue(SampleReduction.load(tmp_dir).is_identity)
+
+            SampleReduction(thinning=2, parameters=['a']).save(tmp_dir)
+            loaded = SampleReduction.load(tmp_dir)
+            self.assertEqual(loaded.thinning, 2)
+            self.assertEqual(loaded.parameters, ['a'])
+
+            SampleReduction().save(tmp_dir)
+            self.assertEqual(os.listdir(tmp_dir), [])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_invalid_settings(self):
+        self.assertRaises(ValueError, SampleReduction, thinning=-1)
+        self.assertRaises(ValueError, SampleReduction, last_n=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
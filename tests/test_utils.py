@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_utils
+----------------------------------
+
+Tests for the `mdt.utils` module.
+"""
+import unittest
+import numpy as np
+
+from mdt.utils import calculate_rhat_maps, calculate_sample_ess_maps, create_process_pool, sort_orientations, \
+    DMRIProblemData
+
+
+class _Protocol(object):
+
+    def __init__(self, length):
+        self.length = length
+
+    def get_new_protocol_with_indices(self, indices):
+        return _Protocol(len(indices))
+
+
+class DMRIProblemDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dwi_volume = np.random.rand(4, 5, 3, 6)
+        self._mask = np.zeros((4, 5, 3), dtype=np.bool_)
+        self._mask[1:3, 2:] = True
+        self._problem_data = DMRIProblemData(_Protocol(6), self._dwi_volume, self._mask, None)
+
+    def test_load_observations(self):
+        observations = self._problem_data.load_observations()
+        np.testing.assert_array_equal(observations, self._dwi_volume[self._mask])
+        self.assertIs(self._problem_data.load_observations(), observations)
+        self.assertIs(self._problem_data.observations, observations)
+
+    def test_subset(self):
+        self._problem_data.load_observations()
+        subset = self._problem_data.get_subset(volumes_to_keep=[0, 2, 3])
+
+        self.assertEqual(subset.protocol.length, 3)
+        np.testing.assert_array_equal(subset.dwi_volume, self._dwi_volume[..., [0, 2, 3]])
+        np.testing.assert_array_equal(subset.observations, self._dwi_volume[self._mask][:, [0, 2, 3]])
+
+        self.assertIs(self._problem_data.get_subset(volumes_to_keep=np.array([0, 2, 3])), subset)
+
+    def test_subsets_cache_bounded(self):
+        selections = [[0, 1], [2, 3], [4, 5]]
+        subsets = [self._problem_data.get_subset(volumes_to_keep=selection) for selection in selections]
+        self.assertEqual(len(self._problem_data._subsets_cache), DMRIProblemData.max_cached_subsets)
+
+        self.assertIs(self._problem_data.get_subset(volumes_to_keep=selections[2]), subsets[2])
+        self.assertIsNot(self._problem_data.get_subset(volumes_to_keep=selections[0]), subsets[0])
+
+    def test_mask_change(self):
+        subset = self._problem_data.get_subset(volumes_to_keep=[0, 1])
+        self._problem_data.mask = np.ones((4, 5, 3), dtype=np.bool_)
+
+        self.assertEqual(len(self._problem_data.observations), 60)
+        self.assertIsNot(self._problem_data.get_subset(volumes_to_keep=[0, 1]), subset)
+
+
+class RHatTest(unittest.TestCase):
+
+    def test_known_chains(self):
+        samples = np.array([[[[0, 1, 0, 1]], [[2, 3, 2, 3]]]], dtype=np.float64)
+        rhat_maps = calculate_rhat_maps(samples, ['a'])
+
+        np.testing.assert_allclose(rhat_maps['a.RHat'], [np.sqrt(6.75)])
+        np.testing.assert_allclose(rhat_maps['a.SplitRHat'], [np.sqrt(19 / 6.)])
+
+    def test_converged_chains(self):
+        samples = np.random.RandomState(0).normal(size=(5, 4, 2, 5000))
+        rhat_maps = calculate_rhat_maps(samples, ['a', 'b'])
+
+        for key in ['a.RHat', 'b.RHat', 'a.SplitRHat', 'b.SplitRHat']:
+            self.assertEqual(rhat_maps[key].shape, (5,))
+            np.testing.assert_allclose(rhat_maps[key], 1, atol=0.01)
+
+    def test_trending_chains(self):
+        """A chain which is not stationary has a split R-hat larger than one, even with a single chain."""
+        samples = np.random.RandomState(0).normal(size=(1, 1, 1, 1000)) + np.linspace(0, 10, 1000)
+        rhat_maps = calculate_rhat_maps(samples, ['a'])
+        self.assertGreater(rhat_maps['a.SplitRHat'][0], 1.5)
+
+
+class SampleESSTest(unittest.TestCase):
+
+    def test_process_pool(self):
+        samples = np.random.RandomState(0).normal(size=(25, 2, 200))
+        expected = calculate_sample_ess_maps(samples, ['a', 'b'], voxels_per_block=7)
+
+        pool = create_process_pool(2)
+        try:
+            ess_maps = calculate_sample_ess_maps(samples, ['a', 'b'], pool=pool, voxels_per_block=7)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        self.assertEqual(set(ess_maps), {'MultivariateESS', 'a.UnivariateESS', 'b.UnivariateESS'})
+        for key in expected:
+            self.assertEqual(ess_maps[key].shape[0], 25)
+            np.testing.assert_allclose(ess_maps[key], expected[key])
+
+    def test_no_pool(self):
+        self.assertIsNone(create_process_pool(1))
+
+
+class SortOrientationsTest(unittest.TestCase):
+
+    def setUp(self):
+        random_state = np.random.RandomState(0)
+        self._maps = {}
+        for ind in range(3):
+            self._maps['w{}'.format(ind)] = random_state.rand(4, 5, 3)
+            self._maps['theta{}'.format(ind)] = random_state.rand(4, 5, 3, 1)
+            self._maps['vec{}'.format(ind)] = random_state.rand(4, 5, 3, 3)
+        self._maps['other'] = random_state.rand(4, 5, 3)
+
+        self._weight_names = ['w0', 'w1', 'w2']
+        self._extra_sortable_maps = [['theta0', 'theta1', 'theta2'], ['vec0', 'vec1', 'vec2']]
+
+    def _get_expected(self, voxels):
+        expected = {name: np.array(volume) for name, volume in self._maps.items()}
+        for voxel in voxels:
+            order = np.argsort([self._maps[name][voxel] for name in self._weight_names])[::-1]
+            for names in self._extra_sortable_maps + [self._weight_names]:
+                for ind, name in enumerate(names):
+                    expected[name][voxel] = self._maps[names[order[ind]]][voxel]
+        return expected
+
+    def _assert_sorted(self, sorted_maps, expected):
+        self.assertEqual(set(sorted_maps), set(self._maps))
+        for name in self._maps:
+            self.assertEqual(sorted_maps[name].shape, self._maps[name].shape)
+            np.testing.assert_array_equal(sorted_maps[name], expected[name])
+
+    def test_sort(self):
+        inputs = {name: np.array(volume) for name, volume in self._maps.items()}
+        sorted_maps = sort_orientations(inputs, self._weight_names, self._extra_sortable_maps, voxels_per_block=7)
+
+        self._assert_sorted(sorted_maps, self._get_expected(np.ndindex(4, 5, 3)))
+        for name in self._maps:
+            np.testing.assert_array_equal(inputs[name], self._maps[name])
+
+    def test_threaded(self):
+        sorted_maps = sort_orientations(self._maps, self._weight_names, self._extra_sortable_maps,
+                                        voxels_per_block=7, nmr_threads=3)
+        self._assert_sorted(sorted_maps, self._get_expected(np.ndindex(4, 5, 3)))
+
+    def test_mask(self):
+        mask = np.zeros((4, 5, 3), dtype=np.bool_)
+        mask[1:3, ::2] = True
+
+        sorted_maps = sort_orientations(self._maps, self._weight_names, self._extra_sortable_maps, mask=mask,
+                                        voxels_per_block=4, nmr_threads=2)
+        self._assert_sorted(sorted_maps, self._get_expected(zip(*np.nonzero(mask))))
+
+
+if __name__ == '__main__':
+    unittest.main()
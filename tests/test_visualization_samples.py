@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_visualization_samples
+----------------------------------
+
+Tests for the `mdt.visualization.samples` module.
+"""
+import threading
+import time
+import unittest
+
+import matplotlib
+matplotlib.use('Agg')
+
+import numpy as np
+
+from mdt.visualization.samples import _get_close_callback, _VoxelPlotDataCache
+
+
+class _BlockingSamples(object):
+
+    def __init__(self, samples, blocking_voxel):
+        """Samples matrix of which loading the given voxel blocks until it is released."""
+        self._samples = samples
+        self._blocking_voxel = blocking_voxel
+        self.shape = samples.shape
+        self.loaded = []
+        self.loading_started = threading.Event()
+        self.release = threading.Event()
+
+    def __getitem__(self, item):
+        self.loaded.append(item[0])
+        if item[0] == self._blocking_voxel:
+            self.loading_started.set()
+            self.release.wait(10)
+        return self._samples[item]
+
+
+def _wait_for(condition, timeout=10):
+    end_time = time.time() + timeout
+    while not condition():
+        if time.time() > end_time:
+            raise AssertionError('Timed out waiting for the prefetch thread.')
+        time.sleep(0.01)
+
+
+class VoxelPlotDataCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self._samples = np.random.RandomState(0).normal(size=(30, 100))
+
+    def test_get(self):
+        cache = _VoxelPlotDataCache({'a': self._samples}, {'a': 10}, False, nmr_prefetch=0)
+        data = cache.get(3)['a']
+
+        histogram, bin_edges = np.histogram(self._samples[3], 10, density=True)
+        np.testing.assert_array_equal(data.samples, self._samples[3])
+        np.testing.assert_array_equal(data.histogram, histogram)
+        np.testing.assert_array_equal(data.bin_edges, bin_edges)
+        self.assertIs(cache.get(3), cache.get(3))
+
+    def test_lru_eviction(self):
+        cache = _VoxelPlotDataCache({'a': self._samples}, {'a': 10}, False, cache_size=3, nmr_prefetch=0)
+        for voxel_ind in [0, 1, 2, 0, 3]:
+            cache.get(voxel_ind)
+        self.assertEqual(list(cache._cache), [2, 0, 3])
+
+    def test_minimum_cache_size(self):
+        """The cache can always hold the requested voxel and all its prefetched neighbours."""
+        cache = _VoxelPlotDataCache({'a': self._samples}, {'a': 10}, False, cache_size=1, nmr_prefetch=2)
+        self.assertEqual(cache._cache_size, 5)
+
+    def test_prefetch(self):
+        cache = _VoxelPlotDataCache({'a': self._samples}, {'a': 10}, False, nmr_prefetch=2)
+        try:
+            cache.get(0)
+            cache.prefetch(0)
+            _wait_for(lambda: set(cache._cache) == {0, 1, 2})
+        finally:
+            cache.close()
+
+    def test_prefetch_replaces_pending(self):
+        samples = _BlockingSamples(self._samples, 11)
+        cache = _VoxelPlotDataCache({'a': samples}, {'a': 10}, False, nmr_prefetch=1)
+        try:
+            cache.prefetch(10)
+            self.assertTrue(samples.loading_started.wait(10))
+
+            cache.prefetch(20)
+            samples.release.set()
+            _wait_for(lambda: set(cache._cache) == {11, 19, 21})
+            self.assertNotIn(9, samples.loaded)
+        finally:
+            samples.release.set()
+            cache.close()
+
+    def test_close(self):
+        cache = _VoxelPlotDataCache({'a': self._samples}, {'a': 10}, False, nmr_prefetch=1)
+        cache.prefetch(5)
+        _wait_for(lambda: set(cache._cache) == {4, 6})
+
+        _get_close_callback(cache)(None)
+        cache._thread.join(10)
+        self.assertFalse(cache._thread.is_alive())
+        self.assertEqual(len(cache._cache), 0)
+
+        cache.get(3)
+        self.assertEqual(len(cache._cache), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()